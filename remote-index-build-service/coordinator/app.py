@@ -4,7 +4,8 @@ import json
 import logging
 from logging.handlers import RotatingFileHandler
 from waitress import serve
-from client.worker_client import WorkerService, Worker, RegisterWorkerRequest
+from client.worker_client import WorkerService, Worker, RegisterWorkerRequest, UnknownWorkerError, get_worker_from_seed_file
+from client.worker_scheduler import AdmissionRejected
 import traceback
 import os
 import math
@@ -51,15 +52,6 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-def get_worker_from_seed_file(seed_file):
-    with open(seed_file, 'r') as f:
-        data = json.load(f)
-        workers = []
-        for worker in data:
-            workers.append(Worker(worker['host'], worker['port']))
-        logging.info(f"Workers are: {workers}")
-        return workers
-
 if is_dev_env():
     logger.info("Running in dev mode")
     workers = get_worker_from_seed_file("workers_seed.json")
@@ -73,35 +65,26 @@ def heart_beat(workerService):
     logger.info(f"Running the heart beat thread")
     show_message = True
     while True:
+        # The snapshot of the workers doesn't change while the workers are registered or removed
         worker_clients = workerService.worker_clients
-        round_robin_iterator = workerService.round_robin_iterator
         if show_message:
-            logger.info(f"Workers before heart beat is : {worker_clients} {round_robin_iterator}")
+            logger.info(f"Workers before heart beat is : {worker_clients}")
             show_message = False
-        for worker_client in worker_clients[:]:
+        for worker_client in worker_clients:
             try:
                 if show_message:
                     logger.info(f"Checking client: {worker_client.worker.host}, port: {worker_client.worker.port}")
-                if not worker_client.heart_beat():
+                heart_beat_response = worker_client.heart_beat()
+                if heart_beat_response is not None:
+                    workerService.refresh_worker_load(worker_client, heart_beat_response.get("capabilities"))
+                else:
                     show_message = True
-                    if round_robin_iterator is not None:
-                        logger.info(f"Removing client: {worker_client.worker.host}, port: {worker_client.worker.port}")
-                        if round_robin_iterator.has_item(worker_client):
-                            round_robin_iterator.remove_item(worker_client)
-                            logger.info(f"Removed client: {worker_client.worker.host}, port: {worker_client.worker.port}")
-                        else:
-                            logger.info(f"iterator round_robin_iterator doesn't have: {worker_client.worker.host}, port: {worker_client.worker.port}")
-
-                    else:
-                        logger.info(f"iterator round_robin_iterator was null: {worker_client.worker.host}, port: {worker_client.worker.port}")
-
-                    if worker_client in worker_clients:
-                        worker_clients.remove(worker_client)
-
+                    logger.info(f"Removing client: {worker_client.worker.host}, port: {worker_client.worker.port}")
+                    workerService.remove_worker(worker_client)
             except Exception as e:
                 logger.error(f"Error in heart beat: {e}")
         if show_message:
-            logger.info(f"Workers after heart beat is : {worker_clients}, {round_robin_iterator}")
+            logger.info(f"Workers after heart beat is : {workerService.worker_clients}")
         # Sleeping for 5 sec
         time.sleep(5)
 
@@ -131,13 +114,31 @@ def create_index():
         response = workerservice.create_index(input)
         logger.info(f"Response is: {response}")
         return json.dumps(response, default=lambda o: o.__dict__, indent=4)
+    except AdmissionRejected as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/create_index_batch', methods=['POST'])
+def create_index_batch():
+    try:
+        input = dict(request.json)
+        number_of_shards = int(input.pop('number_of_shards'))
+        response = workerservice.create_index_batch(input, number_of_shards)
+        logger.info(f"Response is: {response}")
+        return json.dumps(response, default=lambda o: o.__dict__, indent=4)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/jobs', methods=['GET'])
 def get_jobs():
     try:
-        return workerservice.get_jobs()
+        # The jobs are served from the job registry of the coordinator, without asking the workers
+        return workerservice.get_jobs(
+            status=request.args.get('status'),
+            offset=int(request.args.get('offset', 0)),
+            limit=int(request.args.get('limit', 100))
+        )
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -150,6 +151,34 @@ def job(job_id: str):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/job/<string:job_id>', methods=['DELETE'])
+def cancel_job(job_id: str):
+    try:
+        # Stops the job on its worker, or all the shards of a batch job
+        response = workerservice.cancel_job(job_id)
+        return json.dumps(response, default=lambda o: o.__dict__, indent=4), 200
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/job_status', methods=['POST'])
+def job_status():
+    # The workers push the status changes of their jobs
+    job_status = request.get_json(silent=True)
+    try:
+        workerservice.update_job_status(job_status)
+    except UnknownWorkerError as e:
+        # The worker pushed before it registered, or the coordinator restarted, it registers again and pushes again
+        logger.warning(f"Rejected the job status {job_status} : {e}")
+        return jsonify({"error": str(e)}), 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error updating the job status {job_status} : {e}")
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"message": "Job status updated"}), 200
+
 @app.route('/register_worker', methods=['POST'])
 def register_worker():
     try:
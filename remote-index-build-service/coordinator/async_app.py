@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import traceback
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from aiohttp import web
+
+from client.async_worker_client import AsyncWorkerService
+from client.worker_client import RegisterWorkerRequest, UnknownWorkerError, get_worker_from_seed_file
+from client.worker_scheduler import AdmissionRejected
+from util.common import is_dev_env
+
+# The asyncio coordinator, which serves the same APIs as app.py. The heart beats, the job status refresh and the
+# dispatch of the jobs run concurrently on a single event loop, over a pool of keep-alive connections to the workers.
+
+logger = logging.getLogger(__name__)
+
+PORT = int(os.getenv('COORDINATOR_PORT', 6006))
+
+routes = web.RouteTableDef()
+
+
+def to_json_response(data, status: int = 200):
+    return web.Response(text=json.dumps(data, default=lambda o: o.__dict__, indent=4), status=status,
+                        content_type='application/json')
+
+
+@routes.get('/')
+async def hello(request: web.Request):
+    return web.json_response({
+        "message": "Hello from Vector Index Build Service Coordinator!",
+        "timestamp": datetime.now().isoformat()
+    })
+
+
+@routes.post('/create_index')
+async def create_index(request: web.Request):
+    try:
+        response = await request.app["workerservice"].create_index(await request.json())
+        logger.info(f"Response is: {response}")
+        return to_json_response(response)
+    except AdmissionRejected as e:
+        return web.json_response({"error": str(e)}, status=503)
+    except Exception as e:
+        return web.json_response({"error": str(e)}, status=500)
+
+
+@routes.post('/create_index_batch')
+async def create_index_batch(request: web.Request):
+    try:
+        data = await request.json()
+        number_of_shards = int(data.pop('number_of_shards'))
+        response = await request.app["workerservice"].create_index_batch(data, number_of_shards)
+        logger.info(f"Response is: {response}")
+        return to_json_response(response)
+    except Exception as e:
+        return web.json_response({"error": str(e)}, status=500)
+
+
+@routes.get('/jobs')
+async def get_jobs(request: web.Request):
+    try:
+        # The jobs are served from the job registry of the coordinator, without asking the workers
+        return web.json_response(request.app["workerservice"].get_jobs(
+            status=request.query.get('status'),
+            offset=int(request.query.get('offset', 0)),
+            limit=int(request.query.get('limit', 100))
+        ))
+    except Exception as e:
+        return web.json_response({"error": str(e)}, status=500)
+
+
+@routes.get('/job/{job_id}')
+async def job(request: web.Request):
+    try:
+        return to_json_response(await request.app["workerservice"].get_job(request.match_info['job_id']))
+    except Exception as e:
+        return web.json_response({"error": str(e)}, status=500)
+
+
+@routes.delete('/job/{job_id}')
+async def cancel_job(request: web.Request):
+    try:
+        # Stops the job on its worker, or all the shards of a batch job
+        return to_json_response(await request.app["workerservice"].cancel_job(request.match_info['job_id']))
+    except LookupError as e:
+        return web.json_response({"error": str(e)}, status=404)
+    except Exception as e:
+        return web.json_response({"error": str(e)}, status=500)
+
+
+@routes.post('/job_status')
+async def job_status(request: web.Request):
+    # The workers push the status changes of their jobs
+    data = None
+    try:
+        data = await request.json()
+        request.app["workerservice"].update_job_status(data)
+    except UnknownWorkerError as e:
+        # The worker pushed before it registered, or the coordinator restarted, it registers again and pushes again
+        logger.warning(f"Rejected the job status {data} : {e}")
+        return web.json_response({"error": str(e)}, status=409)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    except Exception as e:
+        logger.error(f"Error updating the job status {data} : {e!r}")
+        return web.json_response({"error": str(e)}, status=500)
+    return web.json_response({"message": "Job status updated"})
+
+
+@routes.post('/register_worker')
+async def register_worker(request: web.Request):
+    data = await request.json()
+    try:
+        logger.info(f"Received request: {data}")
+        request.app["workerservice"].register_worker(RegisterWorkerRequest.build_register_worker_request(data))
+    except Exception:
+        logger.error(traceback.format_exc())
+        return web.json_response({"error": f"Invalid request {data}"}, status=400)
+    return web.json_response({"message": "Worker registered successfully"}, status=201)
+
+
+@routes.get('/workers')
+async def get_all_worker(request: web.Request):
+    return to_json_response({"workerList": request.app["workerservice"].get_all_worker()})
+
+
+def build_app(workerservice: AsyncWorkerService, run_heart_beat: bool = True) -> web.Application:
+    async def lifecycle(app: web.Application):
+        await workerservice.start(run_heart_beat=run_heart_beat)
+        yield
+        await workerservice.close()
+
+    app = web.Application()
+    app["workerservice"] = workerservice
+    app.add_routes(routes)
+    app.cleanup_ctx.append(lifecycle)
+    return app
+
+
+def setup_logging():
+    root_logger = logging.getLogger()
+    level = logging.DEBUG if is_dev_env() else logging.INFO
+    root_logger.setLevel(level)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    for handler in [logging.StreamHandler(),
+                    RotatingFileHandler('/app/logs/remote-index-build-service.log', maxBytes=1024 * 1024, backupCount=5)]:
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+        root_logger.addHandler(handler)
+
+
+if __name__ == '__main__':
+    setup_logging()
+    if is_dev_env():
+        logger.info("Running in dev mode so not going to start the heart beat process")
+        workers = get_worker_from_seed_file("workers_seed.json")
+    else:
+        logger.info("Running in prod mode, workers will be added by user")
+        workers = []
+    web.run_app(build_app(AsyncWorkerService(workers), run_heart_beat=not is_dev_env()), host="0.0.0.0", port=PORT)
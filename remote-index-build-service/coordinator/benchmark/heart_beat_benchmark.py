@@ -0,0 +1,138 @@
+"""
+Compares the threaded coordinator (app.py, WorkerService) with the asyncio coordinator (async_app.py,
+AsyncWorkerService) against many simulated workers, some of which are down or too slow to answer.
+
+It measures the time of a heart beat sweep over all the workers, the time to dispatch create index requests, and
+the time of a status refresh of all the dispatched jobs.
+
+Run it from the coordinator directory:
+    python -m benchmark.heart_beat_benchmark --workers 200 --slow-workers 10 --dead-workers 10
+"""
+import argparse
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from client.async_worker_client import AsyncWorkerService
+from client.worker_client import Worker, WorkerService
+
+BASE_PORT = 21000
+# Simulated workers which are too slow to answer sleep longer than any timeout of the coordinator
+SLOW_WORKER_DELAY = 30
+
+
+def build_simulated_worker(latency: float, slow: bool) -> web.Application:
+    job_ids = itertools.count()
+
+    async def respond(data, status=200):
+        await asyncio.sleep(SLOW_WORKER_DELAY if slow else latency)
+        return web.json_response(data, status=status)
+
+    async def heart_beat(request):
+        return await respond({"message": "Hello"})
+
+    async def create_index(request):
+        return await respond({"job_id": f"{request.url.port}-{next(job_ids)}", "status": "submitted"}, status=201)
+
+    async def job(request):
+        return await respond({"status": "running", "result": None, "error": None})
+
+    async def jobs(request):
+        return await respond({"jobs": {}, "total": 0, "memory_budget": 64 * 1024 * 1024 * 1024})
+
+    app = web.Application()
+    app.add_routes([web.get('/heart_beat', heart_beat), web.post('/create_index', create_index),
+                    web.get('/job/{job_id}', job), web.get('/jobs', jobs)])
+    return app
+
+
+def start_simulated_workers(workers: int, slow_workers: int, dead_workers: int, latency: float) -> list:
+    """Start the simulated workers on an event loop of their own, the dead workers are never started"""
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    async def start():
+        for i in range(workers - dead_workers):
+            runner = web.AppRunner(build_simulated_worker(latency, slow=i < slow_workers), access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", BASE_PORT + i).start()
+        started.set()
+
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(start(), loop)
+    started.wait()
+    return [Worker("127.0.0.1", BASE_PORT + i) for i in range(workers)]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def benchmark_threaded(workers: list, live_workers: list, jobs: int, dispatch_threads: int) -> dict:
+    service = WorkerService(workers=workers)
+    # The heart beat loop of app.py checks the workers one after another
+    sweep_time, _ = timed(lambda: [worker_client.heart_beat() for worker_client in service.worker_clients])
+    # Only dispatch to the workers which answer, like after the heart beat removed the others
+    for worker_client in service.worker_clients:
+        if worker_client.worker not in live_workers:
+            service.remove_worker(worker_client)
+    with ThreadPoolExecutor(max_workers=dispatch_threads) as executor:
+        request = {"number_of_vectors": 1000, "dimensions": 128}
+        dispatch_time, _ = timed(lambda: list(executor.map(lambda _: service.create_index(request), range(jobs))))
+    refresh_time, _ = timed(service.refresh_job_statuses)
+    return {"heart_beat_sweep": sweep_time, "dispatch": dispatch_time, "job_status_refresh": refresh_time}
+
+
+async def benchmark_async(workers: list, live_workers: list, jobs: int) -> dict:
+    service = AsyncWorkerService(workers=workers)
+    await service.start(run_heart_beat=False)
+    try:
+        start = time.perf_counter()
+        await service.heart_beat_sweep()
+        sweep_time = time.perf_counter() - start
+        for worker_client in service.worker_clients:
+            if worker_client.worker not in live_workers:
+                service.remove_worker(worker_client)
+        request = {"number_of_vectors": 1000, "dimensions": 128}
+        start = time.perf_counter()
+        await asyncio.gather(*[service.create_index(request) for _ in range(jobs)])
+        dispatch_time = time.perf_counter() - start
+        start = time.perf_counter()
+        await service.refresh_job_statuses()
+        refresh_time = time.perf_counter() - start
+        return {"heart_beat_sweep": sweep_time, "dispatch": dispatch_time, "job_status_refresh": refresh_time}
+    finally:
+        await service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=200)
+    parser.add_argument("--slow-workers", type=int, default=10)
+    parser.add_argument("--dead-workers", type=int, default=10)
+    parser.add_argument("--jobs", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=5, help="Latency of a simulated worker request")
+    parser.add_argument("--dispatch-threads", type=int, default=24,
+                        help="Threads dispatching requests to the threaded coordinator, like the waitress threads")
+    args = parser.parse_args()
+
+    workers = start_simulated_workers(args.workers, args.slow_workers, args.dead_workers, args.latency_ms / 1000)
+    live_workers = workers[args.slow_workers:args.workers - args.dead_workers]
+    results = {
+        "threaded": benchmark_threaded(workers, live_workers, args.jobs, args.dispatch_threads),
+        "async": asyncio.run(benchmark_async(workers, live_workers, args.jobs))
+    }
+    print(f"{args.workers} workers ({args.slow_workers} slow, {args.dead_workers} dead), {args.jobs} jobs")
+    print(f"{'coordinator':<12}{'heart beat sweep (s)':>22}{'dispatch (s)':>15}{'status refresh (s)':>20}")
+    for name, result in results.items():
+        print(f"{name:<12}{result['heart_beat_sweep']:>22.3f}{result['dispatch']:>15.3f}{result['job_status_refresh']:>20.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+from client.batch_jobs import BatchJob, BatchJobRegistry, Shard, split_in_shards
+from client.job_registry import JobRegistry
+from client.worker_client import Worker, RegisterWorkerRequest, scheduling_policy, job_registry_max_jobs, \
+    job_status_refresh_interval, admission_control, apply_cancelled_job, apply_job_status, build_estimator, \
+    learn_from_job, record_dispatched_job, update_capabilities, validate_job_status, UnknownWorkerError
+from client.worker_membership import WorkerMembership
+from client.worker_scheduler import WorkerLoad, WorkerScheduler, build_scheduling_policy
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of pooled keep-alive connections to all the workers, and to a single worker
+worker_connection_limit = int(os.getenv('WORKER_CONNECTION_LIMIT', 256))
+worker_connection_limit_per_host = int(os.getenv('WORKER_CONNECTION_LIMIT_PER_HOST', 8))
+# Maximum number of concurrent requests of a heart beat sweep or of a job status refresh
+worker_request_parallelism = int(os.getenv('WORKER_REQUEST_PARALLELISM', 128))
+heart_beat_interval = float(os.getenv('HEART_BEAT_INTERVAL_SECONDS', 5))
+heart_beat_timeout = float(os.getenv('HEART_BEAT_TIMEOUT_SECONDS', 1))
+# Timeout of the other requests to the workers
+worker_request_timeout = float(os.getenv('WORKER_REQUEST_TIMEOUT_SECONDS', 10))
+
+
+class AsyncWorkerClient:
+
+    def __init__(self, worker: Worker, session: aiohttp.ClientSession, protocol: str = 'http'):
+        self.worker = worker
+        self.load = WorkerLoad()
+        self.capabilities = {}
+        self._session = session
+        self._base_url = f"{protocol}://{worker.host}:{worker.port}"
+
+    @property
+    def pushes_job_status(self) -> bool:
+        """Whether the worker pushes the status changes of its jobs, so they don't have to be polled"""
+        return self.capabilities.get("push_job_status", False)
+
+    async def get_job(self, job_id: str):
+        """Returns the HTTP status and the job, which is None when the status is not 200"""
+        async with self._session.get(f"{self._base_url}/job/{job_id}") as response:
+            return response.status, await response.json() if response.status == 200 else None
+
+    async def cancel_job(self, job_id: str):
+        """Returns the HTTP status and the job, which is None when the worker doesn't know the job"""
+        async with self._session.delete(f"{self._base_url}/job/{job_id}") as response:
+            return response.status, await response.json() if response.status in (200, 202, 409) else None
+
+    async def create_index(self, createIndexRequest: dict):
+        logger.info(f"createIndexRequest is : {createIndexRequest}")
+        async with self._session.post(f"{self._base_url}/create_index", json=createIndexRequest) as response:
+            if response.status == 200 or response.status == 201:
+                return await response.json()
+            return None
+
+    async def get_scheduler_stats(self):
+        """Returns the state of the job scheduler of the worker, like its memory budget, without any job"""
+        async with self._session.get(f"{self._base_url}/jobs", params={"limit": 0}) as response:
+            return await response.json(content_type=None)
+
+    async def heart_beat(self):
+        """Returns the heart beat of the worker, with the capabilities it advertises, or None when it is down"""
+        try:
+            timeout = aiohttp.ClientTimeout(total=heart_beat_timeout)
+            async with self._session.get(f"{self._base_url}/heart_beat", timeout=timeout) as response:
+                if response.status == 200:
+                    return await response.json(content_type=None)
+        except Exception as e:
+            logger.error(f"Error in heart_beat for {self.worker.host}:{self.worker.port} : {e!r}")
+        return None
+
+    def __str__(self):
+        return f"AsyncWorkerClient(host={self.worker.host}, port={self.worker.port})"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class AsyncWorkerService:
+    """
+    The asyncio counterpart of WorkerService. The heart beats of all the workers and the status refresh of all
+    the unfinished jobs are sent concurrently, at most worker_request_parallelism requests at a time, over a
+    single pool of keep-alive connections. The placement of the jobs and the job registry are the same as in
+    WorkerService.
+
+    start must be called from the event loop before the service is used, close once it is not used anymore.
+    """
+
+    def __init__(self, workers: list):
+        self.workers = workers
+        self.membership = WorkerMembership()
+        self.estimator = build_estimator()
+        self.scheduler = WorkerScheduler(build_scheduling_policy(scheduling_policy), self.estimator, admission_control)
+        self.job_registry = JobRegistry(max_jobs=job_registry_max_jobs,
+                                        on_job_completed=self._learn_from_job)
+        self.batch_job_registry = BatchJobRegistry(max_jobs=job_registry_max_jobs)
+        self._session = None
+        self._semaphore = None
+        self._tasks = []
+
+    async def start(self, run_heart_beat: bool = True):
+        connector = aiohttp.TCPConnector(limit=worker_connection_limit, limit_per_host=worker_connection_limit_per_host)
+        self._session = aiohttp.ClientSession(connector=connector,
+                                              timeout=aiohttp.ClientTimeout(total=worker_request_timeout))
+        self._semaphore = asyncio.Semaphore(worker_request_parallelism)
+        self.membership = WorkerMembership([AsyncWorkerClient(worker, self._session) for worker in self.workers])
+        self._tasks.append(asyncio.create_task(self._run_forever(self.refresh_job_statuses, job_status_refresh_interval)))
+        if run_heart_beat:
+            self._tasks.append(asyncio.create_task(self._run_forever(self.heart_beat_sweep, heart_beat_interval)))
+
+    @property
+    def worker_clients(self) -> tuple:
+        """The current snapshot of the clients of the workers, which is never modified"""
+        return self.membership.snapshot()
+
+    def _learn_from_job(self, job):
+        # The jobs complete on the event loop, the estimator is saved to its file by a thread of the default executor
+        learn_from_job(self.estimator, job, save=False)
+        if self.estimator.path is not None:
+            asyncio.get_running_loop().run_in_executor(None, self.estimator.save)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._session.close()
+
+    async def create_index(self, createIndexRequest: dict):
+        worker_client, reservation_id = self.scheduler.reserve(self.worker_clients, createIndexRequest)
+        logger.debug(f"in create_index call, placing the request on {worker_client}")
+        try:
+            response = await worker_client.create_index(createIndexRequest)
+        except Exception:
+            self.scheduler.cancel(reservation_id)
+            raise
+        if response is None:
+            self.scheduler.cancel(reservation_id)
+        else:
+            self.scheduler.confirm(reservation_id, response["job_id"])
+            record_dispatched_job(self.job_registry, self.scheduler, self.membership, worker_client, response,
+                                  createIndexRequest)
+        logger.info(f"response is : {response}")
+        return response
+
+    async def create_index_batch(self, createIndexRequest: dict, number_of_shards: int):
+        """The asyncio counterpart of WorkerService.create_index_batch, the shards are dispatched concurrently"""
+        batch_job = BatchJob(batch_id=BatchJobRegistry.new_batch_id(), request=createIndexRequest,
+                             shards=[Shard(shard, request) for shard, request in
+                                     enumerate(split_in_shards(createIndexRequest, number_of_shards))])
+        responses = await asyncio.gather(*[self.create_index(shard.request) for shard in batch_job.shards],
+                                         return_exceptions=True)
+        for shard, response in zip(batch_job.shards, responses):
+            if isinstance(response, Exception):
+                logger.error(f"Error dispatching shard {shard.shard} of {batch_job.batch_id} : {response!r}")
+                shard.error = str(response)
+            elif response is None:
+                shard.error = "The worker rejected the shard"
+            else:
+                shard.job_id = response["job_id"]
+        self.batch_job_registry.add(batch_job)
+        return {"job_id": batch_job.batch_id, **batch_job.to_status(self.job_registry)}
+
+    async def get_job(self, job_id: str):
+        if BatchJobRegistry.is_batch_id(job_id):
+            batch_job = self.batch_job_registry.get(job_id)
+            if batch_job is None:
+                raise Exception(f"Error in get_job for job_id {job_id}")
+            return batch_job.to_status(self.job_registry)
+        job = self.job_registry.get(job_id)
+        if job is not None:
+            return job.to_status()
+        # The job was not dispatched by this coordinator, or it was evicted from the registry. The workers which
+        # push the status of their jobs are asked too, their pushes could have been rejected while they were not
+        # registered, or lost with the registry when the coordinator restarted
+        worker_clients = list(self.worker_clients)
+        responses = await asyncio.gather(*[self._bounded(w.get_job(job_id)) for w in worker_clients],
+                                         return_exceptions=True)
+        for worker_client, response in zip(worker_clients, responses):
+            if isinstance(response, Exception) or response[0] != 200:
+                continue
+            job = response[1]
+            self.job_registry.record(job_id, worker_client, job.get("status"), result=job.get("result"),
+                                     error=job.get("error"))
+            self.scheduler.update_job_status(job_id, job.get("status"))
+            return job
+        raise Exception(f"Error in get_job for job_id {job_id}")
+
+    async def cancel_job(self, job_id: str):
+        """The asyncio counterpart of WorkerService.cancel_job, the shards of a batch job are cancelled concurrently"""
+        if BatchJobRegistry.is_batch_id(job_id):
+            batch_job = self.batch_job_registry.get(job_id)
+            if batch_job is None:
+                raise LookupError(f"Job {job_id} not found")
+            shards = [shard for shard in batch_job.shards if shard.job_id is not None]
+            responses = await asyncio.gather(*[self._bounded(self._cancel_registered_job(shard.job_id))
+                                               for shard in shards], return_exceptions=True)
+            for shard, response in zip(shards, responses):
+                if isinstance(response, Exception):
+                    logger.error(f"Error cancelling shard {shard.shard} of {job_id} : {response!r}")
+            return batch_job.to_status(self.job_registry)
+        if self.job_registry.get(job_id) is None:
+            try:
+                await self.get_job(job_id)
+            except Exception:
+                raise LookupError(f"Job {job_id} not found")
+        return await self._cancel_registered_job(job_id)
+
+    async def _cancel_registered_job(self, job_id: str):
+        job = self.job_registry.get(job_id)
+        if job is None:
+            raise LookupError(f"Job {job_id} not found")
+        if not job.is_terminal():
+            http_status, job_status = await job.worker_client.cancel_job(job_id)
+            apply_cancelled_job(self.job_registry, self.scheduler, job, http_status, job_status)
+        return job.to_status()
+
+    def get_jobs(self, status: str = None, offset: int = 0, limit: int = 100):
+        """Returns a page of the jobs dispatched by the coordinator, newest first, from the job registry"""
+        jobs, total = self.job_registry.query(status=status, offset=offset, limit=limit)
+        return {
+            "jobs": {job.job_id: job.to_dict() for job in jobs},
+            "total": total,
+            "offset": offset,
+            "limit": limit
+        }
+
+    async def refresh_job_statuses(self):
+        """
+        Refresh the status of the unfinished jobs concurrently, with 1 request per job. Only the jobs of the
+        workers which don't push the status of their jobs are refreshed.
+        """
+        pending_jobs = [job for job in self.job_registry.get_pending_jobs() if not job.worker_client.pushes_job_status]
+        responses = await asyncio.gather(*[self._bounded(job.worker_client.get_job(job.job_id)) for job in pending_jobs],
+                                         return_exceptions=True)
+        for job, response in zip(pending_jobs, responses):
+            if isinstance(response, Exception):
+                logger.debug(f"Error refreshing the status of job {job.job_id} : {response!r}")
+                continue
+            http_status, status = response
+            if http_status == 200:
+                self.job_registry.update(job.job_id, status.get("status"), status.get("result"), status.get("error"))
+                self.scheduler.update_job_status(job.job_id, status.get("status"))
+            elif http_status == 404:
+                # The worker restarted and lost the job
+                self.job_registry.update(job.job_id, "failed", error=f"Job not found on {job.worker_client}")
+                self.scheduler.job_finished(job.job_id)
+
+    async def heart_beat_sweep(self):
+        """
+        Check all the workers concurrently, remove the ones which are down and refresh the capabilities they
+        advertise in their heart beat
+        """
+        worker_clients = self.worker_clients
+        heart_beats = await asyncio.gather(*[self._bounded(w.heart_beat()) for w in worker_clients])
+        legacy_worker_clients = []
+        for worker_client, heart_beat in zip(worker_clients, heart_beats):
+            if heart_beat is None:
+                logger.info(f"Removing client: {worker_client.worker.host}, port: {worker_client.worker.port}")
+                self.remove_worker(worker_client)
+            elif "capabilities" in heart_beat:
+                update_capabilities(self.scheduler, worker_client, heart_beat["capabilities"])
+            else:
+                legacy_worker_clients.append(worker_client)
+        # The workers which don't advertise their capabilities in their heart beat report their memory budget in /jobs
+        stats = await asyncio.gather(*[self._bounded(w.get_scheduler_stats()) for w in legacy_worker_clients],
+                                     return_exceptions=True)
+        for worker_client, worker_stats in zip(legacy_worker_clients, stats):
+            if isinstance(worker_stats, dict) and "memory_budget" in worker_stats:
+                self.scheduler.update_capacity(worker_client, worker_stats["memory_budget"])
+
+    def update_job_status(self, job_status: dict):
+        """Apply a status change pushed by the worker running the job, see WorkerService.update_job_status"""
+        validate_job_status(job_status)
+        worker_client = self.membership.find(job_status["workerURL"], job_status["workerPort"])
+        if worker_client is None:
+            raise UnknownWorkerError(f"Unknown worker {job_status['workerURL']}:{job_status['workerPort']}")
+        apply_job_status(self.job_registry, self.scheduler, worker_client, job_status)
+
+    def remove_worker(self, worker_client: AsyncWorkerClient):
+        self.membership.remove(worker_client)
+        self.scheduler.remove_worker(worker_client)
+        self.job_registry.remove_worker(worker_client)
+
+    def register_worker(self, register_worker_request_list: list[RegisterWorkerRequest]):
+        logger.info(f"register_worker_request is : {register_worker_request_list}")
+        for register_worker_request in register_worker_request_list:
+            worker = Worker(register_worker_request.workerURL, register_worker_request.workerPort)
+            worker_client, added = self.membership.add(
+                worker.host, worker.port,
+                lambda: AsyncWorkerClient(worker, self._session, register_worker_request.workerProtocol))
+            if not added:
+                logger.info(f"Worker {worker.host}:{worker.port} is already registered")
+            if register_worker_request.capabilities is not None:
+                update_capabilities(self.scheduler, worker_client, register_worker_request.capabilities)
+
+    def get_all_worker(self):
+        return [{
+            "workerURL": worker.worker.host,
+            "workerPort": worker.worker.port,
+            "load": worker.load.to_dict(),
+            "capabilities": worker.capabilities
+        } for worker in self.worker_clients]
+
+    async def _bounded(self, coroutine):
+        async with self._semaphore:
+            return await coroutine
+
+    async def _run_forever(self, task, interval: float):
+        while True:
+            try:
+                await task()
+            except Exception as e:
+                logger.error(f"Error in {task.__name__}: {e!r}")
+            await asyncio.sleep(interval)
@@ -0,0 +1,121 @@
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from client.job_registry import JobRegistry, TERMINAL_STATUSES
+
+BATCH_JOB_ID_PREFIX = "batch-"
+
+
+def split_in_shards(createIndexRequest: dict, number_of_shards: int) -> List[dict]:
+    """
+    Split a create index request in number_of_shards create index requests over contiguous ranges of the
+    vectors of the object, which differ by at most 1 vector. Each shard request keeps the total number of
+    vectors of the object, so the worker can find the ids of its vectors.
+    """
+    number_of_vectors = int(createIndexRequest["number_of_vectors"])
+    if number_of_shards < 1 or number_of_shards > number_of_vectors:
+        raise ValueError(f"number_of_shards should be between 1 and {number_of_vectors}, got {number_of_shards}")
+    shard_requests = []
+    vector_offset = 0
+    for shard in range(number_of_shards):
+        shard_vectors = number_of_vectors // number_of_shards + (1 if shard < number_of_vectors % number_of_shards else 0)
+        shard_requests.append({
+            **createIndexRequest,
+            "number_of_vectors": shard_vectors,
+            "vector_offset": vector_offset,
+            "total_number_of_vectors": number_of_vectors
+        })
+        vector_offset += shard_vectors
+    return shard_requests
+
+
+@dataclass
+class Shard:
+    shard: int
+    request: dict
+    job_id: str = None
+    # Set when the shard could not be dispatched to a worker
+    error: str = None
+
+    def to_status(self, job_registry: JobRegistry) -> dict:
+        status, graph_file_location, error, estimated_completion = "failed", None, self.error, None
+        job = job_registry.get(self.job_id) if self.job_id is not None else None
+        if job is not None:
+            status, error, estimated_completion = job.status, job.error, job.estimated_completion
+            if isinstance(job.result, dict):
+                graph_file_location = job.result.get("graphFileLocation")
+        elif self.job_id is not None:
+            status, error = "unknown", f"Job {self.job_id} is not in the job registry anymore"
+        return {
+            "shard": self.shard,
+            "vector_offset": self.request["vector_offset"],
+            "number_of_vectors": self.request["number_of_vectors"],
+            "job_id": self.job_id,
+            "status": status,
+            "error": error,
+            "estimated_completion": estimated_completion,
+            "graphFileLocation": graph_file_location
+        }
+
+
+@dataclass
+class BatchJob:
+    """
+    A create index request built as several shard jobs, on one worker each. Its status is failed as soon as a
+    shard failed and completed once all the shards completed, in which case its result is the manifest of the
+    index files of the shards. It is cancelled once all the shards are finished and some of them were cancelled.
+    """
+    batch_id: str
+    request: dict
+    shards: List[Shard]
+    created_at: float = field(default_factory=time.time)
+
+    def to_status(self, job_registry: JobRegistry) -> dict:
+        shards = [shard.to_status(job_registry) for shard in self.shards]
+        statuses = {shard["status"] for shard in shards}
+        if statuses & {"failed", "unknown"}:
+            status = "failed"
+        elif statuses == {"completed"}:
+            status = "completed"
+        elif statuses <= set(TERMINAL_STATUSES):
+            status = "cancelled"
+        else:
+            status = "running"
+        errors = [f"Shard {shard['shard']}: {shard['error']}" for shard in shards if shard["error"]]
+        result = {"bucketName": self.request["bucket_name"], "shards": shards}
+        # The batch completes with its last shard
+        estimated_completions = [shard["estimated_completion"] for shard in shards]
+        estimated_completion = max(estimated_completions) if None not in estimated_completions else None
+        return {"status": status, "result": result, "error": "; ".join(errors) if status == "failed" else None,
+                "estimated_completion": estimated_completion}
+
+
+class BatchJobRegistry:
+    """Keeps the batch jobs dispatched by the coordinator, the status of their shards is read from the job registry"""
+
+    def __init__(self, max_jobs: int = 10000):
+        self.max_jobs = max_jobs
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_batch_id() -> str:
+        return f"{BATCH_JOB_ID_PREFIX}{uuid.uuid4()}"
+
+    @staticmethod
+    def is_batch_id(job_id: str) -> bool:
+        return job_id.startswith(BATCH_JOB_ID_PREFIX)
+
+    def add(self, batch_job: BatchJob):
+        with self._lock:
+            self._batches[batch_job.batch_id] = batch_job
+            # The batches are in creation order, so the oldest ones are evicted first
+            while len(self._batches) > self.max_jobs:
+                del self._batches[next(iter(self._batches))]
+
+    def get(self, batch_id: str) -> Optional[BatchJob]:
+        with self._lock:
+            return self._batches.get(batch_id)
@@ -0,0 +1,197 @@
+import json
+import logging
+import math
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Phases of a build whose time is learned, along with the peak memory of the build
+DOWNLOAD_PHASE = "download"
+BUILD_PHASE = "build"
+UPLOAD_PHASE = "upload"
+MEMORY = "memory"
+# The features are scaled so that the normal equations stay well conditioned for billions of vector elements
+ELEMENTS_SCALE = 1e9
+VECTORS_SCALE = 1e7
+MEMORY_SCALE = 1e9
+DEFAULT_BUILD_TYPE = "cpu"
+
+
+def _features(target: str, number_of_vectors: int, dimensions: int) -> List[float]:
+    elements = number_of_vectors * dimensions / ELEMENTS_SCALE
+    if target == BUILD_PHASE:
+        # Inserting a vector in a graph index visits about log(n) nodes of d elements each
+        return [1.0, elements, elements * math.log2(max(number_of_vectors, 2))]
+    if target == MEMORY:
+        return [1.0, elements, number_of_vectors / VECTORS_SCALE]
+    # The download and the upload are proportional to the size of the vectors
+    return [1.0, elements]
+
+
+class OnlineLinearRegression:
+    """
+    A ridge regression updated one sample at a time. Only the normal equations X^T X and X^T y are kept, so an
+    update and a prediction cost the same whatever the number of samples, and the model is small to persist.
+    """
+
+    def __init__(self, number_of_features: int, ridge: float = 1e-3):
+        self.ridge = ridge
+        self.xtx = np.zeros((number_of_features, number_of_features))
+        self.xty = np.zeros(number_of_features)
+        self.samples = 0
+        self._coefficients = None
+
+    def update(self, x: List[float], y: float):
+        x = np.asarray(x, dtype=np.float64)
+        self.xtx += np.outer(x, x)
+        self.xty += x * y
+        self.samples += 1
+        self._coefficients = None
+
+    def predict(self, x: List[float]) -> float:
+        if self._coefficients is None:
+            # The intercept is not regularized
+            regularization = self.ridge * np.eye(len(self.xty))
+            regularization[0, 0] = 0
+            self._coefficients = np.linalg.lstsq(self.xtx + regularization, self.xty, rcond=None)[0]
+        return max(float(np.dot(self._coefficients, x)), 0.0)
+
+    def to_dict(self) -> dict:
+        return {"xtx": self.xtx.tolist(), "xty": self.xty.tolist(), "samples": self.samples, "ridge": self.ridge}
+
+    @staticmethod
+    def from_dict(data: dict) -> 'OnlineLinearRegression':
+        regression = OnlineLinearRegression(len(data["xty"]), data["ridge"])
+        regression.xtx = np.asarray(data["xtx"], dtype=np.float64)
+        regression.xty = np.asarray(data["xty"], dtype=np.float64)
+        regression.samples = data["samples"]
+        return regression
+
+
+@dataclass
+class BuildEstimate:
+    # Estimated seconds of each phase, None until enough builds of the same build type were seen
+    download_time: Optional[float]
+    build_time: Optional[float]
+    upload_time: Optional[float]
+    # Estimated peak memory in bytes, None until enough builds of the same build type were seen
+    peak_memory: Optional[int]
+
+    @property
+    def total_time(self) -> Optional[float]:
+        if None in (self.download_time, self.build_time, self.upload_time):
+            return None
+        return self.download_time + self.build_time + self.upload_time
+
+    def to_dict(self) -> dict:
+        return {
+            "download_time": self.download_time,
+            "build_time": self.build_time,
+            "upload_time": self.upload_time,
+            "total_time": self.total_time,
+            "unit": "seconds",
+            "peak_memory": self.peak_memory,
+            "memory_unit": "bytes"
+        }
+
+
+class BuildEstimator:
+    """
+    Learns the time of the phases of a build and its peak memory from the stats of the completed jobs, with 1
+    online regression per build type and per phase, over the number of vectors and the dimensions of the job.
+    An estimate is only made once min_samples builds of the build type were seen.
+
+    The models are saved to path, when it is set, after every update and loaded when the coordinator starts.
+    """
+
+    def __init__(self, path: str = None, min_samples: int = 5):
+        self.path = path
+        self.min_samples = min_samples
+        self._models: Dict[str, Dict[str, OnlineLinearRegression]] = {}
+        self._lock = threading.Lock()
+        # Orders the writes of the file, so the last write is of the latest models
+        self._save_lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def estimate(self, create_index_request: dict, build_type: str = None) -> BuildEstimate:
+        number_of_vectors, dimensions = _shape(create_index_request)
+        predictions = {}
+        with self._lock:
+            models = self._models.get(build_type or DEFAULT_BUILD_TYPE, {})
+            for target in [DOWNLOAD_PHASE, BUILD_PHASE, UPLOAD_PHASE, MEMORY]:
+                model = models.get(target)
+                predictions[target] = None
+                if model is not None and model.samples >= self.min_samples:
+                    predictions[target] = model.predict(_features(target, number_of_vectors, dimensions))
+        return BuildEstimate(
+            download_time=predictions[DOWNLOAD_PHASE],
+            build_time=predictions[BUILD_PHASE],
+            upload_time=predictions[UPLOAD_PHASE],
+            peak_memory=int(predictions[MEMORY] * MEMORY_SCALE) if predictions[MEMORY] is not None else None
+        )
+
+    def observe(self, create_index_request: dict, build_type: str, stats: dict, save: bool = True):
+        """
+        Learn from the stats of a completed job, the phases which are missing from the stats are skipped. The models
+        are saved unless save is False, when the caller calls save itself, like off its event loop.
+        """
+        number_of_vectors, dimensions = _shape(create_index_request)
+        if number_of_vectors == 0 or not isinstance(stats, dict):
+            return
+        samples = {
+            DOWNLOAD_PHASE: stats.get("download_stats", {}).get("time"),
+            BUILD_PHASE: stats.get("create_index", {}).get("totalTime"),
+            UPLOAD_PHASE: stats.get("upload_stats", {}).get("time"),
+        }
+        # The peak RSS of the worker is tracked for its whole process and shared by the jobs built at the same time,
+        # so the memory is learned from the memory of the job alone
+        job_memory = stats.get("memory_stats", {}).get("job_memory")
+        if job_memory:
+            samples[MEMORY] = job_memory / MEMORY_SCALE
+        with self._lock:
+            models = self._models.setdefault(build_type or DEFAULT_BUILD_TYPE, {})
+            for target, y in samples.items():
+                if y is None:
+                    continue
+                x = _features(target, number_of_vectors, dimensions)
+                models.setdefault(target, OnlineLinearRegression(len(x))).update(x, float(y))
+        if save:
+            self.save()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {build_type: {target: model.samples for target, model in models.items()}
+                    for build_type, models in self._models.items()}
+
+    def save(self):
+        """Save the models to path, when it is set. The file is written without holding the models"""
+        if self.path is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                data = {build_type: {target: model.to_dict() for target, model in models.items()}
+                        for build_type, models in self._models.items()}
+            temp_path = f"{self.path}.tmp"
+            try:
+                with open(temp_path, "w") as f:
+                    json.dump(data, f)
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                logger.error(f"Error saving the build estimator to {self.path}: {e}")
+
+    def _load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        self._models = {build_type: {target: OnlineLinearRegression.from_dict(model) for target, model in models.items()}
+                        for build_type, models in data.items()}
+        logger.info(f"Loaded the build estimator from {self.path}: {self.to_dict()}")
+
+
+def _shape(create_index_request: dict):
+    return int(create_index_request.get("number_of_vectors", 0)), int(create_index_request.get("dimensions", 0))
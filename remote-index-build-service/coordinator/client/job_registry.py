@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ["completed", "failed", "cancelled"]
+
+
+@dataclass
+class JobRecord:
+    job_id: str
+    worker_client: Any
+    status: str
+    request: dict = None
+    result: Any = None
+    error: str = None
+    # Estimated completion time in seconds since the epoch, None when the build time can't be estimated yet
+    estimated_completion: float = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    # Rank of the job in the creation order of the registry, as the creation times of 2 jobs can be equal
+    creation_order: int = field(default=0, repr=False)
+
+    def is_terminal(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def to_status(self) -> dict:
+        """The job in the format of the /job API of the workers"""
+        return {"status": self.status, "result": self.result, "error": self.error,
+                "estimated_completion": self.estimated_completion}
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.job_id,
+            "status": self.status,
+            "error": self.error,
+            "result": self.result,
+            "request": self.request,
+            "worker": {"workerURL": self.worker_client.worker.host, "workerPort": self.worker_client.worker.port},
+            "estimated_completion": self.estimated_completion,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+
+class JobRegistry:
+    """
+    Keeps the job id to worker mapping of the jobs dispatched by the coordinator along with their last known
+    status, so the status of a job is served without asking the workers. The status of the jobs which are not
+    finished is refreshed in the background by the coordinator.
+
+    The jobs are kept in least recently updated order, the finished jobs are evicted once there are more than
+    max_jobs jobs. The jobs are also indexed in creation order, overall and by status, so a page of the jobs is a
+    slice of an index rather than a sort of all the jobs. on_job_completed is called with the job when a job is updated to completed, like to learn from
+    its stats.
+    """
+
+    def __init__(self, max_jobs: int = 10000, on_job_completed: Callable[[JobRecord], None] = None):
+        self.max_jobs = max_jobs
+        self.on_job_completed = on_job_completed
+        self._jobs: "OrderedDict[str, JobRecord]" = OrderedDict()
+        # (creation order, job id) of the jobs sorted in creation order, of all the jobs and of the jobs of each status
+        self._created: List[Tuple[int, str]] = []
+        self._created_by_status: Dict[str, List[Tuple[int, str]]] = {}
+        self._next_creation_order = 0
+        self._lock = threading.Lock()
+
+    def record(self, job_id: str, worker_client, status: str, request: dict = None, result=None, error: str = None):
+        with self._lock:
+            self._add(JobRecord(job_id=job_id, worker_client=worker_client, status=status, request=request,
+                                result=result, error=error))
+            self._evict()
+
+    def record_dispatched(self, job_id: str, worker_client, status: str, request: dict,
+                          estimated_completion: float = None):
+        """
+        Record a job dispatched to a worker. The worker can push a status of the job before the coordinator gets
+        the response of the dispatch, in which case the pushed status is kept.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.request, job.estimated_completion = request, estimated_completion
+                completed = job.status == "completed"
+            else:
+                self._add(JobRecord(job_id=job_id, worker_client=worker_client, status=status, request=request,
+                                    estimated_completion=estimated_completion))
+                completed = False
+                self._evict()
+        # The job completed before its dispatch was recorded, it could only be learned from now that its request is known
+        if completed:
+            self._job_completed(job)
+            self._evict()
+
+    def update(self, job_id: str, status: str, result=None, error: str = None) -> bool:
+        """Update the status of a job, returns False when the job is not in the registry"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return False
+            completed = status == "completed" and job.status != "completed"
+            if job.status != status or job.result != result or job.error != error:
+                if job.status != status:
+                    self._remove_from_status_index(job)
+                    insort(self._created_by_status.setdefault(status, []), (job.creation_order, job_id))
+                job.status, job.result, job.error = status, result, error
+                job.updated_at = time.time()
+                self._jobs.move_to_end(job_id)
+                self._evict()
+        if completed:
+            self._job_completed(job)
+        return True
+
+    def _job_completed(self, job: JobRecord):
+        if self.on_job_completed is None or job.request is None:
+            return
+        try:
+            self.on_job_completed(job)
+        except Exception as e:
+            logger.error(f"Error handling the completion of job {job.job_id}: {e}")
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_pending_jobs(self) -> List[JobRecord]:
+        """Returns the jobs which are not finished, whose status should be refreshed"""
+        with self._lock:
+            return [job for job in self._jobs.values() if not job.is_terminal()]
+
+    def query(self, status: str = None, offset: int = 0, limit: int = 100) -> Tuple[List[JobRecord], int]:
+        """Returns a page of the jobs, newest first, optionally filtered by status, along with the number of matching jobs"""
+        with self._lock:
+            created = self._created if status is None else self._created_by_status.get(status, [])
+            end = max(len(created) - offset, 0)
+            return [self._jobs[job_id] for _, job_id in reversed(created[max(end - limit, 0):end])], len(created)
+
+    def remove_worker(self, worker_client):
+        """Fail the unfinished jobs of a worker which is removed, as their status can't be refreshed anymore"""
+        for job in self.get_pending_jobs():
+            if job.worker_client is worker_client:
+                self.update(job.job_id, "failed", error=f"Worker {worker_client.worker.host} was removed")
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def _evict(self):
+        # The jobs are in least recently updated order, so the oldest finished jobs are evicted first
+        excess = len(self._jobs) - self.max_jobs
+        if excess <= 0:
+            return
+        evicted_ids = [job_id for job_id, job in self._jobs.items() if job.is_terminal()][:excess]
+        for job_id in evicted_ids:
+            self._remove(self._jobs[job_id])
+
+    def _add(self, job: JobRecord):
+        # A job recorded again replaces its record, as a new job
+        if job.job_id in self._jobs:
+            self._remove(self._jobs[job.job_id])
+        job.creation_order = self._next_creation_order
+        self._next_creation_order += 1
+        self._jobs[job.job_id] = job
+        # The new job is the last one created
+        self._created.append((job.creation_order, job.job_id))
+        self._created_by_status.setdefault(job.status, []).append((job.creation_order, job.job_id))
+
+    def _remove(self, job: JobRecord):
+        del self._jobs[job.job_id]
+        created = self._created
+        del created[bisect_left(created, (job.creation_order, job.job_id))]
+        self._remove_from_status_index(job)
+
+    def _remove_from_status_index(self, job: JobRecord):
+        created = self._created_by_status[job.status]
+        del created[bisect_left(created, (job.creation_order, job.job_id))]
+        if not created:
+            del self._created_by_status[job.status]
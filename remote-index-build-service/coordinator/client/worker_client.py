@@ -1,24 +1,56 @@
 import concurrent.futures
 import logging
+import os
+import threading
+import time
 from dataclasses import dataclass
 
 from urllib3 import HTTPConnectionPool
 import json
 
-from util.common import ThreadSafeRoundRobinIterator
+from client.build_estimator import BuildEstimator
+from client.batch_jobs import BatchJob, BatchJobRegistry, Shard, split_in_shards
+from client.job_registry import JobRegistry
+from client.worker_membership import WorkerMembership
+from client.worker_scheduler import WorkerLoad, WorkerScheduler, build_scheduling_policy, get_build_type
 
 logger = logging.getLogger(__name__)
 
+# Policy used to pick the worker of a create index request: least-outstanding, bin-packing, power-of-two or round-robin
+scheduling_policy = os.getenv('WORKER_SCHEDULING_POLICY', 'least-outstanding').lower()
+# Number of jobs kept in the job registry, and how often the status of the unfinished jobs is refreshed
+job_registry_max_jobs = int(os.getenv('JOB_REGISTRY_MAX_JOBS', 10000))
+job_status_refresh_interval = float(os.getenv('JOB_STATUS_REFRESH_INTERVAL_SECONDS', 2))
+# Number of threads sending the requests to the workers, for the job status refresh and the job lookups
+worker_request_threads = int(os.getenv('WORKER_REQUEST_THREADS', 16))
+# File where the build estimator is saved, the estimator is only kept in memory when it is not set
+build_estimator_path = os.getenv('BUILD_ESTIMATOR_PATH')
+# Number of completed builds of a build type after which their time and memory are estimated
+build_estimator_min_samples = int(os.getenv('BUILD_ESTIMATOR_MIN_SAMPLES', 5))
+# Reject the jobs which fit in the memory budget of no worker, instead of placing them anyway
+admission_control = int(os.getenv('ADMISSION_CONTROL', 0)) == 1
+
 @dataclass
 class Worker:
     host:str
     port: int
 
+def get_worker_from_seed_file(seed_file):
+    with open(seed_file, 'r') as f:
+        data = json.load(f)
+        workers = []
+        for worker in data:
+            workers.append(Worker(worker['host'], worker['port']))
+        logging.info(f"Workers are: {workers}")
+        return workers
+
 @dataclass
 class RegisterWorkerRequest:
     workerURL: str
     workerPort: int
     workerProtocol: str = 'http'
+    # Resources and load the worker advertises, like its cpu count, memory budget and build type
+    capabilities: dict = None
 
     @staticmethod
     def build_register_worker_request(data: dict) -> list['RegisterWorkerRequest']:
@@ -34,20 +66,95 @@ class RegisterWorkerRequest:
             register_worker_request_list.append(RegisterWorkerRequest(
                 workerURL=worker['workerURL'],
                 workerPort=worker['workerPort'],
-                workerProtocol=worker.get('workerProtocol', 'http')
+                workerProtocol=worker.get('workerProtocol', 'http'),
+                capabilities=worker.get('capabilities')
             ))
         return register_worker_request_list
 
+class UnknownWorkerError(LookupError):
+    """A worker which is not registered pushed the status of a job, it should register again and push it again"""
+
+# Fields of the job status pushed by the workers
+JOB_STATUS_FIELDS = ["job_id", "status", "workerURL", "workerPort"]
+
+def validate_job_status(job_status) -> dict:
+    if not isinstance(job_status, dict) or not all(key in job_status for key in JOB_STATUS_FIELDS):
+        raise ValueError(f"The job status should have the fields {JOB_STATUS_FIELDS}: {job_status}")
+    return job_status
+
+def update_capabilities(scheduler: WorkerScheduler, worker_client, capabilities: dict):
+    worker_client.capabilities = capabilities
+    if "memory_budget" in capabilities:
+        scheduler.update_capacity(worker_client, capabilities["memory_budget"])
+
+def apply_job_status(job_registry: JobRegistry, scheduler: WorkerScheduler, worker_client, job_status: dict):
+    """Apply the status of a job pushed by a worker, which can come before the response of the dispatch of the job"""
+    job_id, status = job_status["job_id"], job_status["status"]
+    if not job_registry.update(job_id, status, job_status.get("result"), job_status.get("error")):
+        job_registry.record(job_id, worker_client, status, result=job_status.get("result"), error=job_status.get("error"))
+    scheduler.update_job_status(job_id, status)
+
+def record_dispatched_job(job_registry: JobRegistry, scheduler: WorkerScheduler, membership: WorkerMembership,
+                          worker_client, response: dict, createIndexRequest: dict):
+    """Record a job accepted by a worker, once its reservation is confirmed, and add its estimated completion to the response"""
+    job_id = response["job_id"]
+    response["estimated_completion"] = scheduler.get_estimated_completion(job_id)
+    job_registry.record_dispatched(job_id, worker_client, response["status"], createIndexRequest,
+                                   response["estimated_completion"])
+    if not membership.contains(worker_client):
+        # The worker was removed while the job was dispatched, after its jobs were failed
+        job_registry.update(job_id, "failed", error=f"Worker {worker_client.worker.host} was removed")
+    # The worker could have pushed that the job finished before it was confirmed
+    job = job_registry.get(job_id)
+    if job is not None:
+        scheduler.update_job_status(job_id, job.status)
+
+def apply_cancelled_job(job_registry: JobRegistry, scheduler: WorkerScheduler, job, http_status: int,
+                        job_status: dict):
+    """
+    Apply the response of a worker to the cancellation of a job. The worker answers with the status of the job, which
+    is still running when the job stops at its next cancellation check, or is already finished.
+    """
+    if http_status in (200, 202, 409):
+        job_registry.update(job.job_id, job_status.get("status"), job_status.get("result"), job_status.get("error"))
+        scheduler.update_job_status(job.job_id, job_status.get("status"))
+    elif http_status == 404:
+        # The worker restarted and lost the job, there is nothing left to cancel
+        job_registry.update(job.job_id, "cancelled", error=f"Job not found on {job.worker_client}")
+        scheduler.job_finished(job.job_id)
+    else:
+        raise Exception(f"Error cancelling the job {job.job_id} on {job.worker_client} : HTTP {http_status}")
+
+def build_estimator() -> BuildEstimator:
+    return BuildEstimator(build_estimator_path, build_estimator_min_samples)
+
+def learn_from_job(estimator: BuildEstimator, job, save: bool = True):
+    """Learn the time and the memory of a build from the stats of a completed job, see BuildEstimator.observe"""
+    if isinstance(job.result, dict):
+        estimator.observe(job.request, get_build_type(job.worker_client), job.result.get("stats"), save)
+
 class WorkerClient:
 
     def __init__(self, worker):
         self.logger = logging.getLogger(__name__)
         self.client_pool = HTTPConnectionPool(host=worker.host, port=worker.port, maxsize=10, timeout=1)
         self.worker = worker
+        self.load = WorkerLoad()
+        self.capabilities = {}
+
+    @property
+    def pushes_job_status(self) -> bool:
+        """Whether the worker pushes the status changes of its jobs, so they don't have to be polled"""
+        return self.capabilities.get("push_job_status", False)
 
     def get_job(self, job_id: str):
         return self.client_pool.request("GET", f"/job/{job_id}", headers={'Content-Type': 'application/json'})
 
+    def cancel_job(self, job_id: str):
+        """Returns the HTTP status and the job, which is None when the worker doesn't know the job"""
+        response = self.client_pool.request("DELETE", f"/job/{job_id}", headers={'Content-Type': 'application/json'})
+        return response.status, response.json() if response.status in (200, 202, 409) else None
+
     def create_index(self, createIndexRequest):
         self.logger.info(f"createIndexRequest is : {createIndexRequest}")
         response = self.client_pool.request("POST", "/create_index", body=json.dumps(createIndexRequest), headers={'Content-Type': 'application/json'})
@@ -55,19 +162,28 @@ class WorkerClient:
             return response.json()
         return None
 
-    def get_jobs(self):
-        jobs = self.client_pool.request("GET", "/jobs", headers={'Content-Type': 'application/json'})
+    def get_jobs(self, status: str = None, offset: int = 0, limit: int = 100):
+        fields = {"offset": offset, "limit": limit}
+        if status is not None:
+            fields["status"] = status
+        jobs = self.client_pool.request("GET", "/jobs", fields=fields, headers={'Content-Type': 'application/json'})
         jobs = jobs.json()
         self.logger.info(f"Jobs are : {jobs}")
         return jobs
 
+    def get_scheduler_stats(self):
+        """Returns the state of the job scheduler of the worker, like its memory budget, without any job"""
+        return self.get_jobs(limit=0)
+
     def heart_beat(self):
+        """Returns the heart beat of the worker, with the capabilities it advertises, or None when it is down"""
         try:
             response = self.client_pool.request(method="GET", url="/heart_beat", headers={'Content-Type': 'application/json'})
-            return response.status == 200
+            if response.status == 200:
+                return response.json()
         except Exception as e:
             self.logger.error(f"Error in heart_beat for {self.worker.host}:{self.worker.port} : {e}")
-        return False
+        return None
 
     def __str__(self):
         return f"WorkerClient(host={self.worker.host}, port={self.worker.port})"
@@ -79,71 +195,218 @@ class WorkerClient:
 class WorkerService:
 
     def __init__(self, workers: list):
-        self.round_robin_iterator = None
         self.logger = logging.getLogger(__name__)
         self.workers = workers
-        self._build_worker_client()
-
-    def _build_worker_client(self):
-        self.worker_clients: list[WorkerClient] = []
-        for worker in self.workers:
-            self.worker_clients.append(WorkerClient(worker))
-        if len(self.worker_clients) == 0:
-            self.round_robin_iterator = None
-        else:
-            self.round_robin_iterator = ThreadSafeRoundRobinIterator(self.worker_clients)
+        self.membership = WorkerMembership([WorkerClient(worker) for worker in workers])
+        self.estimator = build_estimator()
+        self.scheduler = WorkerScheduler(build_scheduling_policy(scheduling_policy), self.estimator, admission_control)
+        self.job_registry = JobRegistry(max_jobs=job_registry_max_jobs,
+                                        on_job_completed=lambda job: learn_from_job(self.estimator, job))
+        self.batch_job_registry = BatchJobRegistry(max_jobs=job_registry_max_jobs)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=worker_request_threads)
+        threading.Thread(target=self._refresh_job_statuses_forever, name="job-status-refresh", daemon=True).start()
 
+    @property
+    def worker_clients(self) -> tuple:
+        """The current snapshot of the clients of the workers, which is never modified"""
+        return self.membership.snapshot()
 
     def get_job(self, job_id: str):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.worker_clients)) as executor:
-            futures = []
-            for worker_client in self.worker_clients:
-                future = executor.submit(worker_client.get_job, job_id)
-                future.add_done_callback(lambda x: x.result().release_conn())
-                futures.append(future)
-
-            for future in futures:
+        if BatchJobRegistry.is_batch_id(job_id):
+            batch_job = self.batch_job_registry.get(job_id)
+            if batch_job is None:
+                raise Exception(f"Error in get_job for job_id {job_id}")
+            return batch_job.to_status(self.job_registry)
+        job = self.job_registry.get(job_id)
+        if job is not None:
+            return job.to_status()
+        # The job was not dispatched by this coordinator, or it was evicted from the registry
+        return self._find_job(job_id)
+
+    def _find_job(self, job_id: str):
+        futures = []
+        # The workers which push the status of their jobs are asked too, their pushes could have been rejected while
+        # they were not registered, or lost with the registry when the coordinator restarted
+        for worker_client in self.worker_clients:
+            future = self._executor.submit(worker_client.get_job, job_id)
+            future.add_done_callback(lambda x: x.exception() is None and x.result().release_conn())
+            futures.append((worker_client, future))
+
+        for worker_client, future in futures:
+            try:
+                response = future.result()
+            except Exception as e:
+                self.logger.info(f"Error getting the job {job_id} from {worker_client} : {e}")
+                continue
+            if response.status == 200:
+                job = response.json()
+                self.job_registry.record(job_id, worker_client, job.get("status"), result=job.get("result"),
+                                         error=job.get("error"))
+                self.scheduler.update_job_status(job_id, job.get("status"))
+                return job
+            else:
+                self.logger.info(f"No job found for the {job_id} : {response.status} {response.reason}")
+        raise Exception(f"Error in get_job for job_id {job_id}")
+
+    def cancel_job(self, job_id: str):
+        """
+        Cancel a job on the worker running it and returns its status, or cancel all the shards of a batch job. A job
+        which is already finished is left as is. Raises LookupError when the job is unknown.
+        """
+        if BatchJobRegistry.is_batch_id(job_id):
+            batch_job = self.batch_job_registry.get(job_id)
+            if batch_job is None:
+                raise LookupError(f"Job {job_id} not found")
+            futures = [(shard, self._executor.submit(self._cancel_registered_job, shard.job_id))
+                       for shard in batch_job.shards if shard.job_id is not None]
+            for shard, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(f"Error cancelling shard {shard.shard} of {job_id} : {e}")
+            return batch_job.to_status(self.job_registry)
+        if self.job_registry.get(job_id) is None:
+            try:
+                self._find_job(job_id)
+            except Exception:
+                raise LookupError(f"Job {job_id} not found")
+        return self._cancel_registered_job(job_id)
+
+    def _cancel_registered_job(self, job_id: str):
+        job = self.job_registry.get(job_id)
+        if job is None:
+            raise LookupError(f"Job {job_id} not found")
+        if not job.is_terminal():
+            http_status, job_status = job.worker_client.cancel_job(job_id)
+            apply_cancelled_job(self.job_registry, self.scheduler, job, http_status, job_status)
+        return job.to_status()
+
+    def refresh_job_statuses(self):
+        """
+        Refresh the status of the unfinished jobs from the workers running them, with 1 request per job. Only the
+        jobs of the workers which don't push the status of their jobs are refreshed.
+        """
+        pending_jobs = [job for job in self.job_registry.get_pending_jobs() if not job.worker_client.pushes_job_status]
+        futures = [(job, self._executor.submit(job.worker_client.get_job, job.job_id)) for job in pending_jobs]
+        for job, future in futures:
+            try:
                 response = future.result()
                 if response.status == 200:
-                    return response.json()
-                else:
-                    self.logger.info(f"No job found for the {job_id} : {response.status} {response.reason}")
-            raise Exception(f"Error in get_job for job_id {job_id}")
+                    status = response.json()
+                    self.job_registry.update(job.job_id, status.get("status"), status.get("result"), status.get("error"))
+                    self.scheduler.update_job_status(job.job_id, status.get("status"))
+                elif response.status == 404:
+                    # The worker restarted and lost the job
+                    self.job_registry.update(job.job_id, "failed", error=f"Job not found on {job.worker_client}")
+                    self.scheduler.job_finished(job.job_id)
+                response.release_conn()
+            except Exception as e:
+                self.logger.debug(f"Error refreshing the status of job {job.job_id} : {e}")
+
+    def _refresh_job_statuses_forever(self):
+        while True:
+            try:
+                self.refresh_job_statuses()
+            except Exception as e:
+                self.logger.error(f"Error in the job status refresh: {e}")
+            time.sleep(job_status_refresh_interval)
 
 
     def create_index(self, createIndexRequest):
-        worker_client = self.round_robin_iterator.get_next()
-        self.logger.debug("in create_index call")
-        response = worker_client.create_index(createIndexRequest)
+        worker_client, reservation_id = self.scheduler.reserve(self.worker_clients, createIndexRequest)
+        self.logger.debug(f"in create_index call, placing the request on {worker_client}")
+        try:
+            response = worker_client.create_index(createIndexRequest)
+        except Exception:
+            self.scheduler.cancel(reservation_id)
+            raise
+        if response is None:
+            self.scheduler.cancel(reservation_id)
+        else:
+            self.scheduler.confirm(reservation_id, response["job_id"])
+            record_dispatched_job(self.job_registry, self.scheduler, self.membership, worker_client, response,
+                                  createIndexRequest)
         self.logger.info(f"response is : {response}")
         return response
 
-    def get_jobs(self):
-        jobs = {}
-        logging.info("in get_jobs call")
-        for worker_client in self.worker_clients:
-            client_jobs = worker_client.get_jobs()
-            for job in client_jobs:
-                jobs[job] = client_jobs[job]
-        self.logger.info(f"jobs are : {jobs}")
-        return jobs
+    def create_index_batch(self, createIndexRequest: dict, number_of_shards: int):
+        """
+        Split the request in number_of_shards shards over ranges of the vectors and place each shard on a worker
+        like a create index request. Returns the batch job, whose status is the status of all its shards.
+        """
+        batch_job = BatchJob(batch_id=BatchJobRegistry.new_batch_id(), request=createIndexRequest,
+                             shards=[Shard(shard, request) for shard, request in
+                                     enumerate(split_in_shards(createIndexRequest, number_of_shards))])
+        futures = [(shard, self._executor.submit(self.create_index, shard.request)) for shard in batch_job.shards]
+        for shard, future in futures:
+            try:
+                response = future.result()
+                if response is None:
+                    shard.error = "The worker rejected the shard"
+                else:
+                    shard.job_id = response["job_id"]
+            except Exception as e:
+                self.logger.error(f"Error dispatching shard {shard.shard} of {batch_job.batch_id} : {e}")
+                shard.error = str(e)
+        self.batch_job_registry.add(batch_job)
+        return {"job_id": batch_job.batch_id, **batch_job.to_status(self.job_registry)}
+
+    def refresh_worker_load(self, worker_client: WorkerClient, capabilities: dict = None):
+        """Refresh the capabilities of the worker, and its capacity from the memory budget it reports"""
+        if capabilities is not None:
+            update_capabilities(self.scheduler, worker_client, capabilities)
+            return
+        # The worker doesn't advertise its capabilities in its heart beat, but reports its memory budget in /jobs
+        stats = worker_client.get_scheduler_stats()
+        if "memory_budget" in stats:
+            self.scheduler.update_capacity(worker_client, stats["memory_budget"])
+
+    def update_job_status(self, job_status: dict):
+        """
+        Apply a status change pushed by the worker running the job. Raises ValueError when the status is invalid,
+        and UnknownWorkerError when the worker is not registered, like after the coordinator restarted.
+        """
+        validate_job_status(job_status)
+        worker_client = self.membership.find(job_status["workerURL"], job_status["workerPort"])
+        if worker_client is None:
+            raise UnknownWorkerError(f"Unknown worker {job_status['workerURL']}:{job_status['workerPort']}")
+        apply_job_status(self.job_registry, self.scheduler, worker_client, job_status)
+
+    def remove_worker(self, worker_client: WorkerClient):
+        if self.membership.remove(worker_client):
+            self.logger.info(f"Removed worker {worker_client.worker.host}:{worker_client.worker.port}")
+        self.scheduler.remove_worker(worker_client)
+        self.job_registry.remove_worker(worker_client)
+
+    def get_jobs(self, status: str = None, offset: int = 0, limit: int = 100):
+        """Returns a page of the jobs dispatched by the coordinator, newest first, from the job registry"""
+        jobs, total = self.job_registry.query(status=status, offset=offset, limit=limit)
+        self.logger.debug(f"jobs are : {jobs}")
+        return {
+            "jobs": {job.job_id: job.to_dict() for job in jobs},
+            "total": total,
+            "offset": offset,
+            "limit": limit
+        }
 
     def register_worker(self, register_worker_request_list: list[RegisterWorkerRequest]):
         self.logger.info(f"register_worker_request is : {register_worker_request_list}")
         for register_worker_request in register_worker_request_list:
             worker = Worker(register_worker_request.workerURL, register_worker_request.workerPort)
-            self.worker_clients.append(WorkerClient(worker))
-            if self.round_robin_iterator is None:
-                self.round_robin_iterator = ThreadSafeRoundRobinIterator(self.worker_clients)
-            else:
-                self.round_robin_iterator.add_item(WorkerClient(worker))
+            worker_client, added = self.membership.add(worker.host, worker.port, lambda: WorkerClient(worker))
+            if not added:
+                self.logger.info(f"Worker {worker.host}:{worker.port} is already registered")
+            if register_worker_request.capabilities is not None:
+                update_capabilities(self.scheduler, worker_client, register_worker_request.capabilities)
 
     def get_all_worker(self):
         worker_list = []
         for worker in self.worker_clients:
             w = {
                 "workerURL": worker.worker.host,
-                "workerPort": worker.worker.port
+                "workerPort": worker.worker.port,
+                "load": worker.load.to_dict(),
+                "capabilities": worker.capabilities
             }
             worker_list.append(w)
         return worker_list
\ No newline at end of file
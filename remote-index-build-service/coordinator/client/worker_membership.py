@@ -0,0 +1,62 @@
+import threading
+from typing import Callable, Dict, Tuple
+
+
+class WorkerMembership:
+    """
+    The table of the workers of the coordinator, with exactly 1 client, and so 1 connection pool, per worker.
+
+    The table is copy-on-write: a register or a removal builds a new immutable snapshot of the table under a lock and
+    swaps it in, while the readers, like the dispatch of the jobs or the heart beat, read the current snapshot without
+    any lock. A snapshot never changes once it is read, so iterating over it while workers come and go is safe.
+    """
+
+    def __init__(self, worker_clients: list = None):
+        self._lock = threading.Lock()
+        worker_clients = tuple(worker_clients or [])
+        # The clients in registration order and the clients by address, swapped together
+        self._state: Tuple[Tuple, Dict[Tuple[str, int], object]] = (
+            worker_clients, {_address(worker_client): worker_client for worker_client in worker_clients}
+        )
+
+    def snapshot(self) -> Tuple:
+        return self._state[0]
+
+    def find(self, host: str, port: int):
+        return self._state[1].get((host, int(port)))
+
+    def contains(self, worker_client) -> bool:
+        return self._state[1].get(_address(worker_client)) is worker_client
+
+    def add(self, host: str, port: int, build_worker_client: Callable[[], object]) -> Tuple[object, bool]:
+        """
+        Returns the client of the worker and whether it was added. The client is only built when the worker is not
+        in the table yet, so a worker which registers again keeps its client and its load.
+        """
+        address = (host, int(port))
+        with self._lock:
+            worker_clients, by_address = self._state
+            worker_client = by_address.get(address)
+            if worker_client is not None:
+                return worker_client, False
+            worker_client = build_worker_client()
+            self._state = (worker_clients + (worker_client,), {**by_address, address: worker_client})
+            return worker_client, True
+
+    def remove(self, worker_client) -> bool:
+        """Returns whether the client was removed, which is False when it was already removed"""
+        with self._lock:
+            worker_clients, by_address = self._state
+            if by_address.get(_address(worker_client)) is not worker_client:
+                return False
+            by_address = dict(by_address)
+            del by_address[_address(worker_client)]
+            self._state = (tuple(w for w in worker_clients if w is not worker_client), by_address)
+            return True
+
+    def __len__(self):
+        return len(self._state[0])
+
+
+def _address(worker_client) -> Tuple[str, int]:
+    return worker_client.worker.host, int(worker_client.worker.port)
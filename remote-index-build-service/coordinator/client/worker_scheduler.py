@@ -0,0 +1,268 @@
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from client.build_estimator import BuildEstimator, DEFAULT_BUILD_TYPE
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ["completed", "failed", "cancelled"]
+
+
+class AdmissionRejected(Exception):
+    """The job doesn't fit in the memory budget of any worker"""
+
+
+def estimate_work(create_index_request: dict, memory_model: Optional[dict]) -> int:
+    """
+    Estimate the work of a create index request, as the peak memory in bytes the worker needs to build it. The
+    memory model is the one the worker advertises in its capabilities, the estimate of its job scheduler, the work is
+    0 when the worker didn't advertise it yet.
+    """
+    if not memory_model:
+        return 0
+    number_of_vectors = int(create_index_request.get('number_of_vectors', 0))
+    dimensions = int(create_index_request.get('dimensions', 0))
+    element_size = memory_model["vector_element_sizes"].get(create_index_request.get('vector_data_type') or 'float32', 4)
+    graph_size_per_vector = memory_model["graph_bytes_per_neighbour"] * _get_hnsw_m(create_index_request, memory_model) + \
+        memory_model["graph_overhead_per_vector"]
+    return number_of_vectors * (int(dimensions * element_size) + memory_model["id_size"] + graph_size_per_vector)
+
+
+def _get_hnsw_m(create_index_request: dict, memory_model: dict) -> int:
+    index_parameters = create_index_request.get('index_parameters') or {}
+    factory_string = index_parameters.get('factory_string')
+    if factory_string:
+        m = re.match(r"HNSW(\d*)", str(factory_string))
+        return int(m.group(1)) if m is not None and m.group(1) else memory_model["default_factory_hnsw_m"]
+    return int(index_parameters.get('m') or memory_model["default_hnsw_m"])
+
+
+@dataclass
+class WorkerLoad:
+    # Estimated memory of the jobs dispatched to the worker which didn't finish yet
+    outstanding_jobs: Dict[str, int] = field(default_factory=dict)
+    # Memory budget the worker reports for its jobs. None until it is reported
+    capacity: Optional[int] = None
+    # Estimated completion time of the outstanding jobs, for the jobs whose build time can be estimated
+    estimated_completions: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def remaining_work(self) -> int:
+        return sum(self.outstanding_jobs.values())
+
+    def can_fit(self, work: int) -> bool:
+        """Whether the worker can run a job of this size at all, even if it has to wait for other jobs first"""
+        return self.capacity is None or work <= self.capacity
+
+    def fits_now(self, work: int) -> bool:
+        """Whether the job fits in the memory the outstanding jobs of the worker leave free"""
+        return self.capacity is None or work <= self.free_capacity()
+
+    def free_capacity(self) -> Optional[int]:
+        return self.capacity - self.remaining_work if self.capacity is not None else None
+
+    def to_dict(self) -> dict:
+        return {
+            "outstanding_jobs": len(self.outstanding_jobs),
+            "remaining_work": self.remaining_work,
+            "capacity": self.capacity
+        }
+
+
+class SchedulingPolicy(ABC):
+    """Picks the worker a job is sent to, among the live workers which can fit the job"""
+
+    @abstractmethod
+    def choose(self, worker_clients: list, work: int):
+        pass
+
+
+class LeastOutstandingPolicy(SchedulingPolicy):
+    """Sends the job to the worker with the fewest outstanding jobs, and then with the least remaining work"""
+
+    def choose(self, worker_clients: list, work: int):
+        return min(worker_clients, key=lambda w: (len(w.load.outstanding_jobs), w.load.remaining_work))
+
+
+class BinPackingPolicy(SchedulingPolicy):
+    """
+    Sends the job to the worker with the least free capacity left which still fits the job, so that big jobs
+    find workers with enough free capacity. When no worker has enough free capacity the job is sent to the worker
+    with the least remaining work.
+    """
+
+    def choose(self, worker_clients: list, work: int):
+        fitting = [w for w in worker_clients if w.load.free_capacity() is not None and w.load.free_capacity() >= work]
+        if len(fitting) > 0:
+            return min(fitting, key=lambda w: w.load.free_capacity() - work)
+        return min(worker_clients, key=lambda w: w.load.remaining_work)
+
+
+class PowerOfTwoChoicesPolicy(SchedulingPolicy):
+    """Sends the job to the least loaded of 2 random workers, which avoids herding jobs on a single worker"""
+
+    def choose(self, worker_clients: list, work: int):
+        choices = random.sample(worker_clients, min(2, len(worker_clients)))
+        return min(choices, key=lambda w: (w.load.remaining_work, len(w.load.outstanding_jobs)))
+
+
+class RoundRobinPolicy(SchedulingPolicy):
+    """Sends the jobs to the workers in turn, whatever their load"""
+
+    def __init__(self):
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self, worker_clients: list, work: int):
+        with self._lock:
+            worker_client = worker_clients[self._next % len(worker_clients)]
+            self._next += 1
+            return worker_client
+
+
+SCHEDULING_POLICIES = {
+    "least-outstanding": LeastOutstandingPolicy,
+    "bin-packing": BinPackingPolicy,
+    "power-of-two": PowerOfTwoChoicesPolicy,
+    "round-robin": RoundRobinPolicy
+}
+
+
+def build_scheduling_policy(name: str) -> SchedulingPolicy:
+    if name not in SCHEDULING_POLICIES:
+        raise NotImplementedError(f"Unknown scheduling policy {name}, valid values are {list(SCHEDULING_POLICIES)}")
+    return SCHEDULING_POLICIES[name]()
+
+
+def get_build_type(worker_client) -> str:
+    """The build type the worker advertises, the workers which don't advertise it are cpu workers"""
+    return getattr(worker_client, "capabilities", {}).get("build_type", DEFAULT_BUILD_TYPE)
+
+
+def get_memory_model(worker_client) -> Optional[dict]:
+    """The model of the memory of the jobs the worker advertises, see estimate_work"""
+    return getattr(worker_client, "capabilities", {}).get("memory_model")
+
+
+class WorkerScheduler:
+    """
+    Places the create index requests on the workers based on their load. The load of a worker is the estimated
+    work of the jobs dispatched to it which didn't finish yet, along with the capacity it reports.
+
+    The work of a job is its estimated memory, the larger of the static estimate of the memory model the worker
+    advertises and of the peak memory the build estimator learned for the build type of the worker. A job is placed on the workers with enough free memory for
+    it when there are some, and otherwise on the workers whose memory budget fits it, where it waits for other jobs
+    first. With admission control a job which fits in the memory budget of no worker is rejected.
+    A job is reserved on the chosen worker before it is dispatched, so concurrent requests see each other, and the
+    reservation is confirmed with the job id returned by the worker, or cancelled when the dispatch fails. The
+    job is removed from the load of the worker once it is seen in a terminal state.
+    """
+
+    def __init__(self, policy: SchedulingPolicy, estimator: BuildEstimator = None, admission_control: bool = False):
+        self.policy = policy
+        self.estimator = estimator
+        self.admission_control = admission_control
+        self._job_workers = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, worker_clients: list, create_index_request: dict):
+        """Returns the worker the request should be sent to and the id of the reservation of its work"""
+        learned_peak_memories = {}
+
+        def work_of(worker_client) -> int:
+            build_type = get_build_type(worker_client)
+            if build_type not in learned_peak_memories:
+                learned_peak_memories[build_type] = self._learned_peak_memory(create_index_request, build_type)
+            work = estimate_work(create_index_request, get_memory_model(worker_client))
+            return max(work, learned_peak_memories[build_type] or 0)
+
+        with self._lock:
+            if len(worker_clients) == 0:
+                raise Exception("No worker is available")
+            candidates = [w for w in worker_clients if w.load.fits_now(work_of(w))]
+            if len(candidates) == 0:
+                candidates = [w for w in worker_clients if w.load.can_fit(work_of(w))]
+            if len(candidates) == 0:
+                work = max(work_of(w) for w in worker_clients)
+                if self.admission_control:
+                    raise AdmissionRejected(f"No worker has the memory for a job of {work} bytes")
+                logger.warning(f"No worker has the memory for a job of {work} bytes, placing it anyway")
+                candidates = worker_clients
+            # The workers can have different build types, the policy compares them with the largest of their estimates
+            worker_client = self.policy.choose(candidates, max(work_of(w) for w in candidates))
+            work = work_of(worker_client)
+            reservation_id = f"reservation-{uuid.uuid4()}"
+            estimated_completion = self._estimate_completion(worker_client, create_index_request, work)
+            worker_client.load.outstanding_jobs[reservation_id] = work
+            if estimated_completion is not None:
+                worker_client.load.estimated_completions[reservation_id] = estimated_completion
+            self._job_workers[reservation_id] = worker_client
+            return worker_client, reservation_id
+
+    def get_estimated_completion(self, job_id: str) -> Optional[float]:
+        """Returns the estimated completion time of an outstanding job, in seconds since the epoch"""
+        with self._lock:
+            worker_client = self._job_workers.get(job_id)
+            return worker_client.load.estimated_completions.get(job_id) if worker_client is not None else None
+
+    def _learned_peak_memory(self, create_index_request: dict, build_type: str) -> Optional[int]:
+        if self.estimator is None:
+            return None
+        return self.estimator.estimate(create_index_request, build_type).peak_memory
+
+    def _estimate_completion(self, worker_client, create_index_request: dict, work: int) -> Optional[float]:
+        if self.estimator is None:
+            return None
+        duration = self.estimator.estimate(create_index_request, get_build_type(worker_client)).total_time
+        if duration is None:
+            return None
+        now = time.time()
+        start = now
+        if not worker_client.load.fits_now(work) and len(worker_client.load.estimated_completions) > 0:
+            # The job waits for the first outstanding job of the worker to finish
+            start = max(min(worker_client.load.estimated_completions.values()), now)
+        return start + duration
+
+    def confirm(self, reservation_id: str, job_id: str):
+        with self._lock:
+            worker_client = self._job_workers.pop(reservation_id, None)
+            # The worker could have been removed while the job was dispatched
+            if worker_client is None:
+                return
+            worker_client.load.outstanding_jobs[job_id] = worker_client.load.outstanding_jobs.pop(reservation_id)
+            if reservation_id in worker_client.load.estimated_completions:
+                worker_client.load.estimated_completions[job_id] = worker_client.load.estimated_completions.pop(reservation_id)
+            self._job_workers[job_id] = worker_client
+
+    def cancel(self, reservation_id: str):
+        self.job_finished(reservation_id)
+
+    def job_finished(self, job_id: str):
+        with self._lock:
+            worker_client = self._job_workers.pop(job_id, None)
+            if worker_client is not None:
+                worker_client.load.outstanding_jobs.pop(job_id, None)
+                worker_client.load.estimated_completions.pop(job_id, None)
+
+    def update_job_status(self, job_id: str, status: str):
+        if status in TERMINAL_STATUSES:
+            self.job_finished(job_id)
+
+    def update_capacity(self, worker_client, memory_budget: int):
+        with self._lock:
+            worker_client.load.capacity = memory_budget
+
+    def remove_worker(self, worker_client):
+        """Forget the jobs of a worker which is removed, as they won't be reported as finished anymore"""
+        with self._lock:
+            for job_id in worker_client.load.outstanding_jobs:
+                self._job_workers.pop(job_id, None)
+            worker_client.load.outstanding_jobs.clear()
+            worker_client.load.estimated_completions.clear()
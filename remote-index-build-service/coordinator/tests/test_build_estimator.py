@@ -0,0 +1,70 @@
+import asyncio
+import threading
+
+import client.worker_client as worker_client_module
+from client.async_worker_client import AsyncWorkerService
+from client.build_estimator import BuildEstimator
+from client.worker_client import Worker, WorkerClient
+
+NUMBER_OF_VECTORS = 100000
+DIMENSIONS = 128
+
+
+def create_index_request(number_of_vectors: int = NUMBER_OF_VECTORS) -> dict:
+    return {"number_of_vectors": number_of_vectors, "dimensions": DIMENSIONS}
+
+
+def stats(number_of_vectors: int, job_memory: int, peak_rss_increase: int) -> dict:
+    return {
+        "download_stats": {"time": number_of_vectors / 1e6},
+        "create_index": {"totalTime": number_of_vectors / 1e5},
+        "upload_stats": {"time": number_of_vectors / 1e6},
+        "memory_stats": {"job_memory": job_memory, "peak_rss_increase": peak_rss_increase}
+    }
+
+
+def test_memory_is_learned_from_the_memory_of_the_job():
+    estimator = BuildEstimator(min_samples=3)
+    for number_of_vectors in [10000, 50000, 100000, 200000]:
+        job_memory = number_of_vectors * (DIMENSIONS * 4 + 300)
+        # The other jobs built at the same time raised the peak RSS of the worker
+        estimator.observe(create_index_request(number_of_vectors), "cpu", stats(number_of_vectors, job_memory, 10 * job_memory))
+
+    peak_memory = estimator.estimate(create_index_request(), "cpu").peak_memory
+
+    # The ridge regression is close to, but not exactly, the memory of the jobs
+    job_memory = NUMBER_OF_VECTORS * (DIMENSIONS * 4 + 300)
+    assert abs(peak_memory - job_memory) < 0.1 * job_memory
+
+
+def test_estimator_is_saved_and_loaded(tmp_path):
+    path = str(tmp_path / "estimator.json")
+    estimator = BuildEstimator(path, min_samples=1)
+    estimator.observe(create_index_request(), "cpu", stats(NUMBER_OF_VECTORS, 10 ** 8, 0), save=False)
+    assert not (tmp_path / "estimator.json").exists()
+
+    estimator.save()
+
+    assert BuildEstimator(path, min_samples=1).to_dict() == {"cpu": {"download": 1, "build": 1, "upload": 1, "memory": 1}}
+
+
+def test_async_service_saves_the_estimator_off_the_event_loop(monkeypatch, tmp_path):
+    monkeypatch.setattr(worker_client_module, "build_estimator_path", str(tmp_path / "estimator.json"))
+    service = AsyncWorkerService(workers=[])
+    saved_by = []
+    save = service.estimator.save
+    monkeypatch.setattr(service.estimator, "save", lambda: (saved_by.append(threading.current_thread()), save()))
+    worker_client = WorkerClient(Worker("10.0.0.1", 6005))
+
+    async def complete_job():
+        service.job_registry.record("job-1", worker_client, "running", request=create_index_request())
+        service.job_registry.update("job-1", "completed", result={"stats": stats(NUMBER_OF_VECTORS, 10 ** 8, 0)})
+        for _ in range(100):
+            if saved_by:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(complete_job())
+
+    assert len(saved_by) == 1 and saved_by[0] is not threading.main_thread()
+    assert (tmp_path / "estimator.json").exists()
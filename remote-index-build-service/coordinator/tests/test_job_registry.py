@@ -0,0 +1,40 @@
+from client.job_registry import JobRegistry
+
+
+def job_ids(jobs) -> list:
+    return [job.job_id for job in jobs]
+
+
+def test_jobs_are_paged_newest_first_by_status():
+    registry = JobRegistry()
+    for i in range(10):
+        registry.record(f"job-{i}", worker_client=None, status="running")
+    # The jobs updated later keep their creation order
+    for i in [7, 2, 5]:
+        registry.update(f"job-{i}", "completed")
+    registry.update("job-5", "running")
+
+    jobs, total = registry.query(offset=2, limit=3)
+    assert (job_ids(jobs), total) == (["job-7", "job-6", "job-5"], 10)
+    jobs, total = registry.query(status="completed")
+    assert (job_ids(jobs), total) == (["job-7", "job-2"], 2)
+    jobs, total = registry.query(status="running", offset=6, limit=5)
+    assert (job_ids(jobs), total) == (["job-1", "job-0"], 8)
+    assert registry.query(status="failed") == ([], 0)
+    assert registry.query(offset=20) == ([], 10)
+
+
+def test_evicted_and_recorded_again_jobs_are_paged():
+    registry = JobRegistry(max_jobs=3)
+    for i in range(3):
+        registry.record(f"job-{i}", worker_client=None, status="running")
+    registry.update("job-1", "completed")
+    # The finished job is evicted to make room for the new job
+    registry.record("job-3", worker_client=None, status="running")
+    # A job recorded again is a new job
+    registry.record("job-0", worker_client=None, status="completed")
+
+    jobs, total = registry.query()
+    assert (job_ids(jobs), total) == (["job-0", "job-3", "job-2"], 3)
+    assert job_ids(registry.query(status="running")[0]) == ["job-3", "job-2"]
+    assert job_ids(registry.query(status="completed")[0]) == ["job-0"]
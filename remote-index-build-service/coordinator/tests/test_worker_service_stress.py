@@ -0,0 +1,110 @@
+import concurrent.futures
+import itertools
+import random
+import threading
+import uuid
+
+import pytest
+
+import client.worker_client as worker_client_module
+from client.worker_client import RegisterWorkerRequest, UnknownWorkerError, WorkerService
+
+NUMBER_OF_DISPATCHES = 10000
+DISPATCH_THREADS = 32
+# The workers which stay registered, so that every dispatch finds a worker
+STABLE_WORKERS = 2
+# The addresses of the workers which keep registering and being removed
+CHURNING_WORKERS = 20
+CREATE_INDEX_REQUEST = {"bucket": "bucket", "object_path": "vectors.knnvec", "number_of_vectors": 1000,
+                        "dimensions": 8, "space_type": "l2"}
+
+
+def register(service: WorkerService, port: int):
+    service.register_worker([RegisterWorkerRequest("10.0.0.1", port, capabilities={"push_job_status": True})])
+    return service.membership.find("10.0.0.1", port)
+
+
+@pytest.fixture
+def dispatched(monkeypatch):
+    """Records the jobs the workers receive, instead of sending them over HTTP"""
+    dispatched = {}
+
+    def create_index(worker_client, create_index_request):
+        job_id = f"job-{uuid.uuid4()}"
+        dispatched[job_id] = worker_client
+        return {"job_id": job_id, "status": "running"}
+
+    monkeypatch.setattr(worker_client_module.WorkerClient, "create_index", create_index)
+    return dispatched
+
+
+def test_workers_come_and_go_while_jobs_are_dispatched(dispatched):
+    service = WorkerService(workers=[])
+    service.job_registry.max_jobs = 2 * NUMBER_OF_DISPATCHES
+    for port in range(STABLE_WORKERS):
+        register(service, port)
+    # Orders the dispatches and the removals of the workers
+    clock = itertools.count()
+    removed_at = {}
+    dispatches = []
+    errors = []
+    done = threading.Event()
+
+    def churn():
+        rng = random.Random(0)
+        try:
+            while not done.is_set():
+                port = STABLE_WORKERS + rng.randrange(CHURNING_WORKERS)
+                worker_client = service.membership.find("10.0.0.1", port)
+                if worker_client is None:
+                    register(service, port)
+                else:
+                    service.remove_worker(worker_client)
+                    removed_at[worker_client] = next(clock)
+        except Exception as e:
+            errors.append(e)
+
+    def dispatch():
+        started_at = next(clock)
+        response = service.create_index(dict(CREATE_INDEX_REQUEST))
+        dispatches.append((started_at, response["job_id"]))
+        # The worker pushes that some of the jobs completed, it could have been removed in the meantime
+        if random.random() < 0.5:
+            worker_client = dispatched[response["job_id"]]
+            try:
+                service.update_job_status({"job_id": response["job_id"], "status": "completed", "result": {},
+                                           "workerURL": worker_client.worker.host,
+                                           "workerPort": worker_client.worker.port})
+            except UnknownWorkerError:
+                assert not service.membership.contains(worker_client)
+
+    churner = threading.Thread(target=churn)
+    churner.start()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DISPATCH_THREADS) as executor:
+        futures = [executor.submit(dispatch) for _ in range(NUMBER_OF_DISPATCHES)]
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                errors.append(future.exception())
+    done.set()
+    churner.join()
+
+    assert errors == []
+    # No job is lost: every dispatch reached a worker and is in the job registry, on the worker it was sent to
+    assert len(dispatches) == len(dispatched) == NUMBER_OF_DISPATCHES
+    for started_at, job_id in dispatches:
+        worker_client = dispatched[job_id]
+        # No job is sent to a worker which was removed before its dispatch started
+        assert removed_at.get(worker_client, started_at + 1) > started_at
+        job = service.job_registry.get(job_id)
+        assert job is not None and job.worker_client is worker_client
+        # The jobs of the workers which were removed while they were dispatched are failed, not left running
+        if worker_client in removed_at:
+            assert job.is_terminal()
+    # The load of the workers holds exactly their running jobs, and the removed workers hold none
+    for worker_client in removed_at:
+        if not service.membership.contains(worker_client):
+            assert worker_client.load.outstanding_jobs == {}
+    for worker_client in service.worker_clients:
+        running_jobs = {job_id for job_id, w in dispatched.items()
+                        if w is worker_client and not service.job_registry.get(job_id).is_terminal()}
+        assert set(worker_client.load.outstanding_jobs) == running_jobs
@@ -7,6 +7,9 @@ import json
 import subprocess
 
 from index_builder.indexing_service import IndexingService
+from index_builder.job_status_notifier import JobStatusNotifier
+from index_builder.job_store import TERMINAL_STATUSES
+from index_builder.vector_index_builder import validate_create_index_request
 from models import data_model
 import uuid
 import logging
@@ -52,13 +55,20 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-indexing_service = IndexingService()
-
-
 coordinator_node_url = os.getenv('COORDINATOR_NODE_URL', '')
 coordinator_node_protocol = os.getenv('COORDINATOR_NODE_PROTOCOL', 'http')
 coordinator_node_port = int(os.getenv('COORDINATOR_NODE_PORT', "6006"))
 register_with_coordinator = int(os.getenv('REGISTER_WITH_COORDINATOR', 1))
+# Push the status changes of the jobs to the coordinator the worker registers with, instead of being polled
+push_job_status = int(os.getenv('PUSH_JOB_STATUS', 1))
+
+job_status_notifier = None
+if register_with_coordinator == 1 and push_job_status == 1 and len(coordinator_node_url) > 0:
+    # The coordinator forgets the worker when it restarts, the worker then registers again from the notifier
+    job_status_notifier = JobStatusNotifier(coordinator_node_protocol, coordinator_node_url, coordinator_node_port,
+                                            getIp(), PORT, register_worker=lambda: register_worker())
+
+indexing_service = IndexingService(job_status_listener=job_status_notifier.notify if job_status_notifier else None)
 
 @app.route('/', methods=['GET'])
 def hello():
@@ -71,7 +81,8 @@ def hello():
 def heart_beat():
     return jsonify({
         "message": "Hello from Vector Index Build Service Coordinator!",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now().isoformat(),
+        "capabilities": indexing_service.get_capabilities()
     }), 200
 
 
@@ -81,16 +92,51 @@ def job(job_id: str):
     if job_deatils is None:
         return jsonify({"error": f"Job not found with Id {job_id}"}), 404
     return jsonify({
+        "status": job_deatils.status,
+        "result": job_deatils.result,
+        "error": job_deatils.error,
+        "progress": job_deatils.progress
+    })
+
+
+@app.route('/job/<string:job_id>', methods=['DELETE'])
+def cancel_job(job_id: str):
+    job_deatils = indexing_service.cancel_job(job_id)
+    if job_deatils is None:
+        return jsonify({"error": f"Job not found with Id {job_id}"}), 404
+    response = jsonify({
         "status": job_deatils.status,
         "result": job_deatils.result,
         "error": job_deatils.error
     })
+    if job_deatils.status == "cancelled":
+        return response, 200
+    if job_deatils.status in TERMINAL_STATUSES:
+        # The job finished before it could be cancelled
+        return response, 409
+    # The job stops at the next cancellation check of the stage it is in
+    return response, 202
 
 
 @app.route('/jobs', methods=['GET'])
 def get_jobs():
-    jobs = indexing_service.get_jobs()
-    return json.dumps(jobs, default=lambda o: o.__dict__, indent=4)
+    try:
+        status = request.args.get('status')
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', 100))
+        if offset < 0 or limit < 0:
+            raise ValueError(f"offset and limit should be positive, got offset {offset} and limit {limit}")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid request {e}"}), 400
+    jobs, total = indexing_service.get_jobs(status=status, offset=offset, limit=limit)
+    response = {
+        "jobs": {job.id: job.to_dict() for job in jobs},
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        **indexing_service.get_scheduler_stats()
+    }
+    return json.dumps(response, default=lambda o: o.__dict__), 200, {'Content-Type': 'application/json'}
 
 
 @app.route('/create_index', methods=['POST'])
@@ -98,6 +144,7 @@ def create_index():
     try:
         logger.info(f"Received request: %s ", request.json)
         create_index_request = data_model.build_create_index_request(request.json)
+        validate_create_index_request(create_index_request)
     except Exception as e:
         logger.error(traceback.format_exc())
         return jsonify({"error": "Invalid request"}), 400
@@ -127,7 +174,8 @@ def register_worker():
         "workerList": [
             {
                 "workerURL": host_ip,
-                "workerPort": PORT
+                "workerPort": PORT,
+                "capabilities": indexing_service.get_capabilities()
             }
         ]
     }
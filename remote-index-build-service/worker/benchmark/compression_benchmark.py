@@ -0,0 +1,113 @@
+"""
+Measures what the framed compressions of the worker save on real embeddings, against the CPU time they cost.
+
+For every compression and level it compresses the vectors, and the faiss index built on a sample of them, and
+reports the compression ratio and the compression and decoding throughput on 1 core. The transfer time of the
+uncompressed and of the compressed bytes is then estimated for the network bandwidth of the instance, a compressed
+download is decoded while it downloads, so it takes the longest of its transfer and of its decoding.
+
+The vectors are read from a file in the format of the vector objects (little-endian vectors, --dimensions is then
+required), from a .fvecs file, or from the train dataset of an ANN Benchmarks .hdf5 file, which needs h5py.
+
+Run it from the worker directory:
+    python -m benchmark.compression_benchmark --vectors sift-128-euclidean.hdf5 --network-gbps 10
+"""
+import argparse
+import io
+import time
+
+import numpy as np
+
+from models.data_model import VECTOR_DATA_TYPES
+from utils.compression import CompressedWriter, FramedDecoder, LZ4, ZSTD
+
+# The compressions and levels compared, lz4 level 0 is its fast mode
+LEVELS = [(LZ4, 0), (LZ4, 9), (ZSTD, 1), (ZSTD, 3), (ZSTD, 9)]
+# Size of the chunks fed to the decoder, like the ranges of a compressed download
+DECODE_CHUNK_SIZE = 1024 * 1024 * 16
+
+
+def read_vectors(path: str, dimensions: int, vector_data_type: str, max_vectors: int) -> np.ndarray:
+    if path.endswith(".hdf5"):
+        import h5py
+        with h5py.File(path, "r") as f:
+            return np.ascontiguousarray(f["train"][:max_vectors], dtype=np.float32)
+    if path.endswith(".fvecs"):
+        data = np.fromfile(path, dtype="<i4")
+        dimensions = data[0]
+        return np.ascontiguousarray(data.reshape(-1, dimensions + 1)[:max_vectors, 1:].view("<f4"))
+    if dimensions is None:
+        raise ValueError("--dimensions is required for the vector object files")
+    width = dimensions // 8 if vector_data_type == "binary" else dimensions
+    vectors = np.fromfile(path, dtype=VECTOR_DATA_TYPES[vector_data_type], count=max_vectors * width)
+    return vectors.reshape(-1, width)
+
+
+def serialize_index(vectors: np.ndarray, index_vectors: int) -> bytes:
+    import faiss
+    sample = np.ascontiguousarray(vectors[:index_vectors], dtype=np.float32)
+    index = faiss.IndexIDMap(faiss.IndexHNSWFlat(sample.shape[1], 16))
+    index.add_with_ids(sample, np.arange(len(sample)))
+    return faiss.serialize_index(index).tobytes()
+
+
+def measure(data: bytes, compression: str, level: int) -> dict:
+    buffer = io.BytesIO()
+    start = time.process_time()
+    writer = CompressedWriter(buffer, compression, level)
+    writer.write(data)
+    writer.close()
+    compress_time = time.process_time() - start
+    compressed = buffer.getbuffer()
+
+    decoder = FramedDecoder(compression)
+    start = time.process_time()
+    decoded_size = sum(len(decoder.decode(compressed[offset:offset + DECODE_CHUNK_SIZE]))
+                       for offset in range(0, len(compressed), DECODE_CHUNK_SIZE))
+    decoder.finish()
+    decode_time = time.process_time() - start
+    assert decoded_size == len(data)
+    return {"compressed_size": len(compressed), "ratio": len(data) / len(compressed),
+            "compress_time": compress_time, "decode_time": decode_time}
+
+
+def report(name: str, data: bytes, network_bytes_per_second: float):
+    size_mb = len(data) / (1024 * 1024)
+    transfer_time = len(data) / network_bytes_per_second
+    print(f"\n{name}: {size_mb:.1f}MB, {transfer_time:.3f}s to transfer uncompressed")
+    print(f"{'compression':<14}{'ratio':>8}{'saved MB':>10}{'compress MB/s':>15}{'decode MB/s':>13}"
+          f"{'decode core s/GB':>18}{'transfer (s)':>14}{'speedup':>9}")
+    for compression, level in LEVELS:
+        result = measure(data, compression, level)
+        compressed_transfer_time = max(result["compressed_size"] / network_bytes_per_second, result["decode_time"])
+        print(f"{f'{compression} {level}':<14}{result['ratio']:>8.3f}"
+              f"{size_mb - result['compressed_size'] / (1024 * 1024):>10.1f}"
+              f"{size_mb / max(result['compress_time'], 1e-9):>15.0f}{size_mb / max(result['decode_time'], 1e-9):>13.0f}"
+              f"{result['decode_time'] / (size_mb / 1024):>18.2f}{compressed_transfer_time:>14.3f}"
+              f"{transfer_time / compressed_transfer_time:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", required=True, help="Path of the vectors, see above for the formats")
+    parser.add_argument("--dimensions", type=int, help="Dimensions of the vectors of a vector object file")
+    parser.add_argument("--vector-data-type", default="float32", choices=list(VECTOR_DATA_TYPES),
+                        help="Vector data type of a vector object file")
+    parser.add_argument("--max-vectors", type=int, default=1000000)
+    parser.add_argument("--index-vectors", type=int, default=100000,
+                        help="Number of vectors of the index whose file is compressed, 0 to skip the index")
+    parser.add_argument("--network-gbps", type=float, default=10, help="Network bandwidth of the instance")
+    args = parser.parse_args()
+
+    vectors = read_vectors(args.vectors, args.dimensions, args.vector_data_type, args.max_vectors)
+    network_bytes_per_second = args.network_gbps * 1e9 / 8
+    print(f"{len(vectors)} vectors of {vectors.shape[1]} {vectors.dtype} elements, "
+          f"{args.network_gbps}Gbps network, times are on 1 core")
+    report("Vectors", vectors.tobytes(), network_bytes_per_second)
+    if args.index_vectors > 0 and args.vector_data_type != "binary":
+        report(f"HNSW16,Flat index of {min(args.index_vectors, len(vectors))} vectors",
+               serialize_index(vectors, args.index_vectors), network_bytes_per_second)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Measures the throughput of the in-place normalization of the cosinesimil vectors for a range of threads.
+
+For every number of threads it normalizes a fresh copy of the vectors with normalize_in_place, like an add batch of
+a CPU build, and reports the throughput and the speedup over 1 thread. The normalization in one numpy expression, which
+allocates a full-size copy of the vectors, and faiss.normalize_L2, are measured for reference. The block size, which
+should fit in the L2 cache of a core, can be compared with --block-kb.
+
+The vectors are random unless --vectors is set, which reads them like benchmark.compression_benchmark.
+
+Run it from the worker directory:
+    python -m benchmark.normalization_benchmark --number-of-vectors 1000000 --dimensions 768 --threads 1 2 4 8 16
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from benchmark.compression_benchmark import read_vectors
+from index_builder.normalization import NORMALIZE_BLOCK_BYTES, normalize_in_place
+
+
+def best_time(vectors: np.ndarray, normalize, repeats: int) -> float:
+    """Returns the shortest time normalize takes on a fresh copy of the vectors, the copy isn't timed"""
+    times = []
+    for _ in range(repeats):
+        copy = vectors.copy()
+        start = time.perf_counter()
+        normalize(copy)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", help="Path of the vectors, see benchmark.compression_benchmark for the formats")
+    parser.add_argument("--number-of-vectors", type=int, default=200000)
+    parser.add_argument("--dimensions", type=int, default=768)
+    parser.add_argument("--threads", type=int, nargs="+",
+                        default=sorted({1, 2, 4, 8, os.cpu_count() or 1}), help="Numbers of threads to compare")
+    parser.add_argument("--block-kb", type=int, nargs="+", default=[NORMALIZE_BLOCK_BYTES // 1024],
+                        help="Block sizes to compare, in KB")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.vectors:
+        vectors = np.ascontiguousarray(read_vectors(args.vectors, args.dimensions, "float32", args.number_of_vectors))
+    else:
+        vectors = np.random.default_rng(42).standard_normal((args.number_of_vectors, args.dimensions), dtype=np.float32)
+    size_mb = vectors.nbytes / (1024 * 1024)
+    print(f"{len(vectors)} vectors of {vectors.shape[1]} dimensions, {size_mb:.1f}MB, {os.cpu_count()} cores")
+
+    print(f"\n{'method':<28}{'threads':>8}{'time (s)':>10}{'MB/s':>9}{'speedup':>9}")
+    numpy_time = best_time(vectors, lambda x: x / np.linalg.norm(x, axis=1, keepdims=True), args.repeats)
+    print(f"{'numpy with a copy':<28}{1:>8}{numpy_time:>10.3f}{size_mb / numpy_time:>9.0f}{'':>9}")
+    try:
+        import faiss
+    except ImportError:
+        faiss = None
+    for block_kb in args.block_kb:
+        baseline = None
+        for threads in args.threads:
+            elapsed = best_time(vectors, lambda x: normalize_in_place(x, threads, block_kb * 1024), args.repeats)
+            baseline = baseline or elapsed
+            print(f"{f'in place, {block_kb}KB blocks':<28}{threads:>8}{elapsed:>10.3f}{size_mb / elapsed:>9.0f}"
+                  f"{baseline / elapsed:>9.2f}")
+    if faiss is not None:
+        baseline = None
+        for threads in args.threads:
+            faiss.omp_set_num_threads(threads)
+            elapsed = best_time(vectors, faiss.normalize_L2, args.repeats)
+            baseline = baseline or elapsed
+            print(f"{'faiss.normalize_L2':<28}{threads:>8}{elapsed:>10.3f}{size_mb / elapsed:>9.0f}"
+                  f"{baseline / elapsed:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,215 @@
 import logging
+import mmap
+import os
+from typing import Callable
 
 import faiss
+import numpy as np
 from utils.decorators.timer import timer_func
+from utils.cancellation import CancellationToken, raise_if_cancelled
 from utils.common import get_omp_num_threads
 from timeit import default_timer as timer
 
+from models.data_model import CreateIndexRequest, Encoders, get_pq_dim
 from vector_data_accessor.accessor import VectorsDataset
+from index_builder.index_writer import get_index_size, write_index
+from index_builder.normalization import normalized
 
+# Maximum size of the slice of memory mapped vectors added to the index in one add_with_ids call
+mmap_add_batch_bytes = int(os.getenv('MMAP_ADD_BATCH_BYTES', 1024*1024*256)) # 256MB
+# Maximum size of the slice of vectors added in one add_with_ids call, the job is checked for a cancellation
+# between 2 slices, so this bounds how long a cancelled build keeps running
+add_batch_bytes = int(os.getenv('ADD_BATCH_BYTES', 1024*1024*64)) # 64MB
+# Fixed number of vectors added in one add_with_ids call, which overrides the batch bytes when it is set, e.g. to
+# tune the batches for the cache locality of the graph build
+add_batch_size = int(os.getenv('ADD_BATCH_SIZE')) if os.getenv('ADD_BATCH_SIZE') else None
+# Whether the pages of the memory mapped vectors which are added to the index are released from the memory of the
+# process right away, rather than when the kernel reclaims them
+mmap_release_added_vectors = int(os.getenv('MMAP_RELEASE_ADDED_VECTORS', 1)) == 1
+# Maximum number of vectors the quantizer of a quantized storage, like SQ8 or PQ, is trained on
+train_sample_size = int(os.getenv('TRAIN_SAMPLE_SIZE', 100000))
+# Number of vectors, held out of the training sample, whose nearest neighbours in the index are compared to the exact
+# ones to measure the recall of the index. The measure is skipped unless it is set
+recall_sample_size = int(os.getenv('RECALL_SAMPLE_SIZE', 0))
+recall_k = int(os.getenv('RECALL_K', 10))
+# Number of vectors, held out of the recall sample, among which the nearest neighbours of the recall sample are
+# searched, which bounds the vectors the measure reads again once they are added
+recall_ground_truth_size = int(os.getenv('RECALL_GROUND_TRUTH_SIZE', 100000))
+# Seed of the sampling of the training and recall vectors, so that the builds of the same vectors are the same
+SAMPLE_SEED = 42
 
-def create_index(vectorsDataset:VectorsDataset, param, space_type, file_to_write="cpuIndex.hnsw.graph") -> dict:
-    num_of_parallel_threads = get_omp_num_threads()
+def validate_request(createIndexRequest: CreateIndexRequest):
+    """Raise ValueError when the factory string of the request doesn't build an HNSW index of its dimensions"""
+    factory_string = createIndexRequest.indexParameters.get("factory_string")
+    if factory_string is None:
+        return
+    try:
+        # The index is empty, so building it only allocates the codebooks of its storage
+        index = faiss.index_factory(createIndexRequest.dimensions, factory_string)
+    except RuntimeError as e:
+        raise ValueError(f"Invalid index_parameters.factory_string {factory_string}: {e}")
+    if not isinstance(index, faiss.IndexHNSW):
+        raise ValueError(f"index_parameters.factory_string should build an HNSW index, got {factory_string}")
+
+def get_factory_string(param: dict, dimensions: int, binary: bool = False) -> str:
+    """Returns the faiss index factory string of the HNSW index built with the parameters"""
+    if param.get("factory_string") is not None:
+        return param.get("factory_string")
+    m = 16 if param.get("m") is None else param.get("m")
+    if binary:
+        # Binary vectors are kept as they are in a binary HNSW index searched with the Hamming distance
+        return f"BHNSW{m}"
+    encoder = Encoders.from_str(param.get("encoder") or Encoders.FLAT.value)
+    if encoder == Encoders.SQ8:
+        return f"HNSW{m},SQ8"
+    if encoder == Encoders.SQFP16:
+        return f"HNSW{m},SQfp16"
+    if encoder == Encoders.PQ:
+        pq_bits = 8 if param.get("pq_bits") is None else param.get("pq_bits")
+        return f"HNSW{m},PQ{get_pq_dim(param, dimensions)}x{pq_bits}"
+    return f"HNSW{m},Flat"
+
+def sample_rows(number_of_vectors: int, train_size: int, query_size: int, ground_truth_size: int = 0):
+    """
+    Returns the sorted rows of the training sample, of the recall queries and of the recall ground truth. The queries
+    are held out of the training sample unless there are too few vectors for both, and are always held out of the
+    ground truth, which is empty when there are no other vectors.
+    """
+    rng = np.random.default_rng(SAMPLE_SEED)
+    sample = rng.choice(number_of_vectors, min(number_of_vectors, query_size + max(train_size, ground_truth_size)),
+                        replace=False)
+    query_rows = np.sort(sample[:min(query_size, number_of_vectors)])
+    rest = sample[len(query_rows):]
+    train_rows = rest if len(rest) > 0 else sample
+    return np.sort(train_rows[:train_size]), query_rows, np.sort(rest[:ground_truth_size])
+
+def to_faiss_vectors(vectors: np.ndarray, binary: bool = False) -> np.ndarray:
+    """
+    faiss adds, trains and searches float32 vectors, or uint8 rows for binary indexes. The float16 and byte vectors are
+    converted to float32 a slice at a time, so only a slice of converted vectors is in memory at once, and the float32
+    vectors are only copied when they are not contiguous.
+    """
+    return np.ascontiguousarray(vectors, dtype=np.uint8 if binary else np.float32)
+
+def get_add_batch_size(xb) -> int:
+    """Returns the number of vectors added to the index in one add_with_ids call"""
+    if add_batch_size is not None:
+        return max(add_batch_size, 1)
+    # Only a slice of memory mapped vectors needs to be resident at a time
+    batch_bytes = min(add_batch_bytes, mmap_add_batch_bytes) if isinstance(xb, np.memmap) else add_batch_bytes
+    return max(batch_bytes // xb[0].nbytes, 1) if len(xb) > 0 else 1
+
+def release_memory_mapped_rows(xb: np.memmap, start: int, end: int):
+    """
+    Release the pages of the memory mapped rows [start, end) from the memory of the process with MADV_DONTNEED.
+    The mapping is read only, so the pages are read from the file again if they are accessed later. The pages which
+    are shared with the rows after end are kept.
+    """
+    mapping = getattr(xb, '_mmap', None)
+    if mapping is None or not hasattr(mmap, 'MADV_DONTNEED') or end <= start:
+        return
+    # numpy maps the file from the offset of the array rounded down to the allocation granularity
+    array_start = xb.offset % mmap.ALLOCATIONGRANULARITY
+    row_bytes = xb[0].nbytes
+    first_page = (array_start + start * row_bytes) // mmap.PAGESIZE * mmap.PAGESIZE
+    last_page = (array_start + end * row_bytes) // mmap.PAGESIZE * mmap.PAGESIZE
+    if last_page > first_page:
+        mapping.madvise(mmap.MADV_DONTNEED, first_page, last_page - first_page)
+
+def create_index(vectorsDataset:VectorsDataset, param, space_type, file_to_write="cpuIndex.hnsw.graph", num_threads=None,
+                 cancellation: CancellationToken = None, on_progress: Callable[[int, int], None] = None) -> dict:
+    """
+    Build the HNSW index of the dataset. The vectors are added in batches, the cancellation token is checked between
+    2 batches and on_progress, when set, is called with the number of vectors added so far and the total number of
+    vectors after every batch.
+    """
+    # The number of threads is per job when the worker is running multiple jobs at once
+    num_of_parallel_threads = get_omp_num_threads() if num_threads is None else num_threads
     logging.info(f"Setting number of parallel threads for graph build: {num_of_parallel_threads}")
     faiss.omp_set_num_threads(num_of_parallel_threads)
 
-    m = 16 if param.get("m") is None else param.get("m")
+    binary = vectorsDataset.vector_data_type == "binary"
+    # The encoder or the factory string can replace the flat storage of the vectors by a quantized one, like HNSW32,SQ8
+    factory_string = get_factory_string(param, vectorsDataset.dimensions, binary)
 
     metric = faiss.METRIC_L2
-    if space_type == "innerproduct":
+    if space_type in ["innerproduct", "cosinesimil"]:
         metric = faiss.METRIC_INNER_PRODUCT
-    cpuPureHNSWIndex: faiss.IndexHNSWFlat = faiss.index_factory(vectorsDataset.dimensions, f"HNSW{m},Flat", metric)
+    # The cosine similarity is the inner product of the vectors normalized to a unit norm, every slice of vectors
+    # is normalized in place once it is converted, so the dataset is never copied as a whole
+    normalize = space_type == "cosinesimil"
+
+    def prepare(vectors: np.ndarray) -> np.ndarray:
+        vectors = to_faiss_vectors(vectors, binary)
+        return normalized(vectors, num_of_parallel_threads) if normalize else vectors
+
+    if binary:
+        cpuPureHNSWIndex: faiss.IndexBinaryHNSW = faiss.index_binary_factory(vectorsDataset.dimensions, factory_string)
+    else:
+        cpuPureHNSWIndex: faiss.IndexHNSW = faiss.index_factory(vectorsDataset.dimensions, factory_string, metric)
 
     cpuPureHNSWIndex.hnsw.efConstruction = 100 if param.get("ef_construction") is None else param.get("ef_construction")
-    logging.info(f"EF Construction is : {cpuPureHNSWIndex.hnsw.efConstruction} and m is : {m}")
-    cpuIdMapIndex = faiss.IndexIDMap(cpuPureHNSWIndex)
+    if param.get("ef_search") is not None:
+        cpuPureHNSWIndex.hnsw.efSearch = param.get("ef_search")
+    logging.info(f"EF Construction is : {cpuPureHNSWIndex.hnsw.efConstruction} and factory string is : {factory_string}")
+    cpuIdMapIndex = faiss.IndexBinaryIDMap(cpuPureHNSWIndex) if binary else faiss.IndexIDMap(cpuPureHNSWIndex)
+
+    number_of_vectors = len(vectorsDataset.ids)
+    train_rows, query_rows, ground_truth_rows = sample_rows(number_of_vectors, train_sample_size, recall_sample_size,
+                                                            recall_ground_truth_size if recall_sample_size > 0 else 0)
+    trainTime = 0
+    storage = faiss.downcast_index(cpuPureHNSWIndex.storage) if not binary else None
+    if isinstance(storage, faiss.IndexPQ):
+        # The polysemous codes only speed up the Hamming filtering of the searches of a flat PQ index, which the HNSW
+        # searches don't use, and training them takes most of the training time
+        storage.do_polysemous_training = False
+    if not cpuIdMapIndex.is_trained:
+        # The quantized storages learn their codebooks from a sample of the vectors before any vector is added, only
+        # the sampled rows of memory mapped vectors are read
+        raise_if_cancelled(cancellation, "The index build was cancelled")
+        t1 = timer()
+        cpuIdMapIndex.train(prepare(vectorsDataset.vectors[train_rows]))
+        trainTime = timer() - t1
+        logging.info(f"Trained the {factory_string} index on {len(train_rows)} vectors in {trainTime}s")
+
+    batch_size = get_add_batch_size(vectorsDataset.vectors)
 
     @timer_func
     def indexDataInIndex(index: faiss.Index, ids, xb):
-        index.add_with_ids(xb, ids)
+        # Add the vectors in bounded slices, so that a cancelled job stops between 2 slices, the progress of the
+        # build is known and only a slice of memory mapped vectors needs to be resident at a time
+        logging.info(f"Adding vectors in batches of {batch_size}")
+        release_rows = mmap_release_added_vectors and isinstance(xb, np.memmap)
+        for start in range(0, len(ids), batch_size):
+            raise_if_cancelled(cancellation, "The index build was cancelled")
+            end = min(start + batch_size, len(ids))
+            index.add_with_ids(prepare(xb[start:end]), ids[start:end])
+            if release_rows:
+                release_memory_mapped_rows(xb, start, end)
+            if on_progress is not None:
+                on_progress(end, len(ids))
     t1 = timer()
     indexDataInIndex(cpuIdMapIndex, vectorsDataset.ids, vectorsDataset.vectors)
     t2 = timer()
+    indexTime = t2 - t1
+
+    recall, recallTime = None, 0
+    if len(query_rows) > 0 and len(ground_truth_rows) > 0:
+        t1 = timer()
+        recall = measure_recall(cpuIdMapIndex, vectorsDataset, query_rows, ground_truth_rows, metric, batch_size,
+                                binary, cancellation, prepare)
+        recallTime = timer() - t1
+        logging.info(f"Recall@{min(recall_k, len(ground_truth_rows))} of the {factory_string} index on "
+                     f"{len(query_rows)} vectors among {len(ground_truth_rows)} vectors is {recall}, measured in "
+                     f"{recallTime}s")
 
     # Let's free up the Vector dataset. We should free up the space to ensure that we can free up some RAM
     vectorsDataset.free_vectors_space()
 
-    indexTime = t2 - t1
+    raise_if_cancelled(cancellation, "The index build was cancelled")
     @timer_func
     def writeIndex(index, fileName):
-        faiss.write_index(index, fileName)
+        write_index(index, fileName)
     t1 = timer()
     writeIndex(cpuIdMapIndex, file_to_write)
     t2 = timer()
@@ -46,4 +218,46 @@ def create_index(vectorsDataset:VectorsDataset, param, space_type, file_to_write
     cpuPureHNSWIndex.own_fields = True
     del cpuPureHNSWIndex
     del cpuIdMapIndex
-    return {"indexTime": indexTime, "writeIndexTime": writeIndexTime, "totalTime": indexTime + writeIndexTime, "unit": "seconds" }
+    return {"trainTime": trainTime, "indexTime": indexTime, "recallTime": recallTime, "writeIndexTime": writeIndexTime,
+            "totalTime": trainTime + indexTime + recallTime + writeIndexTime, "unit": "seconds",
+            "addBatchSize": batch_size, "vectorsPerSecond": number_of_vectors / indexTime if indexTime > 0 else 0,
+            "factoryString": factory_string, "trainSampleSize": len(train_rows) if trainTime > 0 else 0,
+            "indexFileSize": get_index_size(file_to_write), "recall": recall,
+            "recallK": min(recall_k, len(ground_truth_rows)), "recallSampleSize": len(query_rows) if recall is not None else 0,
+            "recallGroundTruthSize": len(ground_truth_rows)}
+
+def measure_recall(index: faiss.Index, vectorsDataset: VectorsDataset, query_rows, ground_truth_rows, metric,
+                   batch_size: int, binary: bool = False, cancellation: CancellationToken = None,
+                   prepare: Callable[[np.ndarray], np.ndarray] = None) -> float:
+    """
+    Returns the share of the exact k nearest neighbours of the query rows among the ground truth rows which the index
+    finds. The index is searched among the ids of the ground truth rows only, which hold out the query rows, so a
+    query doesn't find itself, and the exact neighbours are found by a brute force search over the ground truth rows in
+    batches, so the vectors read again are bounded by the ground truth. Binary vectors are compared with the Hamming
+    distance. prepare converts the vectors like they were added to the index, e.g. normalizes them for the cosine
+    similarity.
+    """
+    if prepare is None:
+        prepare = lambda vectors: to_faiss_vectors(vectors, binary)
+    xb = vectorsDataset.vectors
+    ground_truth_ids = np.asarray(vectorsDataset.ids, dtype=np.int64)[ground_truth_rows]
+    xq = prepare(xb[query_rows])
+    k = min(recall_k, len(ground_truth_rows))
+    # The search parameters replace the efSearch of the index, which is kept
+    hnsw = (faiss.downcast_IndexBinary(index.index) if binary else faiss.downcast_index(index.index)).hnsw
+    params = faiss.SearchParametersHNSW(sel=faiss.IDSelectorBatch(ground_truth_ids), efSearch=hnsw.efSearch)
+    _, found = index.search(xq, k, params=params)
+    exact = faiss.ResultHeap(len(xq), k, keep_max=metric == faiss.METRIC_INNER_PRODUCT)
+    for start in range(0, len(ground_truth_rows), batch_size):
+        raise_if_cancelled(cancellation, "The index build was cancelled")
+        end = min(start + batch_size, len(ground_truth_rows))
+        vectors = prepare(xb[ground_truth_rows[start:end]])
+        if binary:
+            distances, rows = faiss.knn_hamming(xq, vectors, k)
+            distances = distances.astype(np.float32)
+        else:
+            distances, rows = faiss.knn(xq, vectors, k, metric=metric)
+        exact.add_result(distances, np.where(rows >= 0, rows + start, -1))
+    exact.finalize()
+    expected = ground_truth_ids[exact.I]
+    return float(np.mean([len(np.intersect1d(found[q], expected[q])) / k for q in range(len(xq))]))
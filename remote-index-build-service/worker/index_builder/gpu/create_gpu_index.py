@@ -4,21 +4,30 @@ sys.path.append('/tmp/faiss/build/faiss/python')
 import faiss
 from timeit import default_timer as timer
 import math
+from typing import Callable
 
+import numpy as np
+
+from utils.cancellation import CancellationToken, raise_if_cancelled
 from utils.common import get_omp_num_threads
 from utils.decorators.timer import timer_func
 from vector_data_accessor.accessor import VectorsDataset
+from index_builder.index_writer import get_index_size, write_index
+from index_builder.normalization import normalized
 import logging
 
 logger = logging.getLogger(__name__)
 
-def create_index(vectorsDataset:VectorsDataset, indexingParams:dict, space_type:str, file_to_write:str= "gpuIndex.cagra.graph"):
-    num_of_parallel_threads = get_omp_num_threads()
+def create_index(vectorsDataset:VectorsDataset, indexingParams:dict, space_type:str, file_to_write:str= "gpuIndex.cagra.graph", num_threads:int = None,
+                 cancellation: CancellationToken = None, on_progress: Callable[[int, int], None] = None):
+    if vectorsDataset.vector_data_type == "binary":
+        raise ValueError("Binary vectors are not supported by the GPU builds")
+    num_of_parallel_threads = get_omp_num_threads() if num_threads is None else num_threads
     logging.info(f"Setting number of parallel threads for gpu based graph build: {num_of_parallel_threads}")
     faiss.omp_set_num_threads(num_of_parallel_threads)
     res = faiss.StandardGpuResources()
     metric = faiss.METRIC_L2
-    if space_type == "innerproduct":
+    if space_type in ["innerproduct", "cosinesimil"]:
         metric = faiss.METRIC_INNER_PRODUCT
     cagraIndexConfig = faiss.GpuIndexCagraConfig()
     cagraIndexConfig.intermediate_graph_degree = 64 if indexingParams.get('intermediate_graph_degree') is None else indexingParams['intermediate_graph_degree']
@@ -36,10 +45,9 @@ def create_index(vectorsDataset:VectorsDataset, indexingParams:dict, space_type:
     cagraIndexIVFPQConfig.kmeans_n_iters = 10 if indexingParams.get('kmeans_n_iters') == None else indexingParams['kmeans_n_iters']
     # instead of 32 bits per dim, you are using only 8 bits per dim
     cagraIndexIVFPQConfig.pq_bits = 8 if indexingParams.get('pq_bits') == None else indexingParams['pq_bits']
-    #cagraIndexIVFPQConfig.pq_dim = 16 if indexingParams.get('pq_dim') == None else indexingParams['pq_dim']
     compression_factor = 8
     # instead of using d dimension you use d/compression_factor dimensions.
-    cagraIndexIVFPQConfig.pq_dim = int(vectorsDataset.dimensions / compression_factor)
+    cagraIndexIVFPQConfig.pq_dim = int(vectorsDataset.dimensions / compression_factor) if indexingParams.get('pq_dim') is None else indexingParams['pq_dim']
 
     # In total instead of 128 * 32 bits(where dimension = 128) in total for 1 vector you are using ((128 / 8) * 8) = 128 bits in total
     # So this is a 32x compression.
@@ -57,13 +65,27 @@ def create_index(vectorsDataset:VectorsDataset, indexingParams:dict, space_type:
     cagraIVFPQIndex = faiss.GpuIndexCagra(res, vectorsDataset.dimensions, metric, cagraIndexConfig)
     idMapIVFPQIndex = faiss.IndexIDMap(cagraIVFPQIndex)
 
+    # CAGRA builds the whole graph in a single add, so a cancelled job can only stop before or after the build
+    raise_if_cancelled(cancellation, "The index build was cancelled")
+    # CAGRA takes all the vectors at once, so the float16 and byte vectors are converted to float32 as a whole
+    if space_type == "cosinesimil":
+        # The cosine similarity is the inner product of the normalized vectors, which are normalized in place, the
+        # memory mapped float32 vectors in a writable mapping of their file rather than in a copy
+        vectors = normalized(np.ascontiguousarray(vectorsDataset.get_writable_vectors(), dtype=np.float32),
+                             num_of_parallel_threads)
+    else:
+        vectors = np.ascontiguousarray(vectorsDataset.vectors, dtype=np.float32)
     t1 = timer()
-    indexDataInIndex(idMapIVFPQIndex, vectorsDataset.ids, vectorsDataset.vectors)
+    indexDataInIndex(idMapIVFPQIndex, vectorsDataset.ids, vectors)
     t2 = timer()
     indexTime = t2 - t1
+    if on_progress is not None:
+        on_progress(dataset_size, dataset_size)
+    raise_if_cancelled(cancellation, "The index build was cancelled")
 
     t1 = timer()
-    writeIndexMetrics = writeCagraIndexOnFile(idMapIVFPQIndex, cagraIVFPQIndex, file_to_write)
+    writeIndexMetrics = writeCagraIndexOnFile(idMapIVFPQIndex, cagraIVFPQIndex, file_to_write,
+                                              256 if indexingParams.get('ef_search') is None else indexingParams['ef_search'])
     logger.info("Write completed")
     t2 = timer()
     writeIndexTime = t2 - t1
@@ -75,10 +97,13 @@ def create_index(vectorsDataset:VectorsDataset, indexingParams:dict, space_type:
     del idMapIVFPQIndex
     # Let's free up the Vector dataset. We should free up the space to ensure that we can free up some RAM
     vectorsDataset.free_vectors_space()
+    del vectors
     return {
         "indexTime": indexTime, "writeIndexTime": writeIndexTime, "totalTime": indexTime + writeIndexTime, "unit": "seconds",
+        "vectorsPerSecond": dataset_size / indexTime if indexTime > 0 else 0,
         "gpu_to_cpu_index_conversion_time": writeIndexMetrics["gpu_to_cpu_index_conversion_time"] ,
-        "write_to_file_time": writeIndexMetrics["write_to_file_time"]
+        "write_to_file_time": writeIndexMetrics["write_to_file_time"],
+        "indexFileSize": get_index_size(file_to_write)
     }
 
 
@@ -88,11 +113,11 @@ def indexDataInIndex(index: faiss.Index, ids, xb):
 
 
 @timer_func
-def writeCagraIndexOnFile(idMapIndex: faiss.Index, cagraIndex: faiss.GpuIndexCagra, outputFileName: str):
+def writeCagraIndexOnFile(idMapIndex: faiss.Index, cagraIndex: faiss.GpuIndexCagra, outputFileName: str, efSearch: int = 256):
     t1 = timer()
     cpuIndex = faiss.IndexHNSWCagra()
-    # This value will come from input keeping it 256 as this is what we have in our benchmarks
-    cpuIndex.hnsw.efSearch = 256
+    # Defaults to 256 as this is what we have in our benchmarks
+    cpuIndex.hnsw.efSearch = efSearch
     logging.info(f"HNSW value of ef search is {cpuIndex.hnsw.efSearch}")
     # This will ensure that we have faster conversion time, but make the graph immutable
     cpuIndex.base_level_only = True
@@ -104,7 +129,7 @@ def writeCagraIndexOnFile(idMapIndex: faiss.Index, cagraIndex: faiss.GpuIndexCag
     conversion_time = t2 - t1
     
     t1 = timer()
-    faiss.write_index(idMapIndex, outputFileName)
+    write_index(idMapIndex, outputFileName)
     t2 = timer()
     write_to_file_time = t2 - t1
     del cpuIndex
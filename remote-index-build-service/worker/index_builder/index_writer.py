@@ -0,0 +1,30 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks faiss hands over to a stream while serializing an index
+STREAM_WRITE_BLOCK_SIZE = 1024*1024 # 1MB
+
+
+def write_index(index, destination):
+    """
+    Write a faiss index to a file path, or serialize it into a writable stream like the MultipartUploadStream,
+    which can ship the index while it is still being serialized.
+    """
+    # faiss is imported here so that the builders can load their own faiss package first
+    import faiss
+    # The indexes of binary vectors have their own serialization
+    write = faiss.write_index_binary if isinstance(index, faiss.IndexBinary) else faiss.write_index
+    if isinstance(destination, str):
+        write(index, destination)
+        return
+    writer = faiss.PyCallbackIOWriter(destination.write, STREAM_WRITE_BLOCK_SIZE)
+    write(index, writer)
+
+
+def get_index_size(destination) -> int:
+    """Returns the size in bytes of the index written to a file path or serialized into a stream"""
+    if isinstance(destination, str):
+        return os.path.getsize(destination)
+    return getattr(destination, 'size', None)
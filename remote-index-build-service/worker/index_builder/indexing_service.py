@@ -1,78 +1,255 @@
-import traceback
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
-from typing import Dict, Any
-import threading
+from typing import Callable, Dict, List, Tuple
 import logging
+import os
+import tempfile
+import threading
+from timeit import default_timer as timer
 
-from index_builder.vector_index_builder import build_index_and_upload_index
-from models.data_model import CreateIndexRequest, CreateIndexResponse
+from index_builder.job_checkpoint import CheckpointStore, UPLOAD_STAGE
+from index_builder.job_pipeline import IndexingPipeline, PipelineJob, PipelineStage
+from index_builder.job_scheduler import build_job_scheduler, get_memory_model
+from index_builder.job_store import JobDetails, JobStore
+from index_builder.vector_index_builder import download_vectors, create_index, upload_index, discard_index, build_memory_stats, \
+    get_index_file, index_type
+from models.data_model import CreateIndexRequest, CreateIndexResponse, IndexTypes
+from utils.cancellation import CancellationToken, JobCancelledError
+from utils.common import get_free_disk, get_omp_num_threads, get_peak_rss, get_total_memory
 
 logger = logging.getLogger(__name__)
-# Keeping number of threads 1 here to ensure that we are not creating more than 1 indexing job
-executor = ThreadPoolExecutor(max_workers=1)
 
-@dataclass
-class JobDetails:
-    id: str
-    status: str
-    error: str = None
-    result: Dict[str, Any] = None
-    request: CreateIndexRequest = None
+# Number of jobs each stage of the pipeline runs at the same time. A GPU worker has a single GPU device,
+# so only 1 index should be built at a time
+download_concurrency = int(os.getenv('DOWNLOAD_CONCURRENCY', 2))
+build_concurrency = int(os.getenv('BUILD_CONCURRENCY', 1 if index_type == IndexTypes.GPU else get_omp_num_threads()))
+upload_concurrency = int(os.getenv('UPLOAD_CONCURRENCY', 2))
+# Number of jobs which can wait for the build and for the upload stage before the previous stage blocks
+stage_queue_size = int(os.getenv('PIPELINE_QUEUE_SIZE', 2))
+# Number of jobs holding memory, i.e. jobs which are downloading, waiting for the build or building
+max_concurrent_jobs = int(os.getenv('MAX_CONCURRENT_JOBS', download_concurrency + stage_queue_size + build_concurrency))
+# Retention of the finished jobs, which are spilled to the SQLite file when a path is provided
+job_store_max_jobs = int(os.getenv('JOB_STORE_MAX_JOBS', 1000))
+job_store_ttl_seconds = float(os.getenv('JOB_STORE_TTL_SECONDS', 24 * 60 * 60))
+job_store_sqlite_path = os.getenv('JOB_STORE_SQLITE_PATH')
+# Directory where the progress of the jobs is checkpointed, so that they are resumed when the worker restarts.
+# Checkpointing is disabled when it is not set
+job_checkpoint_dir = os.getenv('JOB_CHECKPOINT_DIR')
 
 class IndexingService:
-    def __init__(self):
-        self.jobs: Dict[str, JobDetails] = {}
+    def __init__(self, job_status_listener: Callable[[JobDetails], None] = None):
+        # Called with the job whenever its status changes, like to push the status to the coordinator
+        self.job_status_listener = job_status_listener
+        self.job_store = JobStore(max_jobs=job_store_max_jobs, ttl_seconds=job_store_ttl_seconds,
+                                  sqlite_path=job_store_sqlite_path)
+        # The scheduler admits as many jobs as fit in the memory budget of the worker in the pipeline, where
+        # the vectors of a job are downloaded while other jobs build and upload their indices
+        self.scheduler = build_job_scheduler(self._start_job, build_concurrency, max_concurrent_jobs)
+        self.pipeline = IndexingPipeline([
+            PipelineStage("download", self._download, download_concurrency),
+            PipelineStage("build", self._build, build_concurrency, stage_queue_size),
+            PipelineStage("upload", self._upload, upload_concurrency, stage_queue_size)
+        ], on_failure=self._fail_job)
+        self.checkpoint_store = CheckpointStore(job_checkpoint_dir) if job_checkpoint_dir is not None else None
+        # The cancellation tokens of the jobs which are not finished
+        self._cancellations: Dict[str, CancellationToken] = {}
         self._lock = threading.Lock()
+        self._resume_jobs()
 
     def create_job(self, job_id: str, create_index_request: CreateIndexRequest) -> JobDetails:
+        job = JobDetails(id=job_id, status="submitted", request= create_index_request)
         with self._lock:
-            job = JobDetails(id=job_id, status="submitted", request= create_index_request)
-            self.jobs[job_id] = job
-            return job
+            self._cancellations[job_id] = CancellationToken()
+        self.job_store.put(job)
+        self._notify(job)
+        return job
 
-    def update_job_status(self, job_id: str, **kwargs):
+    def cancel_job(self, job_id: str) -> JobDetails:
+        """
+        Cancel a job, returns the job or None when the job doesn't exist. A job which is waiting to be admitted is
+        dropped and cancelled right away. A running job stops at the next cancellation check of its stage, like
+        between 2 reads of its download, 2 chunks of vectors of its build or 2 parts of its upload, and its status
+        becomes cancelled once its memory is released and its upload is aborted. A finished job is left as is.
+        """
+        with self._lock:
+            cancellation = self._cancellations.get(job_id)
+        if cancellation is None:
+            return self.job_store.get(job_id)
+        logger.info(f"Cancelling job {job_id}")
+        cancellation.cancel()
+        if self.scheduler.cancel(job_id):
+            self._finish_job(job_id)
+            self.update_job_status(job_id, status="cancelled", error="The job was cancelled")
+        return self.job_store.get(job_id)
+
+    def _finish_job(self, job_id: str):
         with self._lock:
-            if job_id in self.jobs:
-                for key, value in kwargs.items():
-                    setattr(self.jobs[job_id], key, value)
+            self._cancellations.pop(job_id, None)
+
+    def update_job_status(self, job_id: str, **kwargs):
+        self.job_store.update(job_id, **kwargs)
+        if "status" in kwargs:
+            self._notify(self.job_store.get(job_id))
+
+    def _notify(self, job: JobDetails):
+        if self.job_status_listener is None or job is None:
+            return
+        try:
+            self.job_status_listener(job)
+        except Exception as e:
+            logger.error(f"Error notifying the status of job {job.id}: {e}")
 
     def get_job_status(self, job_id: str) -> JobDetails:
-        job = self.jobs.get(job_id)
-        return job
+        return self.job_store.get(job_id)
+
+    def get_jobs(self, status: str = None, offset: int = 0, limit: int = 100) -> Tuple[List[JobDetails], int]:
+        return self.job_store.query(status=status, offset=offset, limit=limit)
 
-    def get_jobs(self) -> Dict[str, JobDetails]:
-        return self.jobs
+    def get_scheduler_stats(self) -> dict:
+        return {
+            **self.scheduler.get_stats(),
+            "stages": self.pipeline.get_stats()
+        }
+
+    def get_capabilities(self) -> dict:
+        """The resources and the load of the worker, which the worker advertises to the coordinator"""
+        scheduler_stats = self.scheduler.get_stats()
+        return {
+            "cpu_count": os.cpu_count(),
+            "total_memory": get_total_memory(),
+            "free_disk": get_free_disk(tempfile.gettempdir()),
+            "build_type": index_type.value,
+            "memory_budget": scheduler_stats["memory_budget"],
+            "memory_reserved": scheduler_stats["memory_reserved"],
+            "queue_depth": scheduler_stats["queue_depth"],
+            "running_jobs": len(scheduler_stats["running_jobs"]),
+            "push_job_status": self.job_status_listener is not None,
+            "memory_model": get_memory_model()
+        }
 
     def start_job(self, job_id:str, create_index_request):
-        # submit the job
-        executor.submit(self._run_job, job_id, create_index_request)
-        logger.info(f"Job started {job_id}")
+        # submit the job, it will start once the scheduler admits it
+        self.scheduler.submit(job_id, create_index_request)
+        logger.info(f"Job submitted {job_id}")
+
+    def _resume_jobs(self):
+        """Restart the jobs which were running when the worker died, under their original job ids"""
+        if self.checkpoint_store is None:
+            return
+        for checkpoint in self.checkpoint_store.load_all():
+            logger.info(f"Resuming job {checkpoint.job_id} from the {checkpoint.stage} stage")
+            self.create_job(checkpoint.job_id, checkpoint.request)
+            self.start_job(checkpoint.job_id, checkpoint.request)
 
-    def _run_job(self, job_id, create_index_request:CreateIndexRequest):
+    def _start_job(self, job_id: str, create_index_request: CreateIndexRequest):
+        with self._lock:
+            cancellation = self._cancellations.get(job_id, CancellationToken())
+        job = PipelineJob(id=job_id, request=create_index_request, cancellation=cancellation)
+        if self.checkpoint_store is not None:
+            job.state["checkpoint"] = self.checkpoint_store.open(job_id, create_index_request)
+        self.pipeline.submit(job)
+
+    def _download(self, job: PipelineJob):
+        logger.info(f"Starting index creation for job {job.id}")
+        self.update_job_status(job.id, status="running")
+        checkpoint = job.state.get("checkpoint")
+        if checkpoint is not None and checkpoint.stage == UPLOAD_STAGE:
+            # The index was built before the worker restarted
+            return
+        job.state["peak_rss_before"] = get_peak_rss()
+        if checkpoint is None:
+            job.state["dataset"], job.stats = download_vectors(job.request, cancellation=job.cancellation)
+            return
+        job.state["dataset"], job.stats = download_vectors(
+            job.request, checkpoint.vector_file, checkpoint.downloaded_ranges,
+            lambda start_byte, end_byte: self.checkpoint_store.mark_range_downloaded(checkpoint, start_byte, end_byte),
+            job.cancellation
+        )
+        self.checkpoint_store.mark_downloaded(checkpoint)
+
+    def _build(self, job: PipelineJob):
+        checkpoint = job.state.get("checkpoint")
+        if checkpoint is not None and checkpoint.stage == UPLOAD_STAGE:
+            job.state["index_destination"] = checkpoint.index_file_path
+            job.state["index_file"] = get_index_file(job.request)
+            self.scheduler.release(job.id)
+            return
+        num_threads = self.scheduler.allocate_threads(job.id)
+        # The builders free the vectors while they build, so their size is taken before
+        dataset_size = job.state["dataset"].get_size()
+        build_start = timer()
         try:
-            logger.info(f"Starting index creation for job {job_id}")
-            self.update_job_status(
-                job_id,
-                status="running"
+            # A checkpointed index is written to the checkpoint directory, so its upload can be resumed
+            index_file_path = self.checkpoint_store.index_file_path(checkpoint) if checkpoint is not None else None
+            index_destination, index_file, job.stats["create_index"] = create_index(
+                job.state["dataset"], job.request, num_threads, index_file_path, job.cancellation,
+                lambda vectors_added, total_vectors: self._report_build_progress(job, vectors_added, total_vectors,
+                                                                                 build_start)
             )
-            # create the index
-            graph_file, stats = build_index_and_upload_index(create_index_request)
+            job.state["index_destination"] = index_destination
+            job.state["index_file"] = index_file
+            job.stats["memory_stats"] = build_memory_stats(job.state["peak_rss_before"], dataset_size,
+                                                           job.stats["create_index"].get("indexFileSize"))
+            if checkpoint is not None:
+                self.checkpoint_store.mark_built(checkpoint, index_destination)
+        finally:
+            # The builders free the vectors, so the memory of the job can be given to the next job
+            job.state.pop("dataset").free_vectors_space()
+            self.scheduler.release(job.id)
 
-            result = CreateIndexResponse(bucketName=create_index_request.bucketName, graphFileLocation=graph_file, stats=stats)
+    def _report_build_progress(self, job: PipelineJob, vectors_added: int, total_vectors: int, build_start: float):
+        """Expose the progress of the build in the status of the job, which is not pushed to the coordinator"""
+        elapsed = timer() - build_start
+        self.job_store.update(job.id, progress={
+            "vectors_added": vectors_added,
+            "total_vectors": total_vectors,
+            "percent": 100.0 * vectors_added / total_vectors if total_vectors > 0 else 100.0,
+            "vectors_per_second": vectors_added / elapsed if elapsed > 0 else 0
+        })
 
-            self.update_job_status(
-                job_id,
-                status="completed",
-                result=result
-            )
-            logger.info(f"Index creation completed for job {job_id}")
+    def _upload(self, job: PipelineJob):
+        checkpoint = job.state.get("checkpoint")
+        resume_options = {}
+        if checkpoint is not None:
+            resume_options = {
+                "upload_id": checkpoint.upload_id,
+                "part_size": checkpoint.part_size,
+                "completed_parts": checkpoint.uploaded_parts,
+                "on_upload_created": lambda upload_id, part_size: self.checkpoint_store.mark_upload_created(checkpoint, upload_id, part_size),
+                "on_part_done": lambda part: self.checkpoint_store.mark_part_uploaded(checkpoint, part)
+            }
+        job.stats["upload_stats"] = upload_index(job.state["index_destination"], job.state["index_file"], job.request,
+                                                 job.cancellation, **resume_options)
+        if checkpoint is not None:
+            self.checkpoint_store.delete(checkpoint)
+        job.stats["pipeline_stats"] = {
+            "queue_wait": job.queue_wait,
+            "unit": "seconds"
+        }
+        result = CreateIndexResponse(bucketName=job.request.bucketName, graphFileLocation=job.state["index_file"], stats=job.stats)
+        self._finish_job(job.id)
+        self.update_job_status(
+            job.id,
+            status="completed",
+            result=result
+        )
+        logger.info(f"Index creation completed for job {job.id}")
 
-        except Exception as e:
-            logger.error(f"Error creating index for job {job_id}: {str(e)}")
-            logger.error(traceback.format_exc())
-            self.update_job_status(
-                job_id,
-                status="failed",
-                error=str(e)
-            )
\ No newline at end of file
+    def _fail_job(self, job: PipelineJob, e: Exception):
+        cancelled = isinstance(e, JobCancelledError)
+        if cancelled:
+            logger.info(f"Job {job.id} was cancelled: {str(e)}")
+        else:
+            logger.error(f"Error creating index for job {job.id}: {str(e)}")
+        dataset = job.state.pop("dataset", None)
+        if dataset is not None:
+            dataset.free_vectors_space()
+        if "index_destination" in job.state:
+            discard_index(job.state["index_destination"])
+        if "checkpoint" in job.state:
+            self.checkpoint_store.delete(job.state["checkpoint"])
+        self.scheduler.release(job.id)
+        self._finish_job(job.id)
+        self.update_job_status(
+            job.id,
+            status="cancelled" if cancelled else "failed",
+            error=str(e)
+        )
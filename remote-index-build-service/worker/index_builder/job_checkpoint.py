@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from models.data_model import CreateIndexRequest
+from s3.s3client import cleanup_temp_file
+
+logger = logging.getLogger(__name__)
+
+# Stages a job is resumed from. The build itself can't be checkpointed, a job which dies while building is
+# resumed from its downloaded vectors
+DOWNLOAD_STAGE = "download"
+BUILD_STAGE = "build"
+UPLOAD_STAGE = "upload"
+
+
+@dataclass
+class JobCheckpoint:
+    job_id: str
+    request: CreateIndexRequest
+    stage: str = DOWNLOAD_STAGE
+    # File the vectors are downloaded to, and the [start_byte, end_byte] ranges of it which are downloaded
+    vector_file: str = None
+    downloaded_ranges: List[List[int]] = field(default_factory=list)
+    # Finished local index file
+    index_file_path: str = None
+    # Multipart upload of the index file, and its {'PartNumber', 'ETag'} parts which are uploaded
+    upload_id: str = None
+    part_size: int = None
+    uploaded_parts: List[Dict] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {**self.__dict__, "request": self.request.__dict__}
+
+    @staticmethod
+    def from_dict(data: dict) -> 'JobCheckpoint':
+        return JobCheckpoint(**{**data, "request": CreateIndexRequest(**data["request"])})
+
+
+class CheckpointStore:
+    """
+    Keeps the progress of every job in a JSON file of the checkpoint directory, along with the downloaded
+    vectors and the built index of the job, so that the jobs which were running when the worker died can be
+    resumed when it restarts. A resumed job skips the stages it finished, downloads only the missing byte
+    ranges of its vectors and continues the multipart upload of its index with the parts already uploaded.
+
+    The checkpoint of a job is deleted once the job completes or fails, so only the jobs interrupted by a
+    crash of the worker are resumed. The files are not synced to disk, so the checkpoints survive a crash of
+    the worker process, but not of the host.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, job_id: str, create_index_request: CreateIndexRequest) -> JobCheckpoint:
+        """Returns the checkpoint of the job, which is created when the job has none"""
+        checkpoint_path = self._path(job_id, "json")
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                return JobCheckpoint.from_dict(json.load(f))
+        checkpoint = JobCheckpoint(job_id=job_id, request=create_index_request,
+                                   vector_file=self._path(job_id, "vectors"))
+        self._save(checkpoint)
+        return checkpoint
+
+    def load_all(self) -> List[JobCheckpoint]:
+        """Returns the checkpoints of the jobs which didn't finish"""
+        checkpoints = []
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, file_name)) as f:
+                    checkpoints.append(JobCheckpoint.from_dict(json.load(f)))
+            except Exception as e:
+                logger.error(f"Ignoring the invalid checkpoint {file_name}: {e}")
+        return checkpoints
+
+    def mark_range_downloaded(self, checkpoint: JobCheckpoint, start_byte: int, end_byte: int):
+        with self._lock:
+            checkpoint.downloaded_ranges.append([start_byte, end_byte])
+            self._save(checkpoint)
+
+    def mark_downloaded(self, checkpoint: JobCheckpoint):
+        with self._lock:
+            checkpoint.stage = BUILD_STAGE
+            self._save(checkpoint)
+
+    def index_file_path(self, checkpoint: JobCheckpoint) -> str:
+        return self._path(checkpoint.job_id, "index")
+
+    def mark_built(self, checkpoint: JobCheckpoint, index_file_path: str):
+        """Record the finished index file, the downloaded vectors are not needed anymore"""
+        with self._lock:
+            checkpoint.stage = UPLOAD_STAGE
+            checkpoint.index_file_path = index_file_path
+            self._save(checkpoint)
+        cleanup_temp_file(checkpoint.vector_file)
+
+    def mark_upload_created(self, checkpoint: JobCheckpoint, upload_id: str, part_size: int):
+        with self._lock:
+            checkpoint.upload_id = upload_id
+            checkpoint.part_size = part_size
+            checkpoint.uploaded_parts = []
+            self._save(checkpoint)
+
+    def mark_part_uploaded(self, checkpoint: JobCheckpoint, part: dict):
+        with self._lock:
+            checkpoint.uploaded_parts.append(part)
+            self._save(checkpoint)
+
+    def delete(self, checkpoint: JobCheckpoint):
+        """Remove the checkpoint of a finished job along with its files"""
+        with self._lock:
+            cleanup_temp_file(self._path(checkpoint.job_id, "json"))
+        cleanup_temp_file(checkpoint.vector_file)
+        if checkpoint.index_file_path is not None:
+            cleanup_temp_file(checkpoint.index_file_path)
+
+    def _path(self, job_id: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.{extension}")
+
+    def _save(self, checkpoint: JobCheckpoint):
+        # Write the checkpoint to a temp file first, so a crash while saving keeps the previous checkpoint
+        checkpoint_path = self._path(checkpoint.job_id, "json")
+        with open(f"{checkpoint_path}.tmp", "w") as f:
+            json.dump(checkpoint.to_dict(), f)
+        os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
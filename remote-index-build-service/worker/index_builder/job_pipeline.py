@@ -0,0 +1,95 @@
+import logging
+import queue
+import threading
+import traceback
+from dataclasses import dataclass, field
+from timeit import default_timer as timer
+from typing import Callable, Dict, Any
+
+from models.data_model import CreateIndexRequest
+from utils.cancellation import CancellationToken, JobCancelledError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PipelineJob:
+    id: str
+    request: CreateIndexRequest
+    # Output of a stage which is consumed by the next stage, like the downloaded dataset or the index file
+    state: Dict[str, Any] = field(default_factory=dict)
+    stats: Dict[str, Any] = field(default_factory=dict)
+    queue_wait: Dict[str, float] = field(default_factory=dict)
+    enqueued_at: float = 0
+    cancellation: CancellationToken = field(default_factory=CancellationToken)
+
+
+class PipelineStage:
+    """
+    A stage of the pipeline with its own pool of threads. Jobs wait for a free thread in a bounded queue, once
+    the queue is full the previous stage blocks until this stage catches up. The time each job waited in the
+    queue is recorded under the stage name. A job which is cancelled while it waits in the queue is not processed.
+    """
+
+    def __init__(self, name: str, process: Callable[[PipelineJob], None], concurrency: int, queue_size: int = 0):
+        self.name = name
+        self.process = process
+        self.next_stage: 'PipelineStage' = None
+        self.on_failure: Callable[[PipelineJob, Exception], None] = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._running = 0
+        self._lock = threading.Lock()
+        for i in range(concurrency):
+            threading.Thread(target=self._work, name=f"{name}-stage-{i}", daemon=True).start()
+
+    def put(self, job: PipelineJob):
+        job.enqueued_at = timer()
+        self._queue.put(job)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {"queue_depth": self._queue.qsize(), "running": self._running}
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.queue_wait[self.name] = timer() - job.enqueued_at
+            with self._lock:
+                self._running += 1
+            try:
+                if job.cancellation.is_cancelled():
+                    raise JobCancelledError(f"Job {job.id} was cancelled before the {self.name} stage")
+                self.process(job)
+            except JobCancelledError as e:
+                logger.info(f"Stopped job {job.id} in the {self.name} stage: {e}")
+                self.on_failure(job, e)
+                continue
+            except Exception as e:
+                logger.error(f"Error in {self.name} stage for job {job.id}: {e} {traceback.format_exc()}")
+                self.on_failure(job, e)
+                continue
+            finally:
+                with self._lock:
+                    self._running -= 1
+            if self.next_stage is not None:
+                self.next_stage.put(job)
+
+
+class IndexingPipeline:
+    """
+    Chains the stages of the indexing jobs so that different jobs can be in different stages at the same time,
+    e.g. job N+1 downloads while job N builds and job N-1 uploads.
+    """
+
+    def __init__(self, stages: list, on_failure: Callable[[PipelineJob, Exception], None]):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+        for stage in stages:
+            stage.on_failure = on_failure
+
+    def submit(self, job: PipelineJob):
+        self.stages[0].put(job)
+
+    def get_stats(self) -> dict:
+        return {stage.name: stage.get_stats() for stage in self.stages}
@@ -0,0 +1,175 @@
+import logging
+import os
+import re
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Dict
+
+import numpy as np
+
+from models.data_model import CreateIndexRequest, VECTOR_DATA_TYPES
+from utils.common import get_omp_num_threads, get_total_memory
+
+logger = logging.getLogger(__name__)
+
+# Size of an id in bytes, the size of a vector depends on the vector data type of the request
+ID_SIZE = 8
+# Default number of neighbours of a node in the HNSW graph, the base layer keeps 2 * m neighbours of 4 bytes
+DEFAULT_HNSW_M = 16
+GRAPH_BYTES_PER_NEIGHBOUR = 2 * 4
+# Number of neighbours of the HNSW graph of a factory string which doesn't set it, like HNSW,SQ8
+DEFAULT_FACTORY_HNSW_M = 32
+# Extra per vector bytes of the graph, like the levels and the offsets of the neighbour lists
+GRAPH_OVERHEAD_PER_VECTOR = 16
+# Fraction of the physical memory which can be reserved by the jobs, the rest is left for the OS and the service
+MEMORY_BUDGET_FRACTION = 0.8
+
+
+def get_hnsw_m(create_index_request: CreateIndexRequest) -> int:
+    """Returns the number of neighbours of a node in the HNSW graph built for the request"""
+    index_parameters = create_index_request.indexParameters or {}
+    factory_string = index_parameters.get("factory_string")
+    if factory_string is not None:
+        m = re.match(r"HNSW(\d*)", factory_string).group(1)
+        return int(m) if m else DEFAULT_FACTORY_HNSW_M
+    return index_parameters.get("m") or DEFAULT_HNSW_M
+
+
+def estimate_job_memory(create_index_request: CreateIndexRequest) -> int:
+    """
+    Estimate the peak memory in bytes needed to build the index for the request. This is the size of the
+    vectors and their ids, plus the size of the graph built on top of them.
+    """
+    number_of_vectors = create_index_request.numberOfVectors
+    vectors_size = number_of_vectors * create_index_request.get_vector_size()
+    ids_size = number_of_vectors * ID_SIZE
+    graph_size = number_of_vectors * (GRAPH_BYTES_PER_NEIGHBOUR * get_hnsw_m(create_index_request) + GRAPH_OVERHEAD_PER_VECTOR)
+    return vectors_size + ids_size + graph_size
+
+
+def get_memory_model() -> dict:
+    """
+    The per vector terms of estimate_job_memory, which the worker advertises in its capabilities so that the
+    coordinator estimates the memory of a job the same way as the worker it places the job on. A binary vector
+    element is 1 bit.
+    """
+    return {
+        "vector_element_sizes": {data_type: np.dtype(dtype).itemsize / (8 if data_type == 'binary' else 1)
+                                 for data_type, dtype in VECTOR_DATA_TYPES.items()},
+        "id_size": ID_SIZE,
+        "graph_bytes_per_neighbour": GRAPH_BYTES_PER_NEIGHBOUR,
+        "graph_overhead_per_vector": GRAPH_OVERHEAD_PER_VECTOR,
+        "default_hnsw_m": DEFAULT_HNSW_M,
+        "default_factory_hnsw_m": DEFAULT_FACTORY_HNSW_M
+    }
+
+
+@dataclass
+class JobReservation:
+    memory: int
+    threads: int = 0
+
+
+class JobScheduler:
+    """
+    Admits several indexing jobs at once, as long as they fit in the memory and thread budget of the worker.
+
+    Jobs are admitted in the order they are submitted. A job is admitted when its estimated memory fits in the
+    memory which is not reserved by the admitted jobs. A job which is bigger than the whole memory budget is only
+    admitted when no other job is admitted, so that it is not starved forever. The memory stays reserved from the
+    download of the vectors until the index is built, when release is called.
+
+    The threads are split evenly across the jobs which can build at the same time, a job gets its share of the
+    thread budget capped by the threads which are still free when its build starts. As the threads of a running
+    build can't be taken back, a build starting when all the threads are reserved still gets 1 thread so that it
+    can make progress.
+    """
+
+    def __init__(self, start_job: Callable[[str, CreateIndexRequest], None], memory_budget: int = None,
+                 thread_budget: int = None, max_concurrent_jobs: int = None, max_concurrent_builds: int = None):
+        self._start_job = start_job
+        self.memory_budget = memory_budget if memory_budget is not None else int(get_total_memory() * MEMORY_BUDGET_FRACTION)
+        self.thread_budget = thread_budget if thread_budget is not None else get_omp_num_threads()
+        self.max_concurrent_builds = max_concurrent_builds if max_concurrent_builds is not None else self.thread_budget
+        self.max_concurrent_jobs = max_concurrent_jobs if max_concurrent_jobs is not None else self.max_concurrent_builds
+        self._pending = deque()
+        self._admitted: Dict[str, JobReservation] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job_id: str, create_index_request: CreateIndexRequest):
+        with self._lock:
+            self._pending.append((job_id, create_index_request))
+        self._admit_jobs()
+
+    def allocate_threads(self, job_id: str) -> int:
+        """Reserve the threads of an admitted job when its build starts, and return the number of threads"""
+        with self._lock:
+            free_threads = self.thread_budget - self._reserved_threads()
+            concurrent_builds = min(self.max_concurrent_builds, len(self._admitted))
+            threads = max(min(free_threads, self.thread_budget // max(concurrent_builds, 1)), 1)
+            self._admitted[job_id].threads = threads
+            return threads
+
+    def release(self, job_id: str):
+        """Release the memory and threads of a job once its index is built, or once it failed"""
+        with self._lock:
+            self._admitted.pop(job_id, None)
+        self._admit_jobs()
+
+    def cancel(self, job_id: str) -> bool:
+        """Drop a job which is not admitted yet, returns False when the job is not waiting to be admitted"""
+        with self._lock:
+            for pending_job in self._pending:
+                if pending_job[0] == job_id:
+                    self._pending.remove(pending_job)
+                    break
+            else:
+                return False
+        # The dropped job could have been holding back the jobs queued behind it
+        self._admit_jobs()
+        return True
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "queue_depth": len(self._pending),
+                "running_jobs": {job_id: reservation.__dict__ for job_id, reservation in self._admitted.items()},
+                "memory_budget": self.memory_budget,
+                "memory_reserved": self._reserved_memory(),
+                "thread_budget": self.thread_budget,
+                "threads_reserved": self._reserved_threads()
+            }
+
+    def _reserved_memory(self) -> int:
+        return sum(reservation.memory for reservation in self._admitted.values())
+
+    def _reserved_threads(self) -> int:
+        return sum(reservation.threads for reservation in self._admitted.values())
+
+    def _admit_jobs(self):
+        admitted_jobs = []
+        with self._lock:
+            while len(self._pending) > 0 and len(self._admitted) < self.max_concurrent_jobs:
+                job_id, create_index_request = self._pending[0]
+                memory = estimate_job_memory(create_index_request)
+                free_memory = self.memory_budget - self._reserved_memory()
+                if memory > free_memory and len(self._admitted) > 0:
+                    break
+                self._pending.popleft()
+                self._admitted[job_id] = JobReservation(memory=memory)
+                logger.info(f"Admitted job {job_id} with estimated memory {memory} bytes")
+                admitted_jobs.append((job_id, create_index_request))
+        for job_id, create_index_request in admitted_jobs:
+            self._start_job(job_id, create_index_request)
+
+
+def build_job_scheduler(start_job: Callable[[str, CreateIndexRequest], None], max_concurrent_builds: int,
+                        max_concurrent_jobs: int) -> JobScheduler:
+    memory_budget = os.getenv('WORKER_MEMORY_BUDGET_BYTES')
+    return JobScheduler(
+        start_job,
+        memory_budget=int(memory_budget) if memory_budget is not None else None,
+        max_concurrent_jobs=max_concurrent_jobs,
+        max_concurrent_builds=max_concurrent_builds
+    )
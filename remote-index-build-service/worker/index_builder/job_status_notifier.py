@@ -0,0 +1,84 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import urllib3
+
+from index_builder.job_store import JobDetails
+
+logger = logging.getLogger(__name__)
+
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+
+
+class JobStatusNotifier:
+    """
+    Pushes the status changes of the jobs of the worker to the coordinator, so that the coordinator doesn't have
+    to poll the workers for the status of their jobs.
+
+    The changes are sent in order by a background thread. Only the latest state of a job which is waiting to be
+    sent is kept, and the changes which could not be sent, like while the coordinator restarts, are retried with
+    an exponential backoff until they are delivered. When the coordinator doesn't know the worker, like when the
+    worker pushes before it registered or after the coordinator restarted, the worker registers again with
+    register_worker before the change is sent again. Only the changes the coordinator rejects as invalid are dropped.
+    """
+
+    def __init__(self, coordinator_protocol: str, coordinator_host: str, coordinator_port: int, worker_url: str,
+                 worker_port: int, register_worker: Callable[[], None] = None):
+        self.worker_url = worker_url
+        self.worker_port = worker_port
+        self.register_worker = register_worker
+        self._pool = urllib3.connection_from_url(f"{coordinator_protocol}://{coordinator_host}:{coordinator_port}",
+                                                 maxsize=1, timeout=5, retries=False)
+        self._pending: "OrderedDict[str, dict]" = OrderedDict()
+        self._condition = threading.Condition()
+        threading.Thread(target=self._send_forever, name="job-status-notifier", daemon=True).start()
+
+    def notify(self, job: JobDetails):
+        job_status = job.to_dict()
+        with self._condition:
+            self._pending[job.id] = {
+                "job_id": job.id,
+                "status": job_status["status"],
+                "result": job_status["result"],
+                "error": job_status["error"],
+                "workerURL": self.worker_url,
+                "workerPort": self.worker_port
+            }
+            self._pending.move_to_end(job.id)
+            self._condition.notify()
+
+    def _send_forever(self):
+        failures = 0
+        while True:
+            with self._condition:
+                while len(self._pending) == 0:
+                    self._condition.wait()
+                job_id, job_status = self._pending.popitem(last=False)
+            try:
+                response = self._pool.request("POST", "/job_status", body=json.dumps(job_status, default=lambda o: o.__dict__),
+                                              headers={'Content-Type': 'application/json'})
+                if response.status == 409:
+                    if self.register_worker is not None:
+                        self.register_worker()
+                    raise Exception(f"HTTP {response.status}, the worker was not registered with the coordinator")
+                if response.status == 400:
+                    # Sending the same change again would be rejected again
+                    logger.error(f"The coordinator rejected the status of job {job_id} : {response.data}")
+                elif response.status >= 300:
+                    raise Exception(f"HTTP {response.status}")
+                failures = 0
+            except Exception as e:
+                with self._condition:
+                    # A newer state of the job could have been queued while this one was sent
+                    if job_id not in self._pending:
+                        self._pending[job_id] = job_status
+                        self._pending.move_to_end(job_id, last=False)
+                failures += 1
+                delay = min(RETRY_BASE_DELAY * 2 ** (failures - 1), RETRY_MAX_DELAY)
+                logger.warning(f"Error pushing the status of job {job_id} to the coordinator, retrying in {delay}s : {e}")
+                time.sleep(delay)
@@ -0,0 +1,150 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Tuple
+
+from models.data_model import CreateIndexRequest
+
+logger = logging.getLogger(__name__)
+
+# Jobs in these states will not change anymore, so they can be evicted from memory
+TERMINAL_STATUSES = ["completed", "failed", "cancelled"]
+
+
+@dataclass(slots=True)
+class JobDetails:
+    id: str
+    status: str
+    error: str = None
+    result: Any = None
+    request: CreateIndexRequest = None
+    # Progress of the build of the index, like the percent of the vectors added, while the job is running
+    progress: dict = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "result": _to_dict(self.result),
+            "request": _to_dict(self.request),
+            "progress": self.progress,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> 'JobDetails':
+        return JobDetails(**data)
+
+
+def _to_dict(value):
+    if value is None or isinstance(value, dict):
+        return value
+    return value.__dict__
+
+
+class JobStore:
+    """
+    Keeps the details of the jobs of the worker with a bounded retention.
+
+    The jobs are kept in memory in least recently updated order. Finished jobs are evicted when they are older than
+    the TTL, or when there are more than max_jobs jobs in memory. Evicted jobs are spilled to a local SQLite file
+    when a path is provided, and dropped otherwise. Jobs which are still queued or running are never evicted.
+    """
+
+    def __init__(self, max_jobs: int = 1000, ttl_seconds: float = 24 * 60 * 60, sqlite_path: str = None):
+        self.max_jobs = max_jobs
+        self.ttl_seconds = ttl_seconds
+        self._jobs: "OrderedDict[str, JobDetails]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if sqlite_path is not None:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, created_at REAL, updated_at REAL, details TEXT)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            self._db.commit()
+
+    def put(self, job: JobDetails):
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict()
+
+    def update(self, job_id: str, **kwargs):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            for key, value in kwargs.items():
+                setattr(job, key, value)
+            job.updated_at = time.time()
+            self._jobs.move_to_end(job_id)
+            self._evict()
+
+    def get(self, job_id: str) -> Optional[JobDetails]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None or self._db is None:
+                return job
+            row = self._db.execute("SELECT details FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return JobDetails.from_dict(json.loads(row[0])) if row is not None else None
+
+    def query(self, status: str = None, offset: int = 0, limit: int = 100) -> Tuple[List[JobDetails], int]:
+        """
+        Returns a page of the jobs, newest first, optionally filtered by status, along with the total number of jobs
+        matching the filter. The jobs in memory come before the spilled jobs, which are older.
+        """
+        with self._lock:
+            jobs = [job for job in self._jobs.values() if status is None or job.status == status]
+            jobs.sort(key=lambda job: job.created_at, reverse=True)
+            page = jobs[offset:offset + limit]
+            total = len(jobs)
+            if self._db is None:
+                return page, total
+
+            where, args = ("WHERE status = ?", (status,)) if status is not None else ("", ())
+            total += self._db.execute(f"SELECT COUNT(*) FROM jobs {where}", args).fetchone()[0]
+            remaining = limit - len(page)
+            if remaining > 0:
+                spilled_offset = max(offset - len(jobs), 0)
+                rows = self._db.execute(
+                    f"SELECT details FROM jobs {where} ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                    args + (remaining, spilled_offset)
+                ).fetchall()
+                page += [JobDetails.from_dict(json.loads(row[0])) for row in rows]
+            return page, total
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def _evict(self):
+        # The jobs are in least recently updated order, so the expired jobs are at the front
+        expire_before = time.time() - self.ttl_seconds
+        evicted_ids = []
+        for job_id, job in self._jobs.items():
+            if job.updated_at >= expire_before and len(self._jobs) - len(evicted_ids) <= self.max_jobs:
+                break
+            if job.status in TERMINAL_STATUSES:
+                evicted_ids.append(job_id)
+        if len(evicted_ids) == 0:
+            return
+        evicted = [self._jobs.pop(job_id) for job_id in evicted_ids]
+        if self._db is None:
+            return
+        self._db.executemany(
+            "INSERT OR REPLACE INTO jobs (id, status, created_at, updated_at, details) VALUES (?, ?, ?, ?, ?)",
+            [(job.id, job.status, job.created_at, job.updated_at, json.dumps(job.to_dict()))
+             for job in evicted if job.updated_at >= expire_before]
+        )
+        self._db.execute("DELETE FROM jobs WHERE updated_at < ?", (expire_before,))
+        self._db.commit()
+        logger.debug(f"Evicted {len(evicted)} jobs from memory to the job store file")
@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Size of the blocks of rows normalized at once, which fit in the L2 cache of a core so that the scaling of a block
+# reads the rows its norms were computed from out of the cache
+NORMALIZE_BLOCK_BYTES = 256 * 1024 # 256KB
+
+
+def normalize_in_place(vectors: np.ndarray, num_threads: int = 1, block_bytes: int = NORMALIZE_BLOCK_BYTES):
+    """
+    Scale the rows of 2D float32 vectors to a unit L2 norm in place, the rows with a norm of 0 are left as they are.
+    The rows are normalized in blocks of block_bytes split across num_threads threads, numpy releases the GIL while
+    it computes, and only the norms of a block are allocated.
+    """
+    if len(vectors) == 0:
+        return
+    rows_per_block = max(block_bytes // vectors[0].nbytes, 1)
+
+    def normalize_block(start):
+        block = vectors[start:start + rows_per_block]
+        norms = np.sqrt(np.einsum('ij,ij->i', block, block))
+        norms[norms == 0] = 1
+        block /= norms[:, None]
+
+    blocks = range(0, len(vectors), rows_per_block)
+    if num_threads <= 1 or len(blocks) == 1:
+        for start in blocks:
+            normalize_block(start)
+        return
+    with ThreadPoolExecutor(max_workers=min(num_threads, len(blocks))) as executor:
+        # Consume the results to raise the errors of the blocks
+        list(executor.map(normalize_block, blocks))
+
+
+def normalized(vectors: np.ndarray, num_threads: int = 1) -> np.ndarray:
+    """
+    Returns the float32 vectors normalized in place, or normalized in a copy when they can't be written, like a slice
+    of read only memory mapped vectors. Only the vectors passed in, e.g. an add batch, are ever copied, the whole
+    memory mapped vectors should be mapped writable first, see VectorsDataset.get_writable_vectors.
+    """
+    if not vectors.flags.writeable:
+        vectors = np.array(vectors)
+    normalize_in_place(vectors, num_threads)
+    return vectors
@@ -1,56 +1,179 @@
-from models.data_model import CreateIndexRequest, IndexTypes
+from models.data_model import CPU_INDEX_PARAMETERS, CreateIndexRequest, IndexTypes, IndexUploadModes
 from utils.decorators.timer import timer_func
-from vector_data_accessor.accessor import VectorsDataset
-from s3.s3client import upload_file, cleanup_temp_file
+from utils.cancellation import CancellationToken
+from utils.common import get_peak_rss
+from utils.compression import CompressedWriter, get_extension
+from vector_data_accessor.accessor import VectorsDataset, ingestion_mode
+from s3.s3client import upload_file, cleanup_temp_file, MultipartUploadStream, get_part_size
+from index_builder.job_scheduler import estimate_job_memory
 import logging
+from typing import Callable
 from timeit import default_timer as timer
 import os
+import tempfile
 
 logger = logging.getLogger(__name__)
 # Since this is an env property lets init this during the start of the service
 build_type = os.getenv('INDEX_BUILD_TYPE', 'cpu')
 index_type = IndexTypes.from_str(build_type.lower())
+# With stream the index is uploaded to S3 while it is serialized, rather than written to a temp file first
+index_upload_mode = IndexUploadModes.from_str(os.getenv('INDEX_UPLOAD_MODE', 'stream').lower())
+# Level of the compression of the index files of the requests which set an index_compression, the default of the
+# compression when not set
+index_compression_level = int(os.getenv('INDEX_COMPRESSION_LEVEL')) if os.getenv('INDEX_COMPRESSION_LEVEL') else None
 
-@timer_func
-def build_index_and_upload_index(createIndexRequest: CreateIndexRequest):
-    logger.info(f"Building index... with input: {createIndexRequest}")
+def download_vectors(createIndexRequest: CreateIndexRequest, vector_file: str = None, completed_ranges=None,
+                     on_range_done=None, cancellation: CancellationToken = None):
+    """
+    Download the vectors of the request. vector_file, completed_ranges and on_range_done resume a partial
+    download, see VectorsDataset.get_vector_dataset
+    """
     t1 = timer()
-    dataset = VectorsDataset.get_vector_dataset(createIndexRequest)
+    dataset = VectorsDataset.get_vector_dataset(createIndexRequest, vector_file, completed_ranges, on_range_done,
+                                                cancellation)
     t2 = timer()
     stats = {
         "download_stats": {
+            **dataset.download_stats,
             "time": t2 - t1, "unit": "seconds"
         }
     }
-    index_file_path, index_file, create_index_stats = create_index(dataset, createIndexRequest)
-    t1 = timer()
-    upload_file(file_path=index_file_path, object_key=index_file,  bucket_name=createIndexRequest.bucketName)
-    cleanup_temp_file(temp_file_path=index_file_path)
-    t2 = timer()
-    stats["upload_stats"] = {
-        "time": t2 - t1, "unit": "seconds"
+    return dataset, stats
+
+def build_memory_stats(peak_rss_before: int, dataset_size: int, index_size: int):
+    peak_rss_after = get_peak_rss()
+    # Peak RSS is tracked for the whole process, so the increase is the memory this job needed on top of
+    # the earlier peak. This is what should be used to size the instances for an ingestion mode.
+    # The jobs built at the same time share the peak, the job memory is the memory of this job alone: the bytes of
+    # its vectors and ids along with the bytes of its index.
+    return {
+        "ingestion_mode": ingestion_mode.value,
+        "peak_rss_before": peak_rss_before,
+        "peak_rss_after": peak_rss_after,
+        "peak_rss_increase": peak_rss_after - peak_rss_before,
+        "dataset_size": dataset_size,
+        "index_size": index_size,
+        "job_memory": dataset_size + index_size if index_size is not None else None,
+        "unit": "bytes"
     }
+
+def validate_create_index_request(createIndexRequest: CreateIndexRequest):
+    """
+    Raise ValueError when the builder of the worker can't build the index of the request, so that the request is
+    rejected before a job is created, rather than the job failing once its vectors are downloaded
+    """
+    if index_type == IndexTypes.CPU:
+        from index_builder.cpu.create_cpu_index import validate_request
+        validate_request(createIndexRequest)
+        return
+    cpu_parameters = [name for name in CPU_INDEX_PARAMETERS if name in createIndexRequest.indexParameters]
+    if len(cpu_parameters) > 0:
+        raise ValueError(f"index_parameters {cpu_parameters} are only supported by the CPU builds")
+    if createIndexRequest.vectorDataType == "binary":
+        raise ValueError("Binary vectors are only supported by the CPU builds")
+
+def upload_index(index_destination, index_file: str, createIndexRequest: CreateIndexRequest,
+                 cancellation: CancellationToken = None, **resume_options):
+    """
+    Upload the index file written by create_index. When the index was streamed, its parts are already uploaded
+    or uploading, so this only waits for the last parts and completes the upload. The resume_options of
+    upload_file resume the upload of an index file. The upload of a cancelled job is aborted.
+    """
+    if isinstance(index_destination, MultipartUploadStream):
+        upload_stats = index_destination.close()
+        logger.info(f"Index stream uploaded for request: {createIndexRequest}")
+        return upload_stats
+    upload_stats = upload_file(file_path=index_destination, object_key=index_file,  bucket_name=createIndexRequest.bucketName,
+                               cancellation=cancellation, **resume_options)
+    cleanup_temp_file(temp_file_path=index_destination)
     logger.info(f"Index file uploaded for request: {createIndexRequest}")
-    stats["create_index"] = create_index_stats
-    return index_file, stats
+    return upload_stats
+
+def discard_index(index_destination):
+    """Remove the index file, or abort the upload of the index stream, of a failed job"""
+    if isinstance(index_destination, MultipartUploadStream):
+        index_destination.abort()
+    else:
+        cleanup_temp_file(temp_file_path=index_destination)
 
 @timer_func
-def create_index(dataset: VectorsDataset, createIndexRequest:CreateIndexRequest):
-    index_file = f"{createIndexRequest.objectLocation}.faiss"
-    index_file_path = "/tmp/"
+def create_index(dataset: VectorsDataset, createIndexRequest:CreateIndexRequest, num_threads: int = None,
+                 index_file_path: str = None, cancellation: CancellationToken = None,
+                 on_progress: Callable[[int, int], None] = None):
+    """
+    Build the index of the dataset and write it to its destination, which is returned along with the index file
+    key and the build stats. The destination is a MultipartUploadStream when the index is streamed to S3, and
+    the path of a temp file otherwise, or index_file_path when it is set. Either way it should be passed to
+    upload_index or to discard_index. The build stops with JobCancelledError once the job is cancelled.
+    on_progress is called with the number of vectors added to the index so far and the total number of vectors.
+
+    When the request sets an index_compression the index is compressed while it is serialized, before it is written
+    to its destination.
+    """
+    index_file = get_index_file(createIndexRequest)
+    if index_file_path is not None:
+        index_destination = index_file_path
+    elif index_upload_mode == IndexUploadModes.STREAM:
+        # The size of the index is not known before it is written, the estimated memory of the build is an upper
+        # bound of it, which keeps the parts of big indexes under the S3 part count limit
+        part_size = get_part_size(estimate_job_memory(createIndexRequest))
+        index_destination = MultipartUploadStream(createIndexRequest.bucketName, index_file, part_size=part_size,
+                                                  cancellation=cancellation)
+    else:
+        # Several jobs can build an index for the same object at the same time, so every job writes its own temp file
+        index_destination = _create_index_temp_file(index_file)
     space_type = createIndexRequest.spaceType
     create_index_stats = {}
-    if index_type == IndexTypes.CPU:
-        from index_builder.cpu.create_cpu_index import create_index
-        index_file = f"{index_file}.{index_type.value}"
-        index_file_path = index_file_path + index_file
-        hnsw_params = {}
-        create_index_stats = create_index(dataset, hnsw_params, space_type, index_file_path)
-    elif index_type == IndexTypes.GPU:
-        index_file = f"{index_file}.{index_type.value}"
-        index_file_path = index_file_path + index_file
-        indexing_params = {}
-        from index_builder.gpu.create_gpu_index import create_index
-        create_index_stats = create_index(dataset, indexing_params, space_type, index_file_path)
+    index_file_handle = None
+    try:
+        build_destination = index_destination
+        if createIndexRequest.indexCompression is not None:
+            if isinstance(index_destination, str):
+                index_file_handle = open(index_destination, 'wb')
+            build_destination = CompressedWriter(index_file_handle or index_destination,
+                                                 createIndexRequest.indexCompression, index_compression_level,
+                                                 threads=num_threads or 0)
+        if index_type == IndexTypes.CPU:
+            from index_builder.cpu.create_cpu_index import create_index
+            hnsw_params = createIndexRequest.indexParameters
+            create_index_stats = create_index(dataset, hnsw_params, space_type, build_destination, num_threads,
+                                              cancellation, on_progress)
+        elif index_type == IndexTypes.GPU:
+            indexing_params = createIndexRequest.indexParameters
+            from index_builder.gpu.create_gpu_index import create_index
+            create_index_stats = create_index(dataset, indexing_params, space_type, build_destination, num_threads,
+                                              cancellation, on_progress)
+        if isinstance(build_destination, CompressedWriter):
+            build_destination.close()
+            create_index_stats.update(compression_stats(build_destination))
+    except Exception:
+        if index_file_handle is not None:
+            index_file_handle.close()
+        discard_index(index_destination)
+        raise
+    if index_file_handle is not None:
+        index_file_handle.close()
     logger.info(f"Stats for the create Index request: {createIndexRequest} is : {create_index_stats}")
-    return index_file_path, index_file, create_index_stats
\ No newline at end of file
+    return index_destination, index_file, create_index_stats
+
+def compression_stats(writer: CompressedWriter) -> dict:
+    return {
+        "indexCompression": writer.compression,
+        "compressedIndexFileSize": writer.compressed_size,
+        "indexCompressionRatio": writer.size / writer.compressed_size if writer.compressed_size > 0 else 0
+    }
+
+def get_index_file(createIndexRequest: CreateIndexRequest) -> str:
+    """
+    Returns the key of the index file of the request, the index file of a shard is named after its vector range and
+    a compressed index file has the extension of its compression
+    """
+    extension = get_extension(createIndexRequest.indexCompression) if createIndexRequest.indexCompression else ""
+    if createIndexRequest.is_shard():
+        end = createIndexRequest.vectorOffset + createIndexRequest.numberOfVectors
+        return f"{createIndexRequest.objectLocation}.{createIndexRequest.vectorOffset}-{end}.faiss.{index_type.value}{extension}"
+    return f"{createIndexRequest.objectLocation}.faiss.{index_type.value}{extension}"
+
+def _create_index_temp_file(index_file: str) -> str:
+    with tempfile.NamedTemporaryFile(delete=False, prefix="index-", suffix=f"-{os.path.basename(index_file)}") as f:
+        return f.name
@@ -1,9 +1,55 @@
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 
+import numpy as np
+from utils.compression import COMPRESSIONS
+
 logger = logging.getLogger(__name__)
 
+# The numpy dtypes of the elements of the vectors of each vector data type, which are little-endian as they are written
+# by Java applications. A binary vector packs 8 dimensions per byte
+VECTOR_DATA_TYPES = {
+    'float32': '<f4',
+    'float16': '<f2',
+    'uint8': 'u1',
+    'int8': 'i1',
+    'binary': 'u1'
+}
+
+# The space types of the vectors. cosinesimil vectors are normalized before they are added to an inner product index,
+# and hamming is the space of the binary vectors
+SPACE_TYPES = ['l2', 'innerproduct', 'cosinesimil', 'hamming']
+
+# The build parameters which can be set per request, with the type and the minimum and maximum of their values, the
+# minimum of a float is exclusive. The builders use their defaults for the parameters which are not set, see
+# CPU_INDEX_PARAMETERS for the parameters of the other builder
+INDEX_PARAMETERS = {
+    # HNSW graph of the CPU builds, efSearch is the default of the searches of the index
+    "m": (int, 2, 512),
+    "ef_construction": (int, 1, None),
+    "ef_search": (int, 1, None),
+    # Storage of the vectors in the HNSW index of the CPU builds, see Encoders. The pq encoder uses pq_dim and pq_bits
+    "encoder": (str, None, None),
+    # faiss index factory string of the CPU builds, like HNSW32,SQ8 or HNSW16,PQ8, which replaces HNSW<m>,Flat
+    "factory_string": (str, None, None),
+    # CAGRA graph of the GPU builds
+    "intermediate_graph_degree": (int, 1, None),
+    "graph_degree": (int, 1, None),
+    # IVF-PQ build of the CAGRA graph, pq_bits and pq_dim are also the codes of the pq encoder of the CPU builds
+    "n_lists": (int, 1, None),
+    "kmeans_n_iters": (int, 1, None),
+    "kmeans_trainset_fraction": (float, 0, None),
+    "pq_bits": (int, 4, 8),
+    "pq_dim": (int, 1, None),
+    "n_probes": (int, 1, None)
+}
+
+# The parameters of the HNSW graph and of the storage of the CPU builds, which the GPU builds reject as they can't
+# apply them. The GPU builds set ef_search on the HNSW index their CAGRA graph is converted to, and the CPU builds
+# ignore the CAGRA parameters
+CPU_INDEX_PARAMETERS = ["m", "ef_construction", "encoder", "factory_string"]
+
 @dataclass
 class CreateIndexRequest:
     bucketName: str
@@ -11,6 +57,37 @@ class CreateIndexRequest:
     numberOfVectors: int
     dimensions: int
     spaceType: str
+    # Key of the companion object with the ids of the vectors. When not set the ids are read from the
+    # trailing section of the vector object if present, otherwise the ids are 0 to numberOfVectors - 1
+    idObjectLocation: str = None
+    idDataType: str = 'int64'
+    # A shard of a bigger build indexes the numberOfVectors vectors starting at vectorOffset in an object of
+    # totalNumberOfVectors vectors. When not set the request indexes the whole object
+    vectorOffset: int = 0
+    totalNumberOfVectors: int = None
+    # Build parameters of the index, see INDEX_PARAMETERS
+    indexParameters: dict = field(default_factory=dict)
+    # Type of the elements of the vectors in the vector object, see VECTOR_DATA_TYPES
+    vectorDataType: str = 'float32'
+    # Compression of the uploaded index file, see utils.compression. The index is uploaded uncompressed when not set
+    indexCompression: str = None
+
+    def get_total_number_of_vectors(self) -> int:
+        return self.totalNumberOfVectors if self.totalNumberOfVectors is not None else self.numberOfVectors
+
+    def is_shard(self) -> bool:
+        return self.vectorOffset != 0 or self.numberOfVectors != self.get_total_number_of_vectors()
+
+    def get_vector_dtype(self) -> str:
+        return VECTOR_DATA_TYPES[self.vectorDataType]
+
+    def get_vector_width(self) -> int:
+        """Returns the number of elements of a vector in the vector object"""
+        return self.dimensions // 8 if self.vectorDataType == 'binary' else self.dimensions
+
+    def get_vector_size(self) -> int:
+        """Returns the size in bytes of a vector in the vector object"""
+        return self.get_vector_width() * np.dtype(self.get_vector_dtype()).itemsize
 
 @dataclass
 class CreateIndexResponse:
@@ -21,14 +98,95 @@ class CreateIndexResponse:
 def build_create_index_request(data: dict) -> CreateIndexRequest:
     if not all(key in data for key in ['bucket_name', 'object_location', 'number_of_vectors', 'dimensions', 'space_type']):
         raise ValueError("Missing required fields in JSON data")
+    id_data_type = data.get('id_data_type', 'int64')
+    if id_data_type not in ['int32', 'int64']:
+        raise ValueError(f"Unsupported id_data_type {id_data_type}, valid values are int32 and int64")
+    number_of_vectors = int(data['number_of_vectors'])
+    vector_offset = int(data.get('vector_offset', 0))
+    total_number_of_vectors = int(data['total_number_of_vectors']) if 'total_number_of_vectors' in data else None
+    if vector_offset < 0 or vector_offset + number_of_vectors > (total_number_of_vectors or vector_offset + number_of_vectors):
+        raise ValueError(f"The shard of {number_of_vectors} vectors at vector_offset {vector_offset} is out of the "
+                         f"{total_number_of_vectors} vectors of the object")
+    if data['space_type'] not in SPACE_TYPES:
+        raise ValueError(f"Unsupported space_type {data['space_type']}, valid values are {SPACE_TYPES}")
+    dimensions = int(data['dimensions'])
+    vector_data_type = data.get('vector_data_type', 'float32')
+    if vector_data_type not in VECTOR_DATA_TYPES:
+        raise ValueError(f"Unsupported vector_data_type {vector_data_type}, valid values are {list(VECTOR_DATA_TYPES)}")
+    index_parameters = build_index_parameters(data.get('index_parameters') or {}, dimensions)
+    index_compression = data.get('index_compression')
+    if index_compression is not None and index_compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported index_compression {index_compression}, valid values are {COMPRESSIONS}")
+    if vector_data_type == 'binary':
+        if dimensions % 8 != 0:
+            raise ValueError(f"The dimensions of binary vectors should be a multiple of 8, got {dimensions}")
+        # Binary vectors are compared bit by bit, and their index keeps them as they are
+        if data['space_type'] != 'hamming':
+            raise ValueError(f"Binary vectors only support the hamming space_type, got {data['space_type']}")
+        if index_parameters.get("factory_string") is not None or \
+                index_parameters.get("encoder", Encoders.FLAT.value) != Encoders.FLAT.value:
+            raise ValueError("Binary vectors can't be quantized with index_parameters.encoder or index_parameters.factory_string")
+    elif data['space_type'] == 'hamming':
+        raise ValueError(f"The hamming space_type is only supported for binary vectors, got {vector_data_type} vectors")
     return CreateIndexRequest(
         bucketName=data['bucket_name'],
         objectLocation=data['object_location'],
-        numberOfVectors=int(data['number_of_vectors']),
-        dimensions=int(data['dimensions']),
-        spaceType=data['space_type']
+        numberOfVectors=number_of_vectors,
+        dimensions=dimensions,
+        spaceType=data['space_type'],
+        idObjectLocation=data.get('id_object_location'),
+        idDataType=id_data_type,
+        vectorOffset=vector_offset,
+        totalNumberOfVectors=total_number_of_vectors,
+        indexParameters=index_parameters,
+        vectorDataType=vector_data_type,
+        indexCompression=index_compression
     )
 
+def build_index_parameters(index_parameters: dict, dimensions: int) -> dict:
+    """Validate the index_parameters block of a create index request, see INDEX_PARAMETERS"""
+    if not isinstance(index_parameters, dict):
+        raise ValueError(f"index_parameters should be an object, got {index_parameters}")
+    unknown_parameters = set(index_parameters) - set(INDEX_PARAMETERS)
+    if len(unknown_parameters) > 0:
+        raise ValueError(f"Unknown index_parameters {sorted(unknown_parameters)}, valid parameters are {list(INDEX_PARAMETERS)}")
+    validated = {}
+    for name, value in index_parameters.items():
+        if value is None:
+            continue
+        value_type, minimum, maximum = INDEX_PARAMETERS[name]
+        # bool is a subclass of int, and an int is a valid float
+        if isinstance(value, bool) or not isinstance(value, (int, float) if value_type == float else value_type):
+            raise ValueError(f"index_parameters.{name} should be of type {value_type.__name__}, got {value}")
+        if (minimum is not None and value < minimum) or (maximum is not None and value > maximum) or \
+                (value_type == float and value == minimum):
+            raise ValueError(f"index_parameters.{name} is out of range, got {value}")
+        validated[name] = value
+    factory_string = validated.get("factory_string")
+    if factory_string is not None:
+        # The index is searched as an HNSW graph, so the factory string should build one
+        if not factory_string.startswith("HNSW"):
+            raise ValueError(f"index_parameters.factory_string should build an HNSW index, got {factory_string}")
+        if "m" in validated:
+            raise ValueError("index_parameters.m can't be set along with index_parameters.factory_string")
+        if "encoder" in validated:
+            raise ValueError("index_parameters.encoder can't be set along with index_parameters.factory_string")
+    encoder = validated.get("encoder")
+    if encoder is not None and encoder not in Encoders.list():
+        raise ValueError(f"Unsupported index_parameters.encoder {encoder}, valid values are {Encoders.list()}")
+    if encoder == Encoders.PQ.value and dimensions % get_pq_dim(validated, dimensions) != 0:
+        raise ValueError(f"index_parameters.pq_dim should divide the {dimensions} dimensions for the pq encoder, got "
+                         f"{get_pq_dim(validated, dimensions)}")
+    if validated.get("graph_degree", 0) > validated.get("intermediate_graph_degree", float('inf')):
+        raise ValueError("index_parameters.graph_degree should not be bigger than index_parameters.intermediate_graph_degree")
+    if validated.get("pq_dim", 0) > dimensions:
+        raise ValueError(f"index_parameters.pq_dim should not be bigger than the {dimensions} dimensions")
+    return validated
+
+def get_pq_dim(index_parameters: dict, dimensions: int) -> int:
+    """Returns the number of PQ sub-vectors of the build, by default 1 for every 8 dimensions"""
+    return index_parameters.get("pq_dim") or max(dimensions // 8, 1)
+
 class ExtendedEnum(Enum):
 
     @classmethod
@@ -52,3 +210,51 @@ class IndexTypes(ExtendedEnum):
             return IndexTypes.GPU
         else:
             raise NotImplementedError
+
+
+class IngestionModes(ExtendedEnum):
+    # Download the vectors to a temp file and read them into memory
+    FILE = 'file'
+    # Download the vectors straight into memory without a temp file
+    STREAM = 'stream'
+    # Download the vectors to a temp file and memory map it
+    MMAP = 'mmap'
+
+    @staticmethod
+    def from_str(labelstr: str) -> 'IngestionModes':
+        for mode in IngestionModes:
+            if mode.value == labelstr:
+                return mode
+        raise NotImplementedError
+
+
+class IndexUploadModes(ExtendedEnum):
+    # Write the index to a temp file and upload the file
+    FILE = 'file'
+    # Upload the index while it is serialized
+    STREAM = 'stream'
+
+    @staticmethod
+    def from_str(labelstr: str) -> 'IndexUploadModes':
+        for mode in IndexUploadModes:
+            if mode.value == labelstr:
+                return mode
+        raise NotImplementedError
+
+
+class Encoders(ExtendedEnum):
+    # Full float32 vectors
+    FLAT = 'flat'
+    # 1 byte per dimension, with a scalar quantizer trained on the range of each dimension
+    SQ8 = 'sq8'
+    # 2 bytes per dimension, as float16
+    SQFP16 = 'sqfp16'
+    # pq_dim codes of pq_bits per vector, with a product quantizer trained on a sample of the vectors
+    PQ = 'pq'
+
+    @staticmethod
+    def from_str(labelstr: str) -> 'Encoders':
+        for encoder in Encoders:
+            if encoder.value == labelstr:
+                return encoder
+        raise NotImplementedError
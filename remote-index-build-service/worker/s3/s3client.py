@@ -1,5 +1,7 @@
 import traceback
+from concurrent.futures import FIRST_EXCEPTION, as_completed, wait
 from concurrent.futures.thread import ThreadPoolExecutor
+from timeit import default_timer as timer
 
 import boto3
 import os
@@ -7,9 +9,19 @@ import tempfile
 from pathlib import Path
 from botocore.exceptions import ClientError
 import math
+import mmap
+import contextlib
+import io
+import queue
+import random
+import threading
+import time
 
 import logging
 
+from utils.cancellation import CancellationToken, JobCancelledError, raise_if_cancelled
+from utils.compression import FramedDecoder
+
 # make this region dynamic later
 s3_client = boto3.client('s3', region_name="us-west-2")
 logger = logging.getLogger(__name__)
@@ -41,10 +53,50 @@ def check_s3_object_exists(bucket_name, object_key):
             return False
         raise
 
+def get_s3_object_size(bucket_name, object_key):
+    """
+    Get the size of an object in an S3 bucket.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        object_key (str): The key (path) of the object within the bucket.
+
+    Returns:
+        int: The size of the object in bytes, None if it doesn't exist.
+
+    Raises:
+        botocore.exceptions.ClientError: If there's an error other than 404
+    """
+    metadata = get_s3_object_metadata(bucket_name, object_key)
+    return metadata["size"] if metadata is not None else None
+
+def get_s3_object_metadata(bucket_name, object_key):
+    """
+    Get the size, the ETag and the Content-Encoding of an object in an S3 bucket.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        object_key (str): The key (path) of the object within the bucket.
+
+    Returns:
+        dict: The "size" in bytes, the "etag" and the "content_encoding" of the object, None if it doesn't exist.
+
+    Raises:
+        botocore.exceptions.ClientError: If there's an error other than 404
+    """
+    try:
+        response = s3_client.head_object(Bucket=bucket_name, Key=object_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] == '404':
+            return None
+        raise
+    return {"size": response['ContentLength'], "etag": response['ETag'],
+            "content_encoding": response.get('ContentEncoding')}
+
 def download_s3_file_in_chunks(bucket_name, object_key, chunk_size=1024*1024*10):  # 10MB chunks
     """
     Download a file from S3 in chunks and save to temp directory.
-    TODO: This is downloading the file in sequence. We will make this in parallel in next iteration
+    This is downloading the file in sequence, use download_s3_file_in_parallel for large objects.
     
     Args:
         bucket_name (str): The S3 bucket name
@@ -104,6 +156,365 @@ def download_s3_file_in_chunks(bucket_name, object_key, chunk_size=1024*1024*10)
         cleanup_temp_file(temp_file_path)
         raise
 
+"""
+download_max_workers: Maximum number of concurrent ranged GET requests
+download_range_size: Size of the byte range fetched by a single GET request (default 64MB)
+download_retries: Number of attempts for a single byte range before failing the download
+"""
+download_max_workers = int(os.getenv('S3_DOWNLOAD_MAX_WORKERS', max(os.cpu_count() - 2, 1)))
+download_range_size = int(os.getenv('S3_DOWNLOAD_RANGE_SIZE', 1024*1024*64)) # 64MB range
+download_retries = 3
+# A compressed object is decoded in order, so its ranges are buffered in memory until they are decoded. Smaller ranges
+# keep more of them downloading within the same memory
+compressed_download_range_size = int(os.getenv('S3_COMPRESSED_DOWNLOAD_RANGE_SIZE', 1024*1024*16)) # 16MB range
+download_max_in_flight_bytes = int(os.getenv('S3_DOWNLOAD_MAX_IN_FLIGHT_BYTES', 1024*1024*256)) # 256MB
+
+def download_s3_file_in_parallel(bucket_name, object_key, range_size=download_range_size,
+                                 max_workers=download_max_workers, chunk_size=1024*1024,  # 1MB reads
+                                 file_path=None, completed_ranges=None, on_range_done=None, start_byte=0, end_byte=None,
+                                 cancellation: CancellationToken = None):
+    """
+    Download a file from S3 using concurrent ranged GET requests and save it to temp directory.
+    Only the bytes [start_byte, end_byte) of the object are downloaded when a byte range is given.
+
+    The object is split into byte ranges of range_size bytes which are fetched by a bounded
+    pool of threads. Each range is written directly into its own slot of a preallocated temp
+    file using pwrite, so no reordering or intermediate buffering of ranges is needed.
+
+    A partial download can be resumed by passing the file it was written to along with the
+    ranges which were already downloaded, only the other ranges are fetched again.
+
+    The download stops with JobCancelledError between 2 reads once the cancellation token is cancelled.
+
+    Args:
+        bucket_name (str): The S3 bucket name
+        object_key (str): The S3 object key (file path)
+        range_size (int): Size of the byte range fetched by one GET request (default 64MB)
+        max_workers (int): Maximum number of ranges downloaded concurrently
+        chunk_size (int): Size of the reads from a single GET response body (default 1MB)
+        file_path (str): Optional path of the file to download to, which is kept on failure.
+            Defaults to a new temp file, which is removed on failure
+        completed_ranges (list): Optional [start_byte, end_byte] ranges already downloaded to file_path
+        on_range_done (callable): Optional callback called with start_byte and end_byte once a range
+            is written to the file
+        start_byte (int): Offset in the object of the first byte to download (default 0)
+        end_byte (int): Offset in the object after the last byte to download (default the object size)
+        cancellation (CancellationToken): Optional token of the job the download is for
+
+    Returns:
+        tuple(str, dict): Path to the downloaded file in temp directory and the download stats
+
+    Raises:
+        ValueError: If the object is smaller than the byte range
+        JobCancelledError: If the job was cancelled during the download
+    """
+    temp_file_path = None
+    try:
+        t1 = timer()
+        logger.info(f"Bucket name: {bucket_name}, Object key: {object_key}")
+        response = s3_client.head_object(Bucket=bucket_name, Key=object_key)
+        object_size = response['ContentLength']
+        end_byte = object_size if end_byte is None else end_byte
+        if object_size < end_byte or start_byte > end_byte:
+            raise ValueError(f"Object {object_key} has {object_size} bytes, the range {start_byte}-{end_byte} can't be downloaded")
+        file_size = end_byte - start_byte
+
+        if file_path is None:
+            # Create temp file with same extension as original
+            file_extension = Path(object_key).suffix
+            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=file_extension)
+            temp_file_path = temp_file.name
+        else:
+            temp_file = open(file_path, 'r+b' if os.path.exists(file_path) else 'w+b')
+
+        # The ranges are offsets in the object, so the completed ranges of a resumed download are the same
+        ranges = [(start_byte + start, start_byte + end) for start, end in _split_in_ranges(file_size, range_size)]
+        completed = set(tuple(completed_range) for completed_range in completed_ranges or [])
+        pending_ranges = [byte_range for byte_range in ranges if byte_range not in completed]
+        resumed_bytes = sum(end - start for start, end in ranges) - sum(end - start for start, end in pending_ranges)
+        logger.info(f"Downloading {object_key} to {temp_file_path or file_path} in {len(pending_ranges)} ranges")
+        with temp_file:
+            fd = temp_file.fileno()
+            if os.fstat(fd).st_size != file_size:
+                _preallocate(fd, file_size)
+            retries = _download_ranges(bucket_name, object_key, pending_ranges, _file_sink(fd, chunk_size, start_byte),
+                                       max_workers, on_range_done, cancellation)
+        t2 = timer()
+
+        logger.info(f"Download completed: {temp_file_path or file_path}")
+        download_stats = _download_stats(file_size - resumed_bytes, t2 - t1, len(pending_ranges), retries)
+        download_stats["resumed_bytes"] = resumed_bytes
+        return temp_file_path or file_path, download_stats
+
+    except Exception as e:
+        if isinstance(e, JobCancelledError):
+            logger.info(f"Download of object {object_key} from bucket {bucket_name} was cancelled")
+        else:
+            logger.error(f"Error downloading object {object_key} from bucket {bucket_name}: {traceback.format_exc()} {e}")
+        # Clean up temp file if it exists
+        if temp_file_path is not None:
+            cleanup_temp_file(temp_file_path)
+        raise
+
+def download_s3_object_into_buffer(bucket_name, object_key, buffer, start_byte=0, range_size=download_range_size,
+                                   max_workers=download_max_workers, chunk_size=1024*1024,  # 1MB reads
+                                   cancellation: CancellationToken = None):
+    """
+    Download len(buffer) bytes of an S3 object starting at start_byte directly into a writable buffer.
+
+    The bytes are fetched with concurrent ranged GET requests and every response body is read
+    straight into its slice of the buffer, so nothing is written to disk and no intermediate copy
+    of the object is kept in memory.
+
+    Args:
+        bucket_name (str): The S3 bucket name
+        object_key (str): The S3 object key (file path)
+        buffer: A writable, C-contiguous buffer, e.g. a numpy array, which will be filled
+        start_byte (int): Offset in the object of the first byte to download (default 0)
+        range_size (int): Size of the byte range fetched by one GET request (default 64MB)
+        max_workers (int): Maximum number of ranges downloaded concurrently
+        chunk_size (int): Size of the reads from a single GET response body (default 1MB)
+        cancellation (CancellationToken): Optional token of the job the download is for
+
+    Returns:
+        dict: The download stats
+
+    Raises:
+        ValueError: If the object is smaller than the bytes requested
+        JobCancelledError: If the job was cancelled during the download
+    """
+    view = memoryview(buffer).cast('B')
+    t1 = timer()
+    logger.info(f"Bucket name: {bucket_name}, Object key: {object_key}")
+    response = s3_client.head_object(Bucket=bucket_name, Key=object_key)
+    file_size = response['ContentLength']
+    if file_size < start_byte + len(view):
+        raise ValueError(
+            f"Object {object_key} has {file_size} bytes, but {len(view)} bytes are needed from byte {start_byte}"
+        )
+
+    ranges = [(start_byte + start, start_byte + end) for start, end in _split_in_ranges(len(view), range_size)]
+    logger.info(f"Downloading {len(view)} bytes of {object_key} into memory in {len(ranges)} ranges")
+    retries = _download_ranges(bucket_name, object_key, ranges, _buffer_sink(view, start_byte, chunk_size), max_workers,
+                               cancellation=cancellation)
+    t2 = timer()
+
+    logger.info(f"Download completed for {object_key}")
+    return _download_stats(len(view), t2 - t1, len(ranges), retries)
+
+def download_compressed_s3_object(bucket_name, object_key, compression, write,
+                                  range_size=compressed_download_range_size, max_workers=download_max_workers,
+                                  max_in_flight_bytes=download_max_in_flight_bytes, chunk_size=1024*1024,  # 1MB reads
+                                  cancellation: CancellationToken = None):
+    """
+    Download a compressed S3 object and decode it while it is downloading.
+
+    The compressed bytes are fetched with concurrent ranged GET requests like the other downloads. The ranges are
+    decoded in order as soon as they arrive, so the decoding of a range overlaps the download of the next ones, and
+    at most max_in_flight_bytes of compressed ranges are downloading or waiting to be decoded at a time.
+
+    Args:
+        bucket_name (str): The S3 bucket name
+        object_key (str): The S3 object key (file path)
+        compression (str): Compression of the object, see utils.compression
+        write (callable): Called with every decoded chunk and its offset in the decoded object, in order
+        range_size (int): Size of the byte range fetched by one GET request (default 16MB)
+        max_workers (int): Maximum number of ranges downloaded concurrently
+        max_in_flight_bytes (int): Maximum size of the ranges downloading or waiting to be decoded
+        chunk_size (int): Size of the reads from a single GET response body (default 1MB)
+        cancellation (CancellationToken): Optional token of the job the download is for
+
+    Returns:
+        tuple(int, dict): The size of the decoded object and the download stats
+
+    Raises:
+        ValueError: If the object ends in the middle of a frame
+        JobCancelledError: If the job was cancelled during the download
+    """
+    t1 = timer()
+    logger.info(f"Bucket name: {bucket_name}, Object key: {object_key}")
+    response = s3_client.head_object(Bucket=bucket_name, Key=object_key)
+    object_size = response['ContentLength']
+    ranges = _split_in_ranges(object_size, range_size)
+    decoder = FramedDecoder(compression)
+    in_flight_ranges = max(max_in_flight_bytes // range_size, 1)
+    logger.info(f"Downloading and decoding the {compression} object {object_key} in {len(ranges)} ranges")
+    decoded_size, decode_time, retries = 0, 0, 0
+    next_ranges = iter(ranges)
+    pending = []
+    # Stops the ranges which are downloading once the download fails or the job is cancelled
+    ranges_cancellation = CancellationToken(cancellation)
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, in_flight_ranges, len(ranges)), 1)) as executor:
+        def submit_next_range():
+            byte_range = next(next_ranges, None)
+            if byte_range is not None:
+                pending.append(executor.submit(_download_range_into_memory, bucket_name, object_key, *byte_range,
+                                               chunk_size, ranges_cancellation))
+        try:
+            for _ in range(in_flight_ranges):
+                submit_next_range()
+            while len(pending) > 0:
+                data, range_retries = pending.pop(0).result()
+                submit_next_range()
+                retries += range_retries
+                raise_if_cancelled(cancellation, f"Download of {object_key} was cancelled")
+                t = timer()
+                decoded = decoder.decode(data)
+                decode_time += timer() - t
+                write(decoded, decoded_size)
+                decoded_size += len(decoded)
+            decoder.finish()
+        except Exception as e:
+            # Don't start the ranges which are still queued, the running ones stop at their next read
+            ranges_cancellation.cancel()
+            for future in pending:
+                future.cancel()
+            if isinstance(e, JobCancelledError):
+                logger.info(f"Download of object {object_key} from bucket {bucket_name} was cancelled")
+            else:
+                logger.error(f"Error downloading object {object_key} from bucket {bucket_name}: {traceback.format_exc()} {e}")
+            raise
+    t2 = timer()
+
+    logger.info(f"Download completed for {object_key}, decoded {object_size} bytes into {decoded_size} bytes")
+    download_stats = _download_stats(object_size, t2 - t1, len(ranges), retries)
+    download_stats.update({
+        "compression": compression,
+        "decoded_size": decoded_size,
+        "compression_ratio": decoded_size / object_size if object_size > 0 else 0,
+        "decode_time": decode_time
+    })
+    return decoded_size, download_stats
+
+def _download_range_into_memory(bucket_name, object_key, start_byte, end_byte, chunk_size, cancellation=None):
+    """Download the byte range [start_byte, end_byte) of an object into a new buffer, returned with its retries"""
+    buffer = bytearray(end_byte - start_byte)
+    retries = _download_range(bucket_name, object_key, start_byte, end_byte,
+                              _buffer_sink(memoryview(buffer), start_byte, chunk_size), cancellation=cancellation)
+    return buffer, retries
+
+def _split_in_ranges(size, range_size):
+    """Split [0, size) into half open byte ranges of at most range_size bytes"""
+    return [(start, min(start + range_size, size)) for start in range(0, size, range_size)]
+
+def _preallocate(fd, size):
+    """Reserve the space of the whole object upfront so that ranges can be written in any order"""
+    if size == 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(fd, 0, size)
+    else:
+        os.ftruncate(fd, size)
+
+def _file_sink(fd, chunk_size, base_offset=0):
+    """
+    Returns a sink which reads at most chunk_size bytes from a response body and writes them
+    at their offset in the file, returning the number of bytes consumed. The file starts at
+    the base_offset byte of the object.
+    """
+    def sink(body, offset, end_byte):
+        data = memoryview(body.read(min(chunk_size, end_byte - offset)))
+        written = 0
+        while written < len(data):
+            written += os.pwrite(fd, data[written:], offset - base_offset + written)
+        return written
+    return sink
+
+def _buffer_sink(view, base_offset, chunk_size):
+    """
+    Returns a sink which reads at most chunk_size bytes from a response body straight into the
+    slice of the buffer backing the object offset, returning the number of bytes consumed.
+    """
+    def sink(body, offset, end_byte):
+        start = offset - base_offset
+        return _readinto(body, view[start:start + min(chunk_size, end_byte - offset)])
+    return sink
+
+def _readinto(body, target):
+    # Older botocore versions don't implement readinto on the StreamingBody
+    if hasattr(body, 'readinto'):
+        return body.readinto(target)
+    data = body.read(len(target))
+    target[:len(data)] = data
+    return len(data)
+
+def _download_ranges(bucket_name, object_key, ranges, sink, max_workers, on_range_done=None, cancellation=None):
+    """Download all the ranges in parallel and return the total number of retries it took"""
+    if len(ranges) == 0:
+        return 0
+    # Stops the other ranges once a range fails or the job is cancelled
+    ranges_cancellation = CancellationToken(cancellation)
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(ranges)), 1)) as executor:
+        futures = [
+            executor.submit(_download_range, bucket_name, object_key, start_byte, end_byte, sink, on_range_done,
+                            ranges_cancellation)
+            for start_byte, end_byte in ranges
+        ]
+        try:
+            # The first range to fail fails the download, without waiting for the ranges before it
+            return sum(future.result() for future in as_completed(futures))
+        except Exception:
+            # Don't start the ranges which are still queued, the running ones stop at their next read
+            ranges_cancellation.cancel()
+            for future in futures:
+                future.cancel()
+            raise
+
+def _download_range(bucket_name, object_key, start_byte, end_byte, sink, on_range_done=None, cancellation=None):
+    """
+    Download the byte range [start_byte, end_byte) of an object and hand it over to the sink.
+    On failure the range is retried from the last byte consumed by the sink. on_range_done, if
+    provided, is called with start_byte and end_byte once the whole range is consumed. The
+    cancellation token is checked before every read, a cancelled download is not retried.
+
+    Returns:
+        int: Number of retries it took to download the range
+    """
+    offset = start_byte
+    attempt = 0
+    while True:
+        raise_if_cancelled(cancellation, f"Download of {object_key} was cancelled")
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=object_key,
+                                            Range=f"bytes={offset}-{end_byte - 1}")
+            body = response['Body']
+            while offset < end_byte:
+                raise_if_cancelled(cancellation, f"Download of {object_key} was cancelled")
+                consumed = sink(body, offset, end_byte)
+                if consumed == 0:
+                    raise IOError(f"Response ended at byte {offset} for range {start_byte}-{end_byte}")
+                offset += consumed
+            logger.debug(f"Downloaded range {start_byte}-{end_byte} of {object_key}")
+            if on_range_done is not None:
+                on_range_done(start_byte, end_byte)
+            return attempt
+        except JobCancelledError:
+            body.close()
+            raise
+        except Exception as e:
+            attempt += 1
+            if attempt >= download_retries:
+                logger.error(
+                    f"Failed to download range {start_byte}-{end_byte} after {download_retries} attempts: {str(e)}"
+                )
+                raise
+            logger.warning(
+                f"Retrying download of range {start_byte}-{end_byte} from byte {offset}. "
+                f"Attempts remaining: {download_retries - attempt}"
+            )
+
+def _download_stats(size, time_taken, ranges, retries):
+    return {
+        "size": size,
+        "size_unit": "bytes",
+        "transfer_time": time_taken,
+        "unit": "seconds",
+        "throughput": (size / (1024 * 1024)) / time_taken if time_taken > 0 else 0,
+        "throughput_unit": "MB/s",
+        "ranges": ranges,
+        "retries": retries
+    }
+
 def cleanup_temp_file(temp_file_path):
     """
     Clean up the temporary file when no longer needed
@@ -122,81 +533,249 @@ def cleanup_temp_file(temp_file_path):
 
 """
 max_workers: Maximum number of concurrent upload threads
-chunk_size: Size of each chunk in bytes (default 1GB)
+chunk_size: Minimum size of each part in bytes (default 10MB)
+max_in_flight_bytes: Maximum number of bytes of the parts which are buffered or uploading at a time
+upload_retries: Number of attempts for a single part before failing the upload
 """
-max_workers = os.cpu_count() - 2 # This can be dynamic
+max_workers = int(os.getenv('S3_UPLOAD_MAX_WORKERS', max(os.cpu_count() - 2, 1)))
 chunk_size = 1024*1024*10 # 10MB chunk
+max_in_flight_bytes = int(os.getenv('S3_UPLOAD_MAX_IN_FLIGHT_BYTES', 1024*1024*256)) # 256MB
+upload_retries = 3
+# S3 allows at most 10,000 parts in a multipart upload
+MAX_PARTS = 10000
+# Base and maximum delay in seconds of the exponential backoff between the attempts of a part
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 20
 
-def upload_file(file_path, object_key, bucket_name, metadata=None):
+def get_part_size(file_size):
+    """
+    Returns the part size for a multipart upload of file_size bytes. This is chunk_size, unless the file needs
+    more than MAX_PARTS parts, in which case the part size is grown to fit the file in MAX_PARTS parts.
+    """
+    part_size = max(chunk_size, math.ceil(file_size / MAX_PARTS))
+    # Round up to MBs to keep the parts aligned to the pages of the file
+    mb = 1024 * 1024
+    return math.ceil(part_size / mb) * mb
+
+def get_max_in_flight_parts(part_size):
+    return max(max_in_flight_bytes // part_size, 1)
+
+def upload_file(file_path, object_key, bucket_name, metadata=None, upload_id=None, part_size=None,
+                completed_parts=None, on_upload_created=None, on_part_done=None, cancellation: CancellationToken = None):
     """
     Upload a file to S3 using parallel multipart upload
 
+    The file is memory mapped and every part is uploaded from its slice of the mapping, so the parts are never
+    copied in memory as a whole. At most max_in_flight_bytes bytes of parts are uploading at a time.
+
+    An interrupted upload can be resumed by passing its upload_id and part_size along with the parts which were
+    already uploaded, only the other parts are uploaded again.
+
+    Once the cancellation token is cancelled no new part is uploaded and the multipart upload is aborted. The first
+part which fails for good fails the upload, the parts which didn't start are not uploaded and the others are not
+retried.
+
     Args:
         file_path: Local path to file
         object_key: S3 object key
         bucket_name: name of the bucket
         metadata: Optional metadata dictionary
+        upload_id: Optional id of the multipart upload to resume, a new multipart upload is created by default
+        part_size: Part size of the multipart upload to resume, computed from the file size by default
+        completed_parts: Optional {'PartNumber', 'ETag'} parts of the resumed upload which are already uploaded
+        on_upload_created: Optional callback called with the upload_id and the part_size of a new multipart upload
+        on_part_done: Optional callback called with the {'PartNumber', 'ETag'} of every uploaded part
+        cancellation: Optional token of the job the upload is for
+
+    Returns:
+        dict: The upload stats
+
+    Raises:
+        JobCancelledError: If the job was cancelled during the upload
     """
     file_size = os.path.getsize(file_path)
+    part_size = part_size or get_part_size(file_size)
+    completed_parts = {part['PartNumber']: part for part in completed_parts or []}
+    t1 = timer()
 
     try:
-        # Initialize multipart upload
-        response = s3_client.create_multipart_upload(
-            Bucket=bucket_name,
-            Key=object_key,
-            Metadata=metadata or {}
-        )
-        upload_id = response['UploadId']
+        if upload_id is None:
+            # Initialize multipart upload
+            response = s3_client.create_multipart_upload(
+                Bucket=bucket_name,
+                Key=object_key,
+                Metadata=metadata or {}
+            )
+            upload_id = response['UploadId']
+            if on_upload_created is not None:
+                on_upload_created(upload_id, part_size)
+        else:
+            logger.info(f"Resuming upload {upload_id} of {object_key} with {len(completed_parts)} parts uploaded")
+
+        # Calculate parts, S3 needs at least 1 part even when the file is empty
+        num_parts = max(math.ceil(file_size / part_size), 1)
+        in_flight = threading.BoundedSemaphore(get_max_in_flight_parts(part_size))
+        # Stops the other parts once a part fails or the job is cancelled
+        parts_cancellation = CancellationToken(cancellation)
+        errors = []
 
-        # Calculate parts
-        num_parts = math.ceil(file_size / chunk_size)
-        parts = []
+        def upload_part(part_number, data):
+            try:
+                return _upload_part_data(bucket_name, object_key, upload_id, part_number, data, parts_cancellation)
+            except Exception as e:
+                # Recorded before the future fails, so the error of the first failed part is the one raised
+                errors.append(e)
+                parts_cancellation.cancel()
+                raise
 
         # Upload parts in parallel
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with open(file_path, 'rb') as f, _map_file(f, file_size) as file_map, \
+                ThreadPoolExecutor(max_workers=max_workers) as executor:
             futures = []
 
             for part_number in range(1, num_parts + 1):
-                start_byte = (part_number - 1) * chunk_size
-                end_byte = min(start_byte + chunk_size, file_size)
-
-                futures.append(
-                    executor.submit(
-                        upload_part,
-                        file_path,
-                        bucket_name,
-                        object_key,
-                        upload_id,
-                        part_number,
-                        start_byte,
-                        end_byte
+                if part_number in completed_parts:
+                    continue
+                start_byte = (part_number - 1) * part_size
+                end_byte = min(start_byte + part_size, file_size)
+
+                # Blocks when max_in_flight_bytes bytes of parts are uploading
+                in_flight.acquire()
+                if _is_cancelled(cancellation, futures):
+                    raise JobCancelledError(f"Upload of {object_key} was cancelled")
+                if len(errors) > 0:
+                    # A part failed, the parts after it are not uploaded
+                    break
+                future = executor.submit(upload_part, part_number, BufferSlice(file_map, start_byte, end_byte))
+                future.add_done_callback(lambda _: in_flight.release())
+                if on_part_done is not None:
+                    future.add_done_callback(
+                        lambda f: not f.cancelled() and f.exception() is None and on_part_done(f.result())
                     )
-                )
+                futures.append(future)
 
-            # Process completed parts
-            for future in futures:
-                part = future.result()
-                parts.append(part)
+            # The first part to fail fails the upload, without waiting for the parts before it
+            wait(futures, return_when=FIRST_EXCEPTION)
+            if len(errors) > 0:
+                for future in futures:
+                    future.cancel()
+                raise errors[0]
+            parts = [future.result() for future in futures]
 
+        raise_if_cancelled(cancellation, f"Upload of {object_key} was cancelled")
         # Complete multipart upload
-        parts.sort(key=lambda x: x['PartNumber'])
+        parts = sorted(parts + list(completed_parts.values()), key=lambda part: part['PartNumber'])
         s3_client.complete_multipart_upload(
             Bucket=bucket_name,
             Key=object_key,
             UploadId=upload_id,
             MultipartUpload={'Parts': parts}
         )
+        t2 = timer()
 
         logger.info(f"Successfully uploaded {file_path} to {object_key}")
-        return True
+        upload_stats = _upload_stats(file_size, t2 - t1, num_parts, part_size)
+        upload_stats["resumed_parts"] = len(completed_parts)
+        return upload_stats
 
     except Exception as e:
-        logger.error(f"Error uploading file {file_path}: {str(e)}")
+        if isinstance(e, JobCancelledError):
+            logger.info(f"Upload of file {file_path} was cancelled")
+        else:
+            logger.error(f"Error uploading file {file_path}: {str(e)}")
         # Abort multipart upload if it was initialized
-        if 'upload_id' in locals():
+        if upload_id is not None:
             _abort_multipart_upload(object_key, upload_id, bucket_name)
         raise
 
+def _is_cancelled(cancellation, futures) -> bool:
+    """Whether the upload is cancelled, in which case the parts which didn't start uploading yet are cancelled too"""
+    if cancellation is None or not cancellation.is_cancelled():
+        return False
+    for future in futures:
+        future.cancel()
+    return True
+
+@contextlib.contextmanager
+def _map_file(f, file_size):
+    # An empty file can't be memory mapped
+    if file_size == 0:
+        yield b''
+        return
+    file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield file_map
+    finally:
+        try:
+            file_map.close()
+        except BufferError:
+            # The traceback of the error of a failed part can keep a view of the part, the map is unmapped once the
+            # view is collected, and the error of the part is raised rather than this one
+            logger.debug(f"The map of {f.name} is closed once the views of its parts are released")
+
+def _upload_stats(size, time_taken, parts, part_size):
+    return {
+        "size": size,
+        "size_unit": "bytes",
+        "parts": parts,
+        "part_size": part_size,
+        "time": time_taken,
+        "unit": "seconds",
+        "throughput": (size / (1024 * 1024)) / time_taken if time_taken > 0 else 0,
+        "throughput_unit": "MB/s"
+    }
+
+
+class BufferSlice(io.RawIOBase):
+    """
+    A read only file like view of the slice [start, end) of a buffer, like a memory mapped file or a bytearray.
+    boto3 doesn't accept memoryviews as a body, so this lets a part be uploaded without copying it, as the HTTP
+    client reads the body in small blocks. read returns memoryviews of the buffer, which the HTTP client sends
+    straight from the buffer.
+    """
+
+    def __init__(self, buffer, start, end):
+        self._buffer = buffer
+        self._start = start
+        self._end = end
+        self._position = start
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._end - self._position
+        end = min(self._position + size, self._end)
+        # A view of the buffer rather than a copy, which is released once the caller drops it
+        data = memoryview(self._buffer)[self._position:end]
+        self._position = end
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        memoryview(b).cast('B')[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = self._start + offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        else:
+            position = self._end + offset
+        self._position = min(max(position, self._start), self._end)
+        return self._position - self._start
+
+    def tell(self):
+        return self._position - self._start
+
+    def __len__(self):
+        return self._end - self._start
+
 def _abort_multipart_upload(object_key, upload_id, bucket_name):
     """Abort a multipart upload"""
     try:
@@ -210,21 +789,29 @@ def _abort_multipart_upload(object_key, upload_id, bucket_name):
 
 def upload_part(file_path, bucket_name, object_key, upload_id, part_number, start_byte, end_byte):
     """Upload a single part of the file"""
+    with open(file_path, 'rb') as f, _map_file(f, os.path.getsize(file_path)) as file_map:
+        return _upload_part_data(bucket_name, object_key, upload_id, part_number,
+                                 BufferSlice(file_map, start_byte, end_byte))
+
+def _upload_part_data(bucket_name, object_key, upload_id, part_number, data, cancellation=None):
+    """
+    Upload a single part from a BufferSlice, retrying with an exponential backoff. The part is not uploaded, or
+    retried, once the cancellation token is cancelled.
+    """
     client = s3_client
 
-    retries = 3
-    while retries > 0:
+    attempt = 0
+    while True:
+        raise_if_cancelled(cancellation, f"Upload of part {part_number} of {object_key} was cancelled")
         try:
-            with open(file_path, 'rb') as f:
-                f.seek(start_byte)
-                file_data = f.read(end_byte - start_byte)
-
+            # A failed attempt could have read part of the body
+            data.seek(0)
             response = client.upload_part(
                 Bucket=bucket_name,
                 Key=object_key,
                 PartNumber=part_number,
                 UploadId=upload_id,
-                Body=file_data
+                Body=data
             )
 
             return {
@@ -233,12 +820,145 @@ def upload_part(file_path, bucket_name, object_key, upload_id, part_number, star
             }
 
         except Exception as e:
-            retries -= 1
-            if retries == 0:
+            attempt += 1
+            if attempt >= upload_retries:
                 logger.error(
-                    f"Failed to upload part {part_number} after 3 attempts: {str(e)}"
+                    f"Failed to upload part {part_number} after {upload_retries} attempts: {str(e)}"
                 )
                 raise
+            delay = min(RETRY_BASE_DELAY * (2 ** (attempt - 1)), RETRY_MAX_DELAY) * random.uniform(0.5, 1)
             logger.warning(
-                f"Retrying upload of part {part_number}. Attempts remaining: {retries}"
-            )
\ No newline at end of file
+                f"Retrying upload of part {part_number} in {delay:.2f}s. Attempts remaining: {upload_retries - attempt}"
+            )
+            time.sleep(delay)
+
+
+class MultipartUploadStream:
+    """
+    A writable stream which uploads the bytes written to it to S3 as a multipart upload, while they are still
+    being written. The bytes are written into a fixed pool of reusable part_size buffers, every time a buffer is
+    full it is shipped as a part by a pool of threads and returned to the pool once uploaded. When all the
+    max_in_flight_parts buffers are uploading write blocks until one of them is uploaded. This bounds the memory
+    used by the stream to max_in_flight_parts * part_size, without copying the parts.
+
+    close completes the upload after the last part is uploaded, abort cancels it. When used as a context manager
+    the upload is completed on success and aborted on error. Once the cancellation token is cancelled write and
+    close raise JobCancelledError, and the stream should be aborted.
+    """
+
+    def __init__(self, bucket_name, object_key, part_size=chunk_size, max_in_flight_parts=None, metadata=None,
+                 cancellation: CancellationToken = None):
+        self.bucket_name = bucket_name
+        self.object_key = object_key
+        self.cancellation = cancellation
+        self.part_size = part_size
+        self.max_in_flight_parts = max_in_flight_parts if max_in_flight_parts is not None else get_max_in_flight_parts(part_size)
+        self.size = 0
+        self._futures = []
+        self._error = None
+        self._aborted = False
+        self._free_buffers = queue.Queue()
+        self._allocated_buffers = 0
+        self._buffer = None
+        self._filled = 0
+        self._executor = ThreadPoolExecutor(max_workers=min(self.max_in_flight_parts, max_workers))
+        # The stream is created before the index is built, so the upload time starts with the first write
+        self._start_time = None
+        response = s3_client.create_multipart_upload(
+            Bucket=bucket_name,
+            Key=object_key,
+            Metadata=metadata or {}
+        )
+        self.upload_id = response['UploadId']
+
+    def write(self, data) -> int:
+        raise_if_cancelled(self.cancellation, f"Upload of {self.object_key} was cancelled")
+        if self._start_time is None:
+            self._start_time = timer()
+        view = memoryview(data).cast('B')
+        written = 0
+        while written < len(view):
+            if self._buffer is None:
+                self._buffer = self._take_buffer()
+            size = min(self.part_size - self._filled, len(view) - written)
+            self._buffer[self._filled:self._filled + size] = view[written:written + size]
+            self._filled += size
+            written += size
+            if self._filled == self.part_size:
+                self._ship_part()
+        self.size += written
+        return written
+
+    def close(self):
+        """Upload the remaining bytes as the last part and complete the upload. Returns the upload stats"""
+        try:
+            raise_if_cancelled(self.cancellation, f"Upload of {self.object_key} was cancelled")
+            # S3 needs at least 1 part, even when the object is empty
+            if self._filled > 0 or len(self._futures) == 0:
+                if self._buffer is None:
+                    self._buffer = self._take_buffer()
+                self._ship_part()
+            parts = [future.result() for future in self._futures]
+            s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.object_key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception as e:
+            if isinstance(e, JobCancelledError):
+                logger.info(f"Upload of stream to {self.object_key} was cancelled")
+            else:
+                logger.error(f"Error uploading stream to {self.object_key}: {str(e)}")
+            self.abort()
+            raise
+        finally:
+            self._executor.shutdown(wait=False)
+        time_taken = timer() - (self._start_time or timer())
+        logger.info(f"Successfully uploaded stream of {self.size} bytes to {self.object_key}")
+        return _upload_stats(self.size, time_taken, len(self._futures), self.part_size)
+
+    def abort(self):
+        if self._aborted:
+            return
+        self._aborted = True
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        _abort_multipart_upload(self.object_key, self.upload_id, self.bucket_name)
+
+    def _take_buffer(self):
+        # Buffers are allocated lazily, so small objects don't allocate the whole pool
+        if self._free_buffers.empty() and self._allocated_buffers < self.max_in_flight_parts:
+            self._allocated_buffers += 1
+            return bytearray(self.part_size)
+        # Blocks the writer until a part is uploaded
+        buffer = self._free_buffers.get()
+        # Fail the writer as soon as a part failed, rather than serializing the rest of the object
+        if self._error is not None:
+            raise self._error
+        return buffer
+
+    def _ship_part(self):
+        buffer = self._buffer
+        part_number = len(self._futures) + 1
+        future = self._executor.submit(_upload_part_data, self.bucket_name, self.object_key, self.upload_id,
+                                       part_number, BufferSlice(buffer, 0, self._filled), self.cancellation)
+        future.add_done_callback(lambda f: self._on_part_done(f, buffer))
+        self._futures.append(future)
+        self._buffer = None
+        self._filled = 0
+
+    def _on_part_done(self, future, buffer):
+        if not future.cancelled() and future.exception() is not None:
+            self._error = future.exception()
+        self._free_buffers.put(buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
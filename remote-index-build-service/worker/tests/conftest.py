@@ -0,0 +1,32 @@
+import os
+
+# The worker reads its configuration when its modules are imported, small ranges and parts keep the test objects small
+os.environ.setdefault("S3_DOWNLOAD_RANGE_SIZE", str(256 * 1024))
+os.environ.setdefault("S3_DOWNLOAD_MAX_WORKERS", "2")
+os.environ.setdefault("S3_UPLOAD_MAX_WORKERS", "2")
+
+import boto3
+import pytest
+from moto import mock_aws
+
+BUCKET = "test-bucket"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """A moto S3 with an empty bucket, which the s3client of the worker talks to"""
+    for key in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"]:
+        monkeypatch.setenv(key, "testing")
+    monkeypatch.delenv("AWS_ENDPOINT_URL", raising=False)
+    with mock_aws():
+        import s3.s3client as s3client
+        client = boto3.client("s3", region_name="us-west-2")
+        client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": "us-west-2"})
+        monkeypatch.setattr(s3client, "s3_client", client)
+        yield client
+
+
+def put_object(client, key: str, size: int) -> bytes:
+    data = os.urandom(size)
+    client.put_object(Bucket=BUCKET, Key=key, Body=data)
+    return data
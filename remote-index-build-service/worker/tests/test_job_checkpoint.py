@@ -0,0 +1,158 @@
+import time
+
+import faiss
+import numpy as np
+import pytest
+
+import index_builder.indexing_service as indexing_service
+import s3.s3client as s3client
+from index_builder.job_checkpoint import CheckpointStore, DOWNLOAD_STAGE, BUILD_STAGE, UPLOAD_STAGE
+from index_builder.vector_index_builder import get_index_file
+from models.data_model import CreateIndexRequest
+from tests.conftest import BUCKET
+
+NUMBER_OF_VECTORS = 20000
+DIMENSIONS = 64
+PART_SIZE = 5 * 1024 * 1024
+JOB_ID = "job-1"
+
+
+@pytest.fixture
+def vectors(s3):
+    vectors = np.random.default_rng(0).random((NUMBER_OF_VECTORS, DIMENSIONS), dtype=np.float32)
+    s3.put_object(Bucket=BUCKET, Key="vectors.knnvec", Body=vectors.tobytes())
+    return vectors
+
+
+@pytest.fixture
+def checkpoint_store(monkeypatch, tmp_path):
+    monkeypatch.setattr(indexing_service, "job_checkpoint_dir", str(tmp_path))
+    monkeypatch.setattr(s3client, "chunk_size", PART_SIZE)
+    return CheckpointStore(str(tmp_path))
+
+
+@pytest.fixture
+def requests_to_s3(monkeypatch, s3):
+    """Records the byte ranges downloaded and the parts uploaded by the worker"""
+    ranges, parts = [], []
+    get_object, upload_part = s3.get_object, s3.upload_part
+
+    def recording_get_object(**kwargs):
+        ranges.append(kwargs.get("Range"))
+        return get_object(**kwargs)
+
+    def recording_upload_part(**kwargs):
+        parts.append(kwargs["PartNumber"])
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(s3, "get_object", recording_get_object)
+    monkeypatch.setattr(s3, "upload_part", recording_upload_part)
+    return ranges, parts
+
+
+def create_index_request() -> CreateIndexRequest:
+    return CreateIndexRequest(BUCKET, "vectors.knnvec", NUMBER_OF_VECTORS, DIMENSIONS, "l2")
+
+
+def object_ranges():
+    size, range_size = NUMBER_OF_VECTORS * DIMENSIONS * 4, s3client.download_range_size
+    return [(start, min(start + range_size, size)) for start in range(0, size, range_size)]
+
+
+def write_downloaded_ranges(checkpoint_store, checkpoint, vectors, ranges):
+    data = vectors.tobytes()
+    with open(checkpoint.vector_file, "wb") as f:
+        for start, end in ranges:
+            f.seek(start)
+            f.write(data[start:end])
+            checkpoint_store.mark_range_downloaded(checkpoint, start, end)
+
+
+def resume_job(s3):
+    """Restart the worker on the checkpoint directory and wait for the resumed job"""
+    service = indexing_service.IndexingService()
+    for _ in range(600):
+        job = service.get_job_status(JOB_ID)
+        if job is not None and job.status in ["completed", "failed", "cancelled"]:
+            break
+        time.sleep(0.1)
+    assert job.status == "completed", job.error
+    index_file = get_index_file(create_index_request())
+    assert job.result.graphFileLocation == index_file
+    index_data = s3.get_object(Bucket=BUCKET, Key=index_file)["Body"].read()
+    return job, index_data
+
+
+def assert_index_of(index_data: bytes, vectors: np.ndarray):
+    index = faiss.deserialize_index(np.frombuffer(index_data, dtype=np.uint8))
+    assert index.ntotal == NUMBER_OF_VECTORS
+    faiss.downcast_index(index.index).hnsw.efSearch = 128
+    _, found = index.search(vectors[:10], 1)
+    assert np.mean(found[:, 0] == np.arange(10)) >= 0.9
+
+
+def test_resume_in_download_stage(s3, vectors, checkpoint_store, requests_to_s3):
+    ranges, _ = requests_to_s3
+    checkpoint = checkpoint_store.open(JOB_ID, create_index_request())
+    downloaded = object_ranges()[:len(object_ranges()) // 2]
+    write_downloaded_ranges(checkpoint_store, checkpoint, vectors, downloaded)
+
+    job, index_data = resume_job(s3)
+
+    requested = [requested_range for requested_range in ranges if requested_range is not None]
+    assert len(requested) == len(object_ranges()) - len(downloaded)
+    assert not {f"bytes={start}-{end - 1}" for start, end in downloaded} & set(requested)
+    assert job.result.stats["download_stats"]["resumed_bytes"] == downloaded[-1][1]
+    assert_index_of(index_data, vectors)
+    assert checkpoint_store.load_all() == []
+
+
+def test_resume_in_build_stage(s3, vectors, checkpoint_store, requests_to_s3):
+    ranges, _ = requests_to_s3
+    checkpoint = checkpoint_store.open(JOB_ID, create_index_request())
+    write_downloaded_ranges(checkpoint_store, checkpoint, vectors, object_ranges())
+    checkpoint_store.mark_downloaded(checkpoint)
+    assert checkpoint.stage == BUILD_STAGE
+
+    job, index_data = resume_job(s3)
+
+    # The index file is read back without a range, the vectors are not downloaded again
+    assert [requested_range for requested_range in ranges if requested_range is not None] == []
+    assert_index_of(index_data, vectors)
+    # The memory of the job is its vectors, its int64 ids and its index
+    memory_stats = job.result.stats["memory_stats"]
+    assert memory_stats["dataset_size"] == vectors.nbytes + NUMBER_OF_VECTORS * 8
+    assert memory_stats["index_size"] == len(index_data)
+    assert memory_stats["job_memory"] == memory_stats["dataset_size"] + memory_stats["index_size"]
+    assert checkpoint_store.load_all() == []
+
+
+def test_resume_in_upload_stage(s3, vectors, checkpoint_store, requests_to_s3):
+    _, parts = requests_to_s3
+    request = create_index_request()
+    checkpoint = checkpoint_store.open(JOB_ID, request)
+    assert checkpoint.stage == DOWNLOAD_STAGE
+    checkpoint_store.mark_downloaded(checkpoint)
+    index = faiss.IndexIDMap(faiss.IndexHNSWFlat(DIMENSIONS, 8))
+    index.add_with_ids(vectors, np.arange(NUMBER_OF_VECTORS))
+    index_file_path = checkpoint_store.index_file_path(checkpoint)
+    faiss.write_index(index, index_file_path)
+    with open(index_file_path, "rb") as f:
+        index_file_data = f.read()
+    assert len(index_file_data) > PART_SIZE
+    checkpoint_store.mark_built(checkpoint, index_file_path)
+    assert checkpoint.stage == UPLOAD_STAGE
+    # The worker died after the first part of the index was uploaded
+    upload_id = s3.create_multipart_upload(Bucket=BUCKET, Key=get_index_file(request))["UploadId"]
+    checkpoint_store.mark_upload_created(checkpoint, upload_id, PART_SIZE)
+    response = s3.upload_part(Bucket=BUCKET, Key=get_index_file(request), PartNumber=1, UploadId=upload_id,
+                              Body=index_file_data[:PART_SIZE])
+    checkpoint_store.mark_part_uploaded(checkpoint, {"PartNumber": 1, "ETag": response["ETag"]})
+    parts.clear()
+
+    job, index_data = resume_job(s3)
+
+    assert sorted(parts) == list(range(2, len(index_file_data) // PART_SIZE + 2))
+    assert job.result.stats["upload_stats"]["resumed_parts"] == 1
+    assert index_data == index_file_data
+    assert checkpoint_store.load_all() == []
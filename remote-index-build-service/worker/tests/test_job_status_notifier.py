@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import index_builder.job_status_notifier as job_status_notifier
+from index_builder.job_status_notifier import JobStatusNotifier
+from index_builder.job_store import JobDetails
+
+
+class StubCoordinator:
+    """
+    Answers the job status pushes like the coordinator: 409 while the worker is not registered, 400 for the job
+    statuses without a status, and 200 once the status is applied
+    """
+
+    def __init__(self):
+        self.registered = False
+        self.received = []
+        self.rejected = []
+        coordinator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                job_status = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if not coordinator.registered:
+                    status = 409
+                elif job_status.get("status") is None:
+                    status = 400
+                else:
+                    status = 200
+                (coordinator.received if status == 200 else coordinator.rejected).append((status, job_status))
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def register(self):
+        self.registered = True
+
+
+@pytest.fixture
+def coordinator(monkeypatch):
+    monkeypatch.setattr(job_status_notifier, "RETRY_BASE_DELAY", 0.01)
+    coordinator = StubCoordinator()
+    yield coordinator
+    coordinator.server.shutdown()
+
+
+def wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("Timed out")
+
+
+def test_registers_again_when_the_coordinator_does_not_know_the_worker(coordinator):
+    registrations = []
+    notifier = JobStatusNotifier("http", "127.0.0.1", coordinator.port, "10.0.0.1", 6005,
+                                 register_worker=lambda: (registrations.append(1), coordinator.register()))
+
+    notifier.notify(JobDetails(id="job-1", status="completed", result={"stats": {}}))
+
+    wait_for(lambda: len(coordinator.received) == 1)
+    assert [status for status, _ in coordinator.rejected] == [409]
+    assert len(registrations) == 1
+    assert coordinator.received[0][1]["job_id"] == "job-1" and coordinator.received[0][1]["status"] == "completed"
+
+
+def test_keeps_the_pushes_until_the_worker_is_registered(coordinator):
+    notifier = JobStatusNotifier("http", "127.0.0.1", coordinator.port, "10.0.0.1", 6005)
+
+    notifier.notify(JobDetails(id="job-1", status="running"))
+    wait_for(lambda: len(coordinator.rejected) >= 2)
+    # The worker registers on its own, like on a restart
+    coordinator.register()
+
+    wait_for(lambda: len(coordinator.received) == 1)
+    assert coordinator.received[0][1]["status"] == "running"
+
+
+def test_drops_the_invalid_pushes(coordinator):
+    coordinator.register()
+    notifier = JobStatusNotifier("http", "127.0.0.1", coordinator.port, "10.0.0.1", 6005)
+
+    notifier.notify(JobDetails(id="job-1", status=None))
+    notifier.notify(JobDetails(id="job-2", status="completed"))
+
+    wait_for(lambda: len(coordinator.received) == 1)
+    assert [status for status, _ in coordinator.rejected] == [400]
+    assert coordinator.received[0][1]["job_id"] == "job-2"
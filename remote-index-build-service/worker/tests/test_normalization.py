@@ -0,0 +1,76 @@
+import numpy as np
+
+from index_builder.normalization import normalize_in_place, normalized
+from vector_data_accessor.accessor import VectorsDataset
+
+DIMENSIONS = 16
+
+
+def random_vectors(number_of_vectors: int) -> np.ndarray:
+    return np.random.default_rng(0).standard_normal((number_of_vectors, DIMENSIONS), dtype=np.float32)
+
+
+def expected_normalized(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=vectors.copy(), where=norms > 0)
+
+
+def test_rows_are_normalized_and_zero_rows_are_left_as_they_are():
+    vectors = random_vectors(100)
+    vectors[[0, 57, 99]] = 0
+    expected = expected_normalized(vectors)
+
+    normalize_in_place(vectors)
+
+    np.testing.assert_allclose(vectors, expected, rtol=1e-6)
+    assert not vectors[[0, 57, 99]].any()
+    np.testing.assert_allclose(np.linalg.norm(np.delete(vectors, [0, 57, 99], axis=0), axis=1), 1, rtol=1e-6)
+
+
+def test_rows_are_normalized_across_the_block_boundaries():
+    vectors = random_vectors(103)
+    expected = expected_normalized(vectors)
+    # 5 rows per block, so the last block is partial
+    normalize_in_place(vectors, block_bytes=5 * DIMENSIONS * 4)
+
+    np.testing.assert_allclose(vectors, expected, rtol=1e-6)
+
+
+def test_threads_normalize_like_a_single_thread():
+    vectors = random_vectors(1001)
+    single_thread = vectors.copy()
+    normalize_in_place(single_thread, 1, block_bytes=7 * DIMENSIONS * 4)
+
+    normalize_in_place(vectors, 4, block_bytes=7 * DIMENSIONS * 4)
+
+    np.testing.assert_array_equal(vectors, single_thread)
+
+
+def test_writable_vectors_are_not_copied():
+    vectors = random_vectors(10)
+
+    assert normalized(vectors) is vectors
+    np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1, rtol=1e-6)
+
+
+def test_memory_mapped_vectors_are_normalized_in_a_writable_mapping(tmp_path):
+    vectors = random_vectors(50)
+    expected = expected_normalized(vectors)
+    owned_file, cached_file = tmp_path / "owned.vec", tmp_path / "cached.vec"
+    owned_file.write_bytes(vectors.tobytes())
+    cached_file.write_bytes(vectors.tobytes())
+
+    def memory_mapped(path, vector_file):
+        return VectorsDataset(vectors=np.memmap(path, dtype=np.float32, mode='r', shape=vectors.shape), ids=None,
+                              dimensions=DIMENSIONS, vector_file=vector_file)
+
+    # The file downloaded for the job is normalized in place
+    owned = memory_mapped(owned_file, str(owned_file)).get_writable_vectors()
+    assert isinstance(owned, np.memmap) and normalized(owned) is owned
+    owned.flush()
+    np.testing.assert_allclose(np.fromfile(owned_file, dtype=np.float32).reshape(vectors.shape), expected, rtol=1e-6)
+    # The other files, like the files of the vector cache, are mapped copy on write and left as they are
+    cached = memory_mapped(cached_file, None).get_writable_vectors()
+    assert isinstance(cached, np.memmap) and normalized(cached) is cached
+    np.testing.assert_allclose(cached, expected, rtol=1e-6)
+    assert cached_file.read_bytes() == vectors.tobytes()
@@ -0,0 +1,40 @@
+import numpy as np
+
+import index_builder.cpu.create_cpu_index as create_cpu_index
+from index_builder.cpu.create_cpu_index import create_index, sample_rows
+from vector_data_accessor.accessor import VectorsDataset
+
+NUMBER_OF_VECTORS = 5000
+DIMENSIONS = 16
+
+
+def build(tmp_path, index_parameters: dict) -> dict:
+    vectors = np.random.default_rng(0).random((NUMBER_OF_VECTORS, DIMENSIONS), dtype=np.float32)
+    dataset = VectorsDataset(vectors=vectors, ids=np.arange(NUMBER_OF_VECTORS) * 3, dimensions=DIMENSIONS)
+    return create_index(dataset, index_parameters, "l2", str(tmp_path / "index.faiss"), 1)
+
+
+def test_recall_is_not_measured_by_default(tmp_path):
+    stats = build(tmp_path, {})
+
+    assert stats["recall"] is None and stats["recallSampleSize"] == 0 and stats["recallTime"] == 0
+
+
+def test_recall_queries_are_held_out_of_the_ground_truth():
+    train_rows, query_rows, ground_truth_rows = sample_rows(NUMBER_OF_VECTORS, 1000, 100, 2000)
+
+    assert len(train_rows) == 1000 and len(query_rows) == 100 and len(ground_truth_rows) == 2000
+    assert len(np.intersect1d(query_rows, ground_truth_rows)) == 0
+    assert len(np.intersect1d(query_rows, train_rows)) == 0
+
+
+def test_recall_is_measured_among_the_ground_truth(monkeypatch, tmp_path):
+    monkeypatch.setattr(create_cpu_index, "recall_sample_size", 100)
+    monkeypatch.setattr(create_cpu_index, "recall_ground_truth_size", 2000)
+
+    good = build(tmp_path, {"ef_search": 128})
+    poor = build(tmp_path, {"m": 2, "ef_construction": 2})
+
+    assert good["recallSampleSize"] == 100 and good["recallGroundTruthSize"] == 2000 and good["recallK"] == 10
+    # A query can't find itself, so a poor graph has a poor recall
+    assert good["recall"] > 0.95 and poor["recall"] < good["recall"] - 0.2
@@ -0,0 +1,48 @@
+import pytest
+
+import index_builder.vector_index_builder as vector_index_builder
+from index_builder.vector_index_builder import validate_create_index_request
+from models.data_model import IndexTypes, build_create_index_request
+
+
+def create_index_request(space_type: str = "l2", vector_data_type: str = "float32", **index_parameters):
+    return build_create_index_request({"bucket_name": "bucket", "object_location": "vectors.knnvec",
+                                       "number_of_vectors": 1000, "dimensions": 64, "space_type": space_type,
+                                       "vector_data_type": vector_data_type, "index_parameters": index_parameters})
+
+
+@pytest.fixture
+def gpu_worker(monkeypatch):
+    monkeypatch.setattr(vector_index_builder, "index_type", IndexTypes.GPU)
+
+
+@pytest.mark.parametrize("factory_string", ["HNSW16,Garbage", "HNSW32,PQ7", "HNSW32,IVF16"])
+def test_cpu_builds_reject_the_factory_strings_faiss_can_not_build(factory_string):
+    with pytest.raises(ValueError, match="factory_string"):
+        validate_create_index_request(create_index_request(factory_string=factory_string))
+
+
+@pytest.mark.parametrize("factory_string", ["HNSW32,SQ8", "HNSW16,PQ8x8", "HNSW32_PQ8"])
+def test_cpu_builds_accept_the_hnsw_factory_strings(factory_string):
+    validate_create_index_request(create_index_request(factory_string=factory_string))
+
+
+@pytest.mark.parametrize("index_parameters", [{"m": 32}, {"ef_construction": 200}, {"encoder": "sq8"},
+                                              {"factory_string": "HNSW32,SQ8"}])
+def test_gpu_builds_reject_the_cpu_parameters(gpu_worker, index_parameters):
+    with pytest.raises(ValueError, match="only supported by the CPU builds"):
+        validate_create_index_request(create_index_request(**index_parameters))
+
+
+def test_gpu_builds_accept_the_gpu_parameters(gpu_worker):
+    validate_create_index_request(create_index_request(graph_degree=32, intermediate_graph_degree=64, ef_search=128,
+                                                       pq_dim=8))
+
+
+def test_gpu_builds_reject_the_binary_vectors(gpu_worker):
+    with pytest.raises(ValueError, match="Binary vectors"):
+        validate_create_index_request(create_index_request("hamming", "binary"))
+
+
+def test_cpu_builds_accept_the_binary_vectors():
+    validate_create_index_request(create_index_request("hamming", "binary"))
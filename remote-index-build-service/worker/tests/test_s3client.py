@@ -0,0 +1,179 @@
+import io
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+import s3.s3client as s3client
+from tests.conftest import BUCKET, put_object
+from utils.cancellation import CancellationToken, JobCancelledError
+from utils.compression import CompressedWriter, ZSTD
+
+RANGE_SIZE = 256 * 1024
+CHUNK_SIZE = 32 * 1024
+
+
+class SlowBody:
+    """Response body which takes a while for every read, so that the ranges are still downloading when one fails"""
+
+    def __init__(self, body, read_bytes):
+        self._body = body
+        self._read_bytes = read_bytes
+
+    def read(self, size=-1):
+        time.sleep(0.02)
+        data = self._body.read(size)
+        self._read_bytes.append(len(data))
+        return data
+
+    def close(self):
+        self._body.close()
+
+
+def record_gets(monkeypatch, failing_start=None):
+    """Records the ranges requested from S3 and the bytes read, the range at failing_start always fails"""
+    requested, read_bytes = [], []
+    get_object = s3client.s3_client.get_object
+
+    def recording_get_object(**kwargs):
+        start = int(kwargs["Range"].split("=")[1].split("-")[0])
+        requested.append(start)
+        if start == failing_start:
+            raise ClientError({"Error": {"Code": "InternalError", "Message": "injected"}}, "GetObject")
+        response = get_object(**kwargs)
+        response["Body"] = SlowBody(response["Body"], read_bytes)
+        return response
+
+    monkeypatch.setattr(s3client.s3_client, "get_object", recording_get_object)
+    return requested, read_bytes
+
+
+def test_download_in_parallel(s3, monkeypatch):
+    data = put_object(s3, "vectors.knnvec", 10 * RANGE_SIZE + 5)
+    requested, _ = record_gets(monkeypatch)
+
+    path, stats = s3client.download_s3_file_in_parallel(BUCKET, "vectors.knnvec", range_size=RANGE_SIZE,
+                                                        max_workers=4, chunk_size=CHUNK_SIZE)
+    try:
+        with open(path, "rb") as f:
+            assert f.read() == data
+        assert sorted(requested) == list(range(0, len(data), RANGE_SIZE))
+        assert stats["size"] == len(data)
+    finally:
+        os.remove(path)
+
+
+def test_failed_range_stops_the_other_ranges(s3, monkeypatch, tmp_path):
+    put_object(s3, "vectors.knnvec", 32 * RANGE_SIZE)
+    requested, read_bytes = record_gets(monkeypatch, failing_start=RANGE_SIZE)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+
+    t1 = time.monotonic()
+    with pytest.raises(ClientError):
+        s3client.download_s3_file_in_parallel(BUCKET, "vectors.knnvec", range_size=RANGE_SIZE, max_workers=2,
+                                              chunk_size=CHUNK_SIZE)
+    # A range is 8 slow reads, all 32 ranges on 2 threads would take over 2.5s
+    assert time.monotonic() - t1 < 1
+    # The ranges still queued were never started and the running ones stopped at their next read
+    assert len(set(requested) - {RANGE_SIZE}) <= 2
+    assert sum(read_bytes) < 2 * RANGE_SIZE
+    # The temp file of the failed download is removed
+    assert os.listdir(tmp_path) == []
+
+
+def test_cancelled_download_stops(s3, monkeypatch):
+    put_object(s3, "vectors.knnvec", 32 * RANGE_SIZE)
+    requested, read_bytes = record_gets(monkeypatch)
+    cancellation = CancellationToken()
+    threading.Timer(0.1, cancellation.cancel).start()
+
+    with pytest.raises(JobCancelledError):
+        s3client.download_s3_file_in_parallel(BUCKET, "vectors.knnvec", range_size=RANGE_SIZE, max_workers=2,
+                                              chunk_size=CHUNK_SIZE, cancellation=cancellation)
+    assert len(requested) < 32
+    assert sum(read_bytes) < 32 * RANGE_SIZE
+
+
+def test_failed_range_stops_the_compressed_download(s3, monkeypatch):
+    compressed = io.BytesIO()
+    writer = CompressedWriter(compressed, ZSTD)
+    writer.write(os.urandom(32 * RANGE_SIZE))
+    writer.close()
+    s3.put_object(Bucket=BUCKET, Key="vectors.knnvec.zst", Body=compressed.getvalue())
+    requested, read_bytes = record_gets(monkeypatch, failing_start=RANGE_SIZE)
+
+    with pytest.raises(ClientError):
+        s3client.download_compressed_s3_object(BUCKET, "vectors.knnvec.zst", ZSTD, lambda data, offset: None,
+                                               range_size=RANGE_SIZE, max_workers=2, chunk_size=CHUNK_SIZE,
+                                               max_in_flight_bytes=4 * RANGE_SIZE)
+    assert len(set(requested) - {RANGE_SIZE}) <= 3
+    assert sum(read_bytes) < 3 * RANGE_SIZE
+
+
+def test_buffer_slice_reads_views_of_the_buffer():
+    buffer = bytearray(b"0123456789")
+    body = s3client.BufferSlice(buffer, 2, 8)
+
+    data = body.read(3)
+    assert isinstance(data, memoryview) and data.obj is buffer
+    assert bytes(data) == b"234"
+    target = bytearray(10)
+    assert body.readinto(target) == 3 and target[:3] == b"567"
+    assert body.read() == b""
+    assert body.seek(1) == 1 and bytes(body.read()) == b"34567"
+    assert len(body) == 6
+
+
+def test_upload_file_from_memory_map(s3, monkeypatch, tmp_path):
+    path = tmp_path / "index"
+    data = os.urandom(12 * 1024 * 1024 + 3)
+    path.write_bytes(data)
+    monkeypatch.setattr(s3client, "chunk_size", 5 * 1024 * 1024)
+    done = []
+
+    stats = s3client.upload_file(str(path), "index.faiss", BUCKET, on_part_done=done.append)
+
+    assert s3.get_object(Bucket=BUCKET, Key="index.faiss")["Body"].read() == data
+    assert stats["parts"] == 3 and sorted(part["PartNumber"] for part in done) == [1, 2, 3]
+
+
+def test_upload_stream_reuses_its_buffers(s3):
+    data = os.urandom(17 * 1024 * 1024)
+    part_size = 5 * 1024 * 1024
+
+    with s3client.MultipartUploadStream(BUCKET, "index.faiss", part_size=part_size, max_in_flight_parts=2) as stream:
+        for offset in range(0, len(data), 1024 * 1024):
+            stream.write(data[offset:offset + 1024 * 1024])
+
+    assert s3.get_object(Bucket=BUCKET, Key="index.faiss")["Body"].read() == data
+    assert stream._allocated_buffers <= 2
+
+
+def test_failed_part_stops_the_upload_of_the_file(s3, monkeypatch, tmp_path):
+    path = tmp_path / "index"
+    path.write_bytes(os.urandom(4 * 5 * 1024 * 1024))
+    monkeypatch.setattr(s3client, "chunk_size", 5 * 1024 * 1024)
+    monkeypatch.setattr(s3client, "RETRY_BASE_DELAY", 0.01)
+    attempts = []
+    upload_part = s3client.s3_client.upload_part
+
+    def failing_upload_part(**kwargs):
+        attempts.append(kwargs["PartNumber"])
+        if kwargs["PartNumber"] == 1:
+            # The view of the part read before the failure is kept by the traceback of the error
+            data = kwargs["Body"].read(1024)
+            raise ClientError({"Error": {"Code": "InternalError", "Message": "injected"}}, "UploadPart")
+        time.sleep(0.5)
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(s3client.s3_client, "upload_part", failing_upload_part)
+
+    with pytest.raises(ClientError):
+        s3client.upload_file(str(path), "index.faiss", BUCKET)
+
+    # The part uploading alongside the failed part completes, the parts after it never start
+    assert sorted(attempts) == [1] * s3client.upload_retries + [2]
+    assert s3.list_multipart_uploads(Bucket=BUCKET).get("Uploads", []) == []
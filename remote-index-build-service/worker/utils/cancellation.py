@@ -0,0 +1,30 @@
+import threading
+
+
+class JobCancelledError(Exception):
+    """Raised by the steps of a job once the job is cancelled"""
+
+
+class CancellationToken:
+    """
+    Tells the steps of a job that the job is cancelled. The steps check the token between their units of work, like
+    between the reads of a download or between the chunks of vectors added to an index, and stop by raising
+    JobCancelledError. A token with a parent is also cancelled once its parent is, e.g. to stop the other parts of a
+    step once one of them fails without cancelling the whole job.
+    """
+
+    def __init__(self, parent: 'CancellationToken' = None):
+        self._cancelled = threading.Event()
+        self._parent = parent
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set() or (self._parent is not None and self._parent.is_cancelled())
+
+
+def raise_if_cancelled(cancellation: CancellationToken, message: str = "The job was cancelled"):
+    """Raise JobCancelledError when the token, which can be None for the jobs which can't be cancelled, is cancelled"""
+    if cancellation is not None and cancellation.is_cancelled():
+        raise JobCancelledError(message)
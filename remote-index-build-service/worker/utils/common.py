@@ -1,9 +1,24 @@
 import math
 import os
+import resource
+import shutil
 
 def get_omp_num_threads():
     return max(math.floor(os.cpu_count()-2), 1)
 
+def get_total_memory():
+    """Returns the physical memory of the machine in bytes"""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
 def delete_file(file_path):
     if os.path.exists(file_path):
-        os.remove(file_path)
\ No newline at end of file
+        os.remove(file_path)
+
+def get_peak_rss():
+    """Returns the peak resident set size of the process in bytes"""
+    # On linux ru_maxrss is reported in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_free_disk(path):
+    """Returns the free space in bytes of the file system holding the path"""
+    return shutil.disk_usage(path).free
@@ -0,0 +1,112 @@
+from typing import Optional
+
+# Framed compression formats of the vector objects and of the index files. The packages of the formats are optional,
+# they are only imported when an object or an index file is compressed with them
+ZSTD = 'zstd'
+LZ4 = 'lz4'
+COMPRESSIONS = [ZSTD, LZ4]
+PACKAGES = {ZSTD: 'zstandard', LZ4: 'lz4'}
+# Key extensions of the compressed objects, the first one is used for the index files
+EXTENSIONS = {ZSTD: ['.zst', '.zstd'], LZ4: ['.lz4']}
+# Content-Encoding of the compressed S3 objects, which takes precedence over the key extension
+CONTENT_ENCODINGS = {'zstd': ZSTD, 'lz4': LZ4, 'x-lz4': LZ4}
+DEFAULT_ZSTD_LEVEL = 3
+
+
+def get_compression(object_key: str, content_encoding: str = None) -> Optional[str]:
+    """Returns the compression of an object from its Content-Encoding, or from the extension of its key, if any"""
+    if content_encoding:
+        compression = CONTENT_ENCODINGS.get(content_encoding.strip().lower())
+        if compression is not None:
+            return compression
+    for compression, extensions in EXTENSIONS.items():
+        if any(object_key.lower().endswith(extension) for extension in extensions):
+            return compression
+    return None
+
+
+def get_extension(compression: str) -> str:
+    return EXTENSIONS[compression][0]
+
+
+def _import_codec(compression: str):
+    try:
+        if compression == ZSTD:
+            import zstandard
+            return zstandard
+        if compression == LZ4:
+            import lz4.frame
+            return lz4.frame
+    except ImportError as e:
+        raise ImportError(f"The {compression} compression needs the {PACKAGES[compression]} package") from e
+    raise ValueError(f"Unsupported compression {compression}, valid values are {COMPRESSIONS}")
+
+
+class FramedDecoder:
+    """
+    Decodes a compressed stream which is fed chunk by chunk in order. The stream can be made of several concatenated
+    frames, like the output of a parallel compressor, a new frame is started once the previous one ends.
+    """
+
+    def __init__(self, compression: str):
+        self.compression = compression
+        self._codec = _import_codec(compression)
+        self._decoder = self._new_decoder()
+        self._in_frame = False
+
+    def _new_decoder(self):
+        if self.compression == ZSTD:
+            return self._codec.ZstdDecompressor().decompressobj()
+        return self._codec.LZ4FrameDecompressor()
+
+    def decode(self, data) -> bytes:
+        chunks = []
+        while len(data) > 0:
+            chunks.append(self._decoder.decompress(data))
+            self._in_frame = not self._decoder.eof
+            if self._in_frame:
+                break
+            # lz4 has no unused data when the frame ends with the chunk
+            data = self._decoder.unused_data or b""
+            self._decoder = self._new_decoder()
+        return b"".join(chunks)
+
+    def finish(self):
+        """Raises ValueError when the stream ended in the middle of a frame"""
+        if self._in_frame:
+            raise ValueError(f"The {self.compression} stream ended in the middle of a frame")
+
+
+class CompressedWriter:
+    """
+    Compresses the bytes written to it into a single frame which is written to the destination, any object with a
+    write method like a file or the MultipartUploadStream. close ends the frame, it doesn't close the destination.
+    size is the number of bytes written before the compression, and compressed_size the number of bytes written to
+    the destination.
+    """
+
+    def __init__(self, destination, compression: str, level: int = None, threads: int = 0):
+        codec = _import_codec(compression)
+        self.compression = compression
+        self.size = 0
+        self.compressed_size = 0
+        self._destination = destination
+        if compression == ZSTD:
+            # zstd compresses the blocks of a single frame with several threads
+            self._compressor = codec.ZstdCompressor(level=level or DEFAULT_ZSTD_LEVEL, threads=threads).compressobj()
+        else:
+            self._compressor = codec.LZ4FrameCompressor(compression_level=level or 0)
+            self._emit(self._compressor.begin())
+
+    def write(self, data) -> int:
+        self._emit(self._compressor.compress(data))
+        self.size += len(data)
+        return len(data)
+
+    def close(self):
+        self._emit(self._compressor.flush())
+
+    def _emit(self, data):
+        if len(data) > 0:
+            self._destination.write(data)
+            self.compressed_size += len(data)
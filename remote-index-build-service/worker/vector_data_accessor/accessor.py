@@ -1,8 +1,30 @@
-from dataclasses import dataclass
+import contextlib
+from dataclasses import dataclass, field
+import logging
+import os
+import tempfile
 
 import numpy as np
-from models.data_model import CreateIndexRequest
+from models.data_model import CreateIndexRequest, IngestionModes
 import s3.s3client as s3
+from utils.cancellation import CancellationToken
+from utils.compression import get_compression
+from vector_data_accessor.vector_cache import CacheEntry, VectorCache
+
+logger = logging.getLogger(__name__)
+
+# Since this is an env property lets init this during the start of the service
+ingestion_mode = IngestionModes.from_str(os.getenv('VECTOR_INGESTION_MODE', 'file').lower())
+# Disk cache of the downloaded vector objects, which is disabled when no directory is set
+vector_cache_dir = os.getenv('VECTOR_CACHE_DIR')
+vector_cache_max_bytes = int(os.getenv('VECTOR_CACHE_MAX_BYTES', 1024*1024*1024*20)) # 20GB
+vector_cache = VectorCache(vector_cache_dir, vector_cache_max_bytes) if vector_cache_dir is not None else None
+
+# The ids are little-endian, as they are written by Java applications
+ID_DTYPES = {
+    'int32': '<i4',
+    'int64': '<i8'
+}
 
 
 @dataclass
@@ -10,20 +32,345 @@ class VectorsDataset:
     vectors: np.ndarray
     ids: np.array
     dimensions: int
+    download_stats: dict = field(default_factory=dict)
+    # Set when the vectors are memory mapped from a downloaded file, which is removed once the vectors are freed
+    vector_file: str = None
+    # Set when the vectors are memory mapped from the vector cache, the entry is released once the vectors are freed
+    cache_entry: CacheEntry = None
+    # The vectors keep the type of the vector object, a binary vector is a row of dimensions / 8 bytes
+    vector_data_type: str = 'float32'
 
     def free_vectors_space(self):
-        del self.vectors
-        del self.ids
+        # Drop the references rather than deleting the attributes, so this can be called more than once
+        self.vectors = None
+        self.ids = None
+        if self.vector_file is not None:
+            s3.cleanup_temp_file(self.vector_file)
+            self.vector_file = None
+        if self.cache_entry is not None:
+            self.cache_entry.release()
+            self.cache_entry = None
+
+    def get_size(self) -> int:
+        """The bytes of the vectors and of the ids of the dataset"""
+        return sum(array.nbytes for array in (self.vectors, self.ids) if array is not None)
+
+    def is_memory_mapped(self) -> bool:
+        return isinstance(self.vectors, np.memmap)
+
+    def get_writable_vectors(self) -> np.ndarray:
+        """
+        Returns the vectors in an array which can be written in place, without copying them. The memory mapped vectors
+        are mapped again: the file downloaded for the job is written in place, as it is removed once the vectors are
+        freed, while the files of the vector cache or of a checkpoint are mapped copy on write, so they are never
+        modified.
+        """
+        if not self.is_memory_mapped() or self.vectors.flags.writeable:
+            return self.vectors
+        return np.memmap(self.vectors.filename, dtype=self.vectors.dtype, mode='r+' if self.vector_file is not None else 'c',
+                         offset=self.vectors.offset, shape=self.vectors.shape)
 
     @staticmethod
-    def get_vector_dataset(createIndexRequest: CreateIndexRequest):
-        if not s3.check_s3_object_exists(createIndexRequest.bucketName, createIndexRequest.objectLocation):
+    def get_vector_dataset(createIndexRequest: CreateIndexRequest, vector_file: str = None, completed_ranges=None,
+                           on_range_done=None, cancellation: CancellationToken = None):
+        """
+        Download the vectors and the ids of the request. When vector_file is set, the vectors are downloaded to
+        that file, skipping the completed_ranges which are already downloaded, and the file is left in place for
+        the caller to remove. on_range_done is called with the start and end byte of every downloaded range. These
+        only apply to the file and mmap ingestion modes, as the stream mode doesn't write the vectors to a file.
+
+        In the file and mmap ingestion modes the vector cache, when enabled, is looked up before downloading the
+        vectors, in which case vector_file is not used.
+
+        When the request is a shard only its byte range of the vectors, and its ids, are downloaded. The ids
+        of a shard are the ids of its vectors in the whole object.
+
+        The vectors keep the vector data type of the request, they are read or memory mapped without any
+        conversion, and the builders convert them to float32 where faiss needs it.
+
+        A vector object compressed with zstd or lz4, as told by its Content-Encoding or its key extension, is
+        decoded while it is downloading, see __download_compressed. Its download is neither cached nor resumed.
+
+        All the downloads stop with JobCancelledError once the cancellation token is cancelled.
+        """
+        object_metadata = s3.get_s3_object_metadata(createIndexRequest.bucketName, createIndexRequest.objectLocation)
+        if object_metadata is None:
             raise TypeError(f"{createIndexRequest.objectLocation} does not exist in the bucket : {createIndexRequest.bucketName}")
-        vector_file = s3.download_s3_file_in_chunks(createIndexRequest.bucketName, createIndexRequest.objectLocation)
-        return VectorsDataset.__parse(vector_file, createIndexRequest.dimensions, createIndexRequest.numberOfVectors)
+        object_size = object_metadata["size"]
+        id_dtype = ID_DTYPES[createIndexRequest.idDataType]
+        compression = get_compression(createIndexRequest.objectLocation, object_metadata.get("content_encoding"))
+        # The size of a compressed object is only known once it is decoded, along with its trailing ids
+        read_trailing_ids = createIndexRequest.idObjectLocation is None and compression is None and \
+            VectorsDataset.__has_trailing_ids(object_size, createIndexRequest, id_dtype)
+        # The trailing ids of a shard are not next to its vectors, so they are downloaded on their own
+        read_shard_trailing_ids = read_trailing_ids and createIndexRequest.is_shard()
+        read_trailing_ids = read_trailing_ids and not read_shard_trailing_ids
+        vector_dtype, vector_width = createIndexRequest.get_vector_dtype(), createIndexRequest.get_vector_width()
+
+        if compression is not None:
+            dataset = VectorsDataset.__download_compressed(createIndexRequest, compression, id_dtype, cancellation)
+            read_trailing_ids = dataset.ids is not None
+        elif ingestion_mode == IngestionModes.STREAM:
+            dataset = VectorsDataset.__stream(createIndexRequest, read_trailing_ids, id_dtype,
+                                              cancellation=cancellation)
+        else:
+            keep_vector_file = vector_file is not None
+            vector_file, cache_entry, download_stats = VectorsDataset.__download_vector_file(
+                createIndexRequest, object_metadata, vector_file, completed_ranges, on_range_done, cancellation)
+            # A temp file is removed once the vectors are read, while a cached file is released to the cache
+            owned_vector_file = vector_file if cache_entry is None and not keep_vector_file else None
+            try:
+                if ingestion_mode == IngestionModes.MMAP:
+                    dataset = VectorsDataset.__memory_map(vector_file, vector_width, createIndexRequest.numberOfVectors,
+                                                          read_trailing_ids, id_dtype, vector_dtype)
+                    dataset.vector_file = owned_vector_file
+                    dataset.cache_entry = cache_entry
+                else:
+                    dataset = VectorsDataset.__parse(vector_file, vector_width, createIndexRequest.numberOfVectors,
+                                                     read_trailing_ids, id_dtype, vector_dtype)
+            except Exception:
+                VectorsDataset.__release_vector_file(owned_vector_file, cache_entry)
+                raise
+            if ingestion_mode != IngestionModes.MMAP:
+                # The vectors are now in memory, so the downloaded file is not needed anymore
+                VectorsDataset.__release_vector_file(owned_vector_file, cache_entry)
+            dataset.download_stats = download_stats
+        # The rows of binary vectors are narrower than their dimensions
+        dataset.dimensions = createIndexRequest.dimensions
+        dataset.vector_data_type = createIndexRequest.vectorDataType
+
+        try:
+            if createIndexRequest.idObjectLocation is not None:
+                dataset.ids, dataset.download_stats["ids"] = VectorsDataset.__download_ids(
+                    createIndexRequest, id_dtype, cancellation)
+                dataset.download_stats["ids_source"] = "id_object"
+            elif read_shard_trailing_ids:
+                dataset.ids = np.empty(createIndexRequest.numberOfVectors, dtype=id_dtype)
+                dataset.download_stats["ids"] = s3.download_s3_object_into_buffer(
+                    createIndexRequest.bucketName, createIndexRequest.objectLocation, dataset.ids,
+                    start_byte=VectorsDataset.__trailing_ids_offset(createIndexRequest, id_dtype), cancellation=cancellation)
+                dataset.download_stats["ids_source"] = "trailing_section"
+            elif read_trailing_ids:
+                dataset.download_stats["ids_source"] = "trailing_section"
+            else:
+                dataset.ids = np.arange(createIndexRequest.vectorOffset,
+                                        createIndexRequest.vectorOffset + createIndexRequest.numberOfVectors, dtype=np.int64)
+                dataset.download_stats["ids_source"] = "generated"
+        except Exception:
+            # The vectors can be memory mapped from a file or from the cache, which should not be leaked
+            dataset.free_vectors_space()
+            raise
+        return dataset
+
+    @staticmethod
+    def __vectors_byte_range(createIndexRequest: CreateIndexRequest):
+        """Returns the byte range of the vectors of the request in the vector object"""
+        vector_size = createIndexRequest.get_vector_size()
+        start_byte = createIndexRequest.vectorOffset * vector_size
+        return start_byte, start_byte + createIndexRequest.numberOfVectors * vector_size
+
+    @staticmethod
+    def __trailing_ids_offset(createIndexRequest: CreateIndexRequest, id_dtype: str):
+        """Returns the offset in the vector object of the first trailing id of the request"""
+        vectors_size = createIndexRequest.get_total_number_of_vectors() * createIndexRequest.get_vector_size()
+        return vectors_size + createIndexRequest.vectorOffset * np.dtype(id_dtype).itemsize
+
+    @staticmethod
+    def __download_vector_file(createIndexRequest: CreateIndexRequest, object_metadata: dict, vector_file: str = None,
+                               completed_ranges=None, on_range_done=None, cancellation: CancellationToken = None):
+        """
+        Download the vector object to a file, going through the vector cache when it is enabled. Returns the path
+        of the file, the pinned cache entry of the file if it is cached, and the download stats. The stats tell
+        whether the object was a cache hit or a cache miss, or whether it bypassed a cache which is too small for it.
+        Only the byte range of the vectors of a shard is downloaded, and cached.
+        """
+        start_byte, end_byte = 0, object_metadata["size"]
+        if createIndexRequest.is_shard():
+            start_byte, end_byte = VectorsDataset.__vectors_byte_range(createIndexRequest)
+        if vector_cache is not None:
+            download_stats = {}
+
+            def download(path):
+                _, stats = s3.download_s3_file_in_parallel(createIndexRequest.bucketName,
+                                                           createIndexRequest.objectLocation, file_path=path,
+                                                           start_byte=start_byte, end_byte=end_byte,
+                                                           cancellation=cancellation)
+                download_stats.update(stats)
+
+            cache_entry = vector_cache.get(createIndexRequest.bucketName, createIndexRequest.objectLocation,
+                                           object_metadata["etag"], end_byte - start_byte, download,
+                                           byte_range=(start_byte, end_byte) if createIndexRequest.is_shard() else None)
+            if cache_entry is not None:
+                if cache_entry.hit:
+                    download_stats = {"size": end_byte - start_byte, "size_unit": "bytes"}
+                download_stats["cache"] = "hit" if cache_entry.hit else "miss"
+                return cache_entry.path, cache_entry, download_stats
+        vector_file, download_stats = s3.download_s3_file_in_parallel(createIndexRequest.bucketName,
+                                                                      createIndexRequest.objectLocation,
+                                                                      file_path=vector_file,
+                                                                      completed_ranges=completed_ranges,
+                                                                      on_range_done=on_range_done,
+                                                                      start_byte=start_byte, end_byte=end_byte,
+                                                                      cancellation=cancellation)
+        if vector_cache is not None:
+            download_stats["cache"] = "bypass"
+        return vector_file, None, download_stats
+
+    @staticmethod
+    def __release_vector_file(owned_vector_file: str, cache_entry: CacheEntry):
+        if cache_entry is not None:
+            cache_entry.release()
+        elif owned_vector_file is not None:
+            s3.cleanup_temp_file(owned_vector_file)
+
+    @staticmethod
+    def __has_trailing_ids(object_size: int, createIndexRequest: CreateIndexRequest, id_dtype: str) -> bool:
+        """
+        The ids can be appended to the vector object as a trailing section of 1 id per vector. The section
+        is only used when the object size is exactly the size of the vectors plus the size of the ids.
+        """
+        number_of_vectors = createIndexRequest.get_total_number_of_vectors()
+        vectors_size = number_of_vectors * createIndexRequest.get_vector_size()
+        ids_size = number_of_vectors * np.dtype(id_dtype).itemsize
+        if object_size == vectors_size + ids_size:
+            return True
+        if object_size > vectors_size:
+            logger.warning(f"{createIndexRequest.objectLocation} has {object_size - vectors_size} bytes after the vectors "
+                           f"which don't match {number_of_vectors} ids of type {id_dtype}, ignoring them")
+        return False
+
+    @staticmethod
+    def __download_ids(createIndexRequest: CreateIndexRequest, id_dtype: str, cancellation: CancellationToken = None):
+        """
+        Download the ids from the companion id object straight into the id array. The id object must
+        contain exactly 1 little-endian id per vector of the vector object, a shard reads only its own ids.
+        """
+        ids = np.empty(createIndexRequest.numberOfVectors, dtype=id_dtype)
+        expected_size = createIndexRequest.get_total_number_of_vectors() * ids.itemsize
+        object_size = s3.get_s3_object_size(createIndexRequest.bucketName, createIndexRequest.idObjectLocation)
+        if object_size is None:
+            raise TypeError(f"{createIndexRequest.idObjectLocation} does not exist in the bucket : {createIndexRequest.bucketName}")
+        if object_size != expected_size:
+            raise ValueError(f"Expected {expected_size} bytes of ids in {createIndexRequest.idObjectLocation}, but got {object_size}")
+        download_stats = s3.download_s3_object_into_buffer(createIndexRequest.bucketName,
+                                                           createIndexRequest.idObjectLocation, ids,
+                                                           start_byte=createIndexRequest.vectorOffset * ids.itemsize,
+                                                           cancellation=cancellation)
+        return ids, download_stats
+
+    @staticmethod
+    def __stream(createIndexRequest: CreateIndexRequest, read_trailing_ids: bool = False, id_dtype: str = '<i8',
+                 cancellation: CancellationToken = None):
+        """
+        Download the vectors from S3 straight into a preallocated (numberOfVectors, dimensions) array,
+        without going through a temp file. This keeps a single copy of the vectors in memory and
+        doesn't need any space on the local disk. The trailing ids, if present, are downloaded the same way.
+        """
+        vectors = np.empty((createIndexRequest.numberOfVectors, createIndexRequest.get_vector_width()),
+                           dtype=createIndexRequest.get_vector_dtype())
+        start_byte, _ = VectorsDataset.__vectors_byte_range(createIndexRequest)
+        download_stats = s3.download_s3_object_into_buffer(createIndexRequest.bucketName,
+                                                           createIndexRequest.objectLocation, vectors,
+                                                           start_byte=start_byte, cancellation=cancellation)
+        ids = None
+        if read_trailing_ids:
+            ids = np.empty(createIndexRequest.numberOfVectors, dtype=id_dtype)
+            download_stats["ids"] = s3.download_s3_object_into_buffer(createIndexRequest.bucketName,
+                                                                      createIndexRequest.objectLocation, ids,
+                                                                      start_byte=VectorsDataset.__trailing_ids_offset(
+                                                                          createIndexRequest, id_dtype),
+                                                                      cancellation=cancellation)
+        return VectorsDataset(vectors=vectors, dimensions=createIndexRequest.dimensions, ids=ids,
+                              download_stats=download_stats)
+
+    @staticmethod
+    def __download_compressed(createIndexRequest: CreateIndexRequest, compression: str, id_dtype: str,
+                              cancellation: CancellationToken = None):
+        """
+        Download a compressed vector object and decode it in a single pass. Only the decoded bytes of the vectors of
+        the request are kept, straight in the vector array in the stream ingestion mode and in a temp file otherwise,
+        and so are its trailing ids, which are only used when the decoded object has the size of the vectors plus
+        the ids. A shard still downloads and decodes the whole object, as a compressed object can't be read from an
+        offset.
+        """
+        number_of_vectors = createIndexRequest.numberOfVectors
+        vectors_start, vectors_end = VectorsDataset.__vectors_byte_range(createIndexRequest)
+        ids = np.empty(number_of_vectors, dtype=id_dtype) if createIndexRequest.idObjectLocation is None else None
+        ids_start = VectorsDataset.__trailing_ids_offset(createIndexRequest, id_dtype)
+        ids_view = memoryview(ids).cast('B') if ids is not None else memoryview(b"")
+        vectors, vector_file, vectors_view = None, None, None
+        if ingestion_mode == IngestionModes.STREAM:
+            vectors = np.empty((number_of_vectors, createIndexRequest.get_vector_width()),
+                               dtype=createIndexRequest.get_vector_dtype())
+            vectors_view = memoryview(vectors).cast('B')
+        else:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".vec") as f:
+                vector_file = f.name
+        try:
+            with open(vector_file, 'wb') if vector_file is not None else contextlib.nullcontext() as f:
+                def write(data, offset):
+                    # Copy the parts of the decoded chunk which overlap the vectors and the trailing ids
+                    data = memoryview(data)
+                    sections = [(vectors_start, vectors_end, vectors_view), (ids_start, ids_start + len(ids_view), ids_view)]
+                    for start, end, target in sections:
+                        first, last = max(start, offset), min(end, offset + len(data))
+                        if first >= last:
+                            continue
+                        if target is None:
+                            f.write(data[first - offset:last - offset])
+                        else:
+                            target[first - start:last - start] = data[first - offset:last - offset]
+
+                decoded_size, download_stats = s3.download_compressed_s3_object(
+                    createIndexRequest.bucketName, createIndexRequest.objectLocation, compression, write,
+                    cancellation=cancellation)
+            if decoded_size < vectors_end:
+                raise ValueError(f"Expected at least {vectors_end} bytes of vectors in {createIndexRequest.objectLocation}, "
+                                 f"but got {decoded_size} decoded bytes")
+            if ids is not None and not VectorsDataset.__has_trailing_ids(decoded_size, createIndexRequest, id_dtype):
+                ids = None
+            if vector_file is None:
+                return VectorsDataset(vectors=vectors, dimensions=createIndexRequest.dimensions, ids=ids,
+                                      download_stats=download_stats)
+            if ingestion_mode == IngestionModes.MMAP:
+                dataset = VectorsDataset.__memory_map(vector_file, createIndexRequest.get_vector_width(), number_of_vectors,
+                                                      vector_dtype=createIndexRequest.get_vector_dtype())
+            else:
+                dataset = VectorsDataset.__parse(vector_file, createIndexRequest.get_vector_width(), number_of_vectors,
+                                                 vector_dtype=createIndexRequest.get_vector_dtype())
+                s3.cleanup_temp_file(vector_file)
+        except Exception:
+            if vector_file is not None:
+                s3.cleanup_temp_file(vector_file)
+            raise
+        dataset.ids = ids
+        dataset.download_stats = download_stats
+        return dataset
+
+    @staticmethod
+    def __memory_map(vector_file: str, dimension: int, number_of_vectors: int, read_trailing_ids: bool = False,
+                     id_dtype: str = '<i8', vector_dtype: str = '<f4'):
+        """
+        Memory map the downloaded vector file instead of reading it in memory. The index builders add
+        the vectors in bounded slices, so the page cache can evict the pages of the vectors which are
+        already inserted and the worker doesn't need RAM for both the dataset and the graph.
+        The trailing ids, if present, are memory mapped too.
+        """
+        vectors_size = number_of_vectors * dimension * np.dtype(vector_dtype).itemsize
+        expected_size = vectors_size
+        if read_trailing_ids:
+            expected_size += number_of_vectors * np.dtype(id_dtype).itemsize
+        file_size = os.path.getsize(vector_file)
+        if file_size < expected_size:
+            raise ValueError(f"Expected at least {expected_size} bytes, but got {file_size}")
+        vectors = np.memmap(vector_file, dtype=vector_dtype, mode='r', shape=(number_of_vectors, dimension))
+        ids = None
+        if read_trailing_ids:
+            ids = np.memmap(vector_file, dtype=id_dtype, mode='r', offset=vectors_size, shape=(number_of_vectors,))
+        return VectorsDataset(vectors=vectors, dimensions=dimension, ids=ids, vector_file=vector_file)
 
     @staticmethod
-    def __parse(vector_file: str, dimension: int, number_of_vectors: int,
+    def __parse(vector_file: str, dimension: int, number_of_vectors: int, read_trailing_ids: bool = False,
             id_dtype: str = '<i8', vector_dtype: str = '<f4'):
         """
         Parse binary vector data from a file into a VectorsDataset object.
@@ -36,6 +383,8 @@ class VectorsDataset:
             vector_file (str): Path to the binary file containing vector data.
             dimension (int): Number of dimensions for each vector.
             number_of_vectors (int): Total number of vectors to read from the file.
+            read_trailing_ids (bool, optional): Whether the vectors are followed by a section
+                of number_of_vectors ids. Defaults to False, in which case ids are None.
             id_dtype (str, optional): NumPy dtype for reading IDs.
                 Defaults to '<i8' (little-endian 64-bit integer).
             vector_dtype (str, optional): NumPy dtype for reading vector values.
@@ -46,7 +395,7 @@ class VectorsDataset:
 
         Raises:
             ValueError: If the number of values read doesn't match the expected size
-                (number_of_vectors * dimension).
+                (number_of_vectors * dimension), or if fewer than number_of_vectors ids are read.
             IOError: If there are issues reading the file.
             TypeError: If the file content doesn't match the expected data types.
 
@@ -55,16 +404,20 @@ class VectorsDataset:
             ...     'vectors.bin',
             ...     dimension=128,
             ...     number_of_vectors=1000,
+            ...     read_trailing_ids=True,
             ...     id_dtype='>i8',
             ...     vector_dtype='>f4'
             ... )
 
         Notes:
-            - The binary file should contain vectors in a contiguous block
+            - The binary file should contain vectors in a contiguous block, optionally
+              followed by a contiguous block of ids
             - Data is expected to be in little-endian format ('<') for Java compatibility
-            - Supported vector types:
+            - Supported vector types, see VECTOR_DATA_TYPES:
                 * '<f4': 32-bit float (Java float)
-                * '<f8': 64-bit float (Java double)
+                * '<f2': 16-bit float
+                * 'u1': unsigned byte, or 8 dimensions of a binary vector
+                * 'i1': signed byte (Java byte)
             - Supported ID types:
                 * '<i4': 32-bit integer (Java int)
                 * '<i8': 64-bit integer (Java long)
@@ -88,6 +441,9 @@ class VectorsDataset:
 
                 # Reshape the vectors array
             vectors = vectors.reshape(number_of_vectors, dimension)
-            # TODO: Take these ids from S3.
-            ids = np.array(range(number_of_vectors), dtype=np.int32)
+            ids = None
+            if read_trailing_ids:
+                ids = np.fromfile(f, dtype=id_dtype, count=number_of_vectors)
+                if len(ids) != number_of_vectors:
+                    raise ValueError(f"Expected {number_of_vectors} ids, but got {len(ids)}")
             return VectorsDataset(vectors=vectors, dimensions=dimension, ids=ids)
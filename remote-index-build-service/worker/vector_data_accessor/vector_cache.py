@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict
+
+import s3.s3client as s3
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE_EXTENSION = ".bin"
+PARTIAL_FILE_EXTENSION = ".partial"
+
+
+class CacheEntry:
+    """
+    A cached object which is pinned until release is called, so that it is not evicted while it is read.
+    Can be used as a context manager.
+    """
+
+    def __init__(self, cache: 'VectorCache', cache_key: str, path: str, hit: bool):
+        self.path = path
+        self.hit = hit
+        self._cache = cache
+        self._cache_key = cache_key
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._cache._unpin(self._cache_key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+
+class VectorCache:
+    """
+    A disk cache of the downloaded vector objects, keyed by the bucket, the key and the ETag of the object, so a
+    new version of an object is never served from the cache.
+
+    The cache holds at most max_bytes bytes, the least recently used objects are evicted to make room for new
+    ones. Objects which are read by a job are pinned and never evicted, and an object which is downloaded by a
+    job is not downloaded again by a concurrent job, which waits for the first download instead. The entries
+    are loaded from the cache directory when the worker starts, in the order they were last used.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._pins: Dict[str, int] = {}
+        self._downloads: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def get(self, bucket_name: str, object_key: str, etag: str, size: int,
+            download: Callable[[str], None], byte_range: tuple = None) -> CacheEntry:
+        """
+        Returns the pinned cache entry of the object, or of its byte_range when it is set. On a miss the object is
+        downloaded to the path passed to download, and added to the cache once download returns. Returns None when
+        the object is bigger than the whole cache, in which case it should be downloaded without the cache.
+        """
+        if size > self.max_bytes:
+            return None
+        cache_key = self._cache_key(bucket_name, object_key, etag, byte_range)
+        while True:
+            with self._lock:
+                if cache_key in self._entries:
+                    self._entries.move_to_end(cache_key)
+                    self._pin(cache_key)
+                    path = self._path(cache_key)
+                    # The last use of the entries is kept as the modification time of their file
+                    os.utime(path)
+                    logger.info(f"Cache hit for {object_key} in bucket {bucket_name}")
+                    return CacheEntry(self, cache_key, path, hit=True)
+                download_done = self._downloads.get(cache_key)
+                if download_done is None:
+                    self._downloads[cache_key] = threading.Event()
+                    break
+            # Another job is downloading the same object
+            download_done.wait()
+
+        partial_path = os.path.join(self.directory, f"{cache_key}.{uuid.uuid4()}{PARTIAL_FILE_EXTENSION}")
+        try:
+            with self._lock:
+                self._evict(size)
+            logger.info(f"Cache miss for {object_key} in bucket {bucket_name}")
+            download(partial_path)
+            os.replace(partial_path, self._path(cache_key))
+            with self._lock:
+                self._entries[cache_key] = size
+                self._pin(cache_key)
+                # Concurrent misses could have filled the cache while the object was downloading
+                self._evict(0)
+            return CacheEntry(self, cache_key, self._path(cache_key), hit=False)
+        except Exception:
+            s3.cleanup_temp_file(partial_path)
+            raise
+        finally:
+            with self._lock:
+                self._downloads.pop(cache_key).set()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {"objects": len(self._entries), "size": sum(self._entries.values()), "max_size": self.max_bytes,
+                    "size_unit": "bytes"}
+
+    def _pin(self, cache_key: str):
+        self._pins[cache_key] = self._pins.get(cache_key, 0) + 1
+
+    def _unpin(self, cache_key: str):
+        with self._lock:
+            self._pins[cache_key] -= 1
+            if self._pins[cache_key] == 0:
+                del self._pins[cache_key]
+
+    def _evict(self, size: int):
+        """Evict the least recently used objects which are not pinned until size more bytes fit in the cache"""
+        cached_size = sum(self._entries.values())
+        for cache_key in list(self._entries.keys()):
+            if cached_size + size <= self.max_bytes:
+                break
+            if cache_key in self._pins:
+                continue
+            cached_size -= self._entries.pop(cache_key)
+            s3.cleanup_temp_file(self._path(cache_key))
+
+    def _load(self):
+        entries = []
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            if file_name.endswith(PARTIAL_FILE_EXTENSION):
+                # Left by a download which was interrupted by a restart
+                s3.cleanup_temp_file(path)
+            elif file_name.endswith(CACHE_FILE_EXTENSION):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, file_name[:-len(CACHE_FILE_EXTENSION)], stat.st_size))
+        for _, cache_key, size in sorted(entries):
+            self._entries[cache_key] = size
+        self._evict(0)
+        logger.info(f"Loaded {len(self._entries)} objects from the vector cache {self.directory}")
+
+    def _path(self, cache_key: str) -> str:
+        return os.path.join(self.directory, f"{cache_key}{CACHE_FILE_EXTENSION}")
+
+    @staticmethod
+    def _cache_key(bucket_name: str, object_key: str, etag: str, byte_range: tuple = None) -> str:
+        key = f"{bucket_name}/{object_key}/{etag}"
+        if byte_range is not None:
+            key += f"/{byte_range[0]}-{byte_range[1]}"
+        return hashlib.sha256(key.encode()).hexdigest()